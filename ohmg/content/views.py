@@ -11,6 +11,7 @@ from ohmg.georeference.models import (
     Document,
     ItemBase,
     SetCategory,
+    prime_items,
 )
 from ohmg.core.context_processors import generate_ohmg_context
 from ohmg.core.schemas import AnnotationSetSchema
@@ -105,6 +106,7 @@ class VirtualResourceView(View):
             resource = Document.objects.get(pk=pk)
         elif resource.type == 'layer':
             resource = Layer.objects.get(pk=pk)
+        prime_items([resource])
 
         split_summary = resource.get_split_summary()
         georeference_summary = resource.get_georeference_summary()
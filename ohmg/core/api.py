@@ -83,10 +83,11 @@ def list_maps(request,
         locale_inclusive: bool = False,
     ):
     # overall, not really optimized. should refactor at some point...
+    maps = Volume.objects.all().select_related("progress", "loaded_by")
     if sort == "load_date":
-        maps = Volume.objects.all().order_by('-load_date')
+        maps = maps.order_by('-load_date')
     else:
-        maps = Volume.objects.all().order_by('city', 'year')
+        maps = maps.order_by('city', 'year')
     
     if locale:
         place = Place.objects.get(slug=locale)
@@ -0,0 +1,298 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# response codes that are worth retrying, anything else fails immediately
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+_local = threading.local()
+
+def get_session():
+    """Return a requests Session for the current thread. Sessions keep
+    connections alive between requests, so repeated downloads from the same
+    host don't pay for a new TCP/TLS handshake every time. Sessions aren't
+    guaranteed to be thread safe, so each thread gets its own."""
+
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
+
+class RateLimiter:
+    """Enforces a minimum interval between requests to the same host, across
+    all threads in this process. Intervals (in seconds) come from
+    settings.HTTP_HOST_RATE_LIMITS, keyed by host name."""
+
+    def __init__(self, intervals=None):
+        self.intervals = intervals if intervals is not None else settings.HTTP_HOST_RATE_LIMITS
+        self.next_request = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        interval = self.intervals.get(host, 0)
+        if not interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request.get(host, now))
+            self.next_request[host] = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+    return _rate_limiter
+
+def get_backoff(attempt, base=None):
+    """Exponential backoff delay (seconds) for a retry attempt, starting at 1."""
+    if base is None:
+        base = settings.HTTP_RETRY_BACKOFF
+    return base * (2 ** (attempt - 1))
+
+def file_sha256(path, chunk_size=1048576):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_remote_size(url, timeout=60):
+    """Return the size in bytes of the file at url from a HEAD request, or
+    None if it can't be determined."""
+
+    get_rate_limiter().wait(url)
+    try:
+        response = get_session().head(url, timeout=timeout, allow_redirects=True)
+    except requests.RequestException as e:
+        logger.warning(f"request error for {url}: {e}")
+        return None
+    length = response.headers.get("Content-Length")
+    if response.status_code != 200 or not (length and length.isdigit()):
+        return None
+    return int(length)
+
+def download_file(url, out_path, retries=3, checksum=None, chunk_size=1048576, timeout=60):
+    """Stream a file to out_path and return out_path, or None if the download
+    failed. Data is written to out_path + ".part" and only renamed into place
+    once complete, so an interrupted download resumes where it left off (with
+    an HTTP Range request) on the next attempt, or the next call. The size is
+    verified against the response headers, and checksum (sha256 hex) is
+    verified if given. Failed attempts are retried with exponential backoff.
+
+    An existing out_path is checked against the checksum, or without one,
+    against the size reported by a HEAD request, and is downloaded again if
+    it doesn't match."""
+
+    if os.path.isfile(out_path):
+        if checksum is not None:
+            valid = file_sha256(out_path) == checksum
+        else:
+            # if the size can't be found, the existing file is kept
+            expected = get_remote_size(url, timeout=timeout)
+            valid = expected is None or os.path.getsize(out_path) == expected
+        if valid:
+            logger.debug(f"already downloaded {url}")
+            return out_path
+        logger.warning(f"existing file for {url} doesn't match, downloading again")
+
+    part_path = out_path + ".part"
+    session = get_session()
+    limiter = get_rate_limiter()
+
+    for attempt in range(1, retries + 2):
+        if attempt > 1:
+            delay = get_backoff(attempt - 1)
+            logger.warning(f"retrying {url} in {delay} seconds ({attempt - 1}/{retries})")
+            time.sleep(delay)
+
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        limiter.wait(url)
+        logger.debug(f"request {url}" + (f" from byte {offset}" if offset else ""))
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416:
+                    # the partial file is already complete (or invalid), start over
+                    os.remove(part_path)
+                    continue
+                if response.status_code not in (200, 206):
+                    logger.warning(f"response code: {response.status_code} for {url}")
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        return None
+                    continue
+
+                # a 200 means the server ignored the Range header
+                if response.status_code == 200:
+                    offset = 0
+                    expected = response.headers.get("Content-Length")
+                else:
+                    expected = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+                expected = int(expected) if expected and expected.isdigit() else None
+
+                with open(part_path, "ab" if offset else "wb") as out_file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        out_file.write(chunk)
+
+        except requests.RequestException as e:
+            logger.warning(f"request error for {url}: {e}")
+            continue
+
+        size = os.path.getsize(part_path)
+        if expected is not None and size != expected:
+            logger.warning(f"incomplete download for {url}: {size}/{expected} bytes")
+            continue
+
+        if checksum is not None and file_sha256(part_path) != checksum:
+            logger.warning(f"checksum mismatch for {url}, discarding download")
+            os.remove(part_path)
+            continue
+
+        os.replace(part_path, out_path)
+        return out_path
+
+    logger.warning(f"request failed, cancelling: {url}")
+    return None
+
+def get_with_retries(url, retries=3, timeout=60, **kwargs):
+    """GET a url with the thread's pooled session, applying the per-host rate
+    limit and retrying connection errors and retryable status codes with
+    exponential backoff. Returns the response (which may have an error
+    status), or None if no response was ever received."""
+
+    session = get_session()
+    limiter = get_rate_limiter()
+    response = None
+    for attempt in range(1, retries + 2):
+        if attempt > 1:
+            delay = get_backoff(attempt - 1)
+            logger.warning(f"retrying {url} in {delay} seconds ({attempt - 1}/{retries})")
+            time.sleep(delay)
+        limiter.wait(url)
+        try:
+            response = session.get(url, timeout=timeout, **kwargs)
+        except requests.RequestException as e:
+            logger.warning(f"request error for {url}: {e}")
+            continue
+        if response.status_code not in RETRY_STATUS_CODES:
+            return response
+        logger.warning(f"response code: {response.status_code} for {url}")
+    return response
+
+class ResponseCache:
+    """A compact on-disk cache for JSON responses, keyed by url. Entries are
+    zlib-compressed into a single SQLite file, expire after ttl seconds, and
+    the least recently used entries are evicted once the total (compressed)
+    size passes max_size bytes, checked every EVICT_INTERVAL stores. Hit,
+    miss, and eviction counts are kept in self.metrics for the life of the
+    instance. Each thread gets its own SQLite connection, so one instance
+    can be shared across threads."""
+
+    EVICT_INTERVAL = 100
+
+    def __init__(self, path=None, ttl=None, max_size=None):
+        self.path = path if path else os.path.join(settings.CACHE_DIR, "http_cache.sqlite3")
+        self.ttl = ttl if ttl is not None else settings.HTTP_CACHE_TTL
+        self.max_size = max_size if max_size is not None else settings.HTTP_CACHE_MAX_SIZE
+        self.metrics = {"hits": 0, "misses": 0, "expired": 0, "stores": 0, "evictions": 0}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, data BLOB, size INTEGER, created REAL, accessed REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = conn
+        return conn
+
+    def _count(self, metric):
+        with self._lock:
+            self.metrics[metric] += 1
+
+    def get(self, url):
+        row = self.connection.execute(
+            "SELECT data, created FROM responses WHERE url = ?", (url, )
+        ).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        if self.ttl and time.time() - row[1] > self.ttl:
+            self._count("expired")
+            self.connection.execute("DELETE FROM responses WHERE url = ?", (url, ))
+            return None
+        self.connection.execute("UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), url))
+        self._count("hits")
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, url, data):
+        blob = zlib.compress(json.dumps(data, separators=(",", ":")).encode())
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (url, data, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (url, blob, len(blob), now, now),
+        )
+        with self._lock:
+            self.metrics["stores"] += 1
+            evict = self.metrics["stores"] % self.EVICT_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is under
+        max_size. Summing the sizes scans the whole table, so set() only
+        calls this every EVICT_INTERVAL stores."""
+        if not self.max_size:
+            return
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+        removed = 0
+        for url, size in self.connection.execute(
+            "SELECT url, size FROM responses ORDER BY accessed"
+        ).fetchall():
+            if total <= self.max_size:
+                break
+            self.connection.execute("DELETE FROM responses WHERE url = ?", (url, ))
+            total -= size
+            removed += 1
+        with self._lock:
+            self.metrics["evictions"] += removed
+
+    def clear(self):
+        self.connection.execute("DELETE FROM responses")
+
+    def summary(self):
+        lookups = self.metrics["hits"] + self.metrics["misses"] + self.metrics["expired"]
+        rate = round(self.metrics["hits"] / lookups * 100, 1) if lookups else 0
+        return ", ".join([f"{k}: {v}" for k, v in self.metrics.items()]) + f", hit rate: {rate}%"
@@ -3,16 +3,17 @@ import json
 import pytz
 import time
 import logging
-import requests
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from django.conf import settings
 from django.urls import reverse
 
+from ohmg.core.http import get_with_retries, ResponseCache
 from ohmg.core.utils import (
     full_capitalize,
 )
 from ohmg.loc_insurancemaps.models import Volume
+from ohmg.places.models import update_volume_counts
 from ohmg.georeference.models import AnnotationSet, SetCategory
 
 from ohmg.core.utils import (
@@ -21,6 +22,11 @@ from ohmg.core.utils import (
 
 logger = logging.getLogger(__name__)
 
+# errors from a malformed or unexpected LoC response, which skip a single
+# city or item during a bulk import (request errors are retried and logged
+# in get_with_retries)
+LOC_RESPONSE_ERRORS = (KeyError, IndexError, TypeError, ValueError)
+
 def filter_volumes_for_use(volumes):
     """
     This is the primary filter function that is applied to a set of volumes
@@ -87,50 +93,83 @@ def unsanitize_name(state, name):
 
     return rev.get(name, name)
 
-def import_all_available_volumes(state, apply_filter=True, verbose=False):
+def import_all_available_volumes(state, apply_filter=True, verbose=False, workers=1):
     """Preparatory step that runs through all cities in the provided
     state, filters the available volumes for those cities, and then
-    imports each one to create a new Volume object."""
+    imports each one to create a new Volume object.
+
+    With more than one worker, the city searches and item fetches run in a
+    thread pool, and each new volume's item is requested as soon as its city
+    search returns. Volumes are created in this thread as their items come
+    back, and all Place counts are recalculated once at the end, instead of
+    once per volume."""
 
-    lc = LOCConnection(delay=0, verbose=verbose)
+    cache = ResponseCache()
+    lc = LOCConnection(verbose=verbose, cache=cache)
     cities = lc.get_city_list_by_state(state)
 
-    volumes = []
-    for city in cities:
-        lc.reset()
-        city = unsanitize_name(state, city[0])
-        vols = lc.get_volume_list_by_city(city, state)
+    def get_city_volumes(city):
+        city_lc = LOCConnection(verbose=verbose, cache=cache)
+        vols = city_lc.get_volume_list_by_city(unsanitize_name(state, city[0]), state)
         if apply_filter is True:
-            vols = filter_volumes_for_use(vols)
-            volumes += [i for i in vols if i['include'] is True]
-        else:
-            volumes += vols
+            vols = [i for i in filter_volumes_for_use(vols) if i['include'] is True]
+        return vols
 
-    for volume in volumes:
-        try:
-            Volume.objects.get(pk=volume['identifier'])
-        except Volume.DoesNotExist:
-            import_volume(volume['identifier'])
+    def get_item_kwargs(identifier):
+        item_lc = LOCConnection(verbose=verbose, cache=cache)
+        return identifier, get_volume_kwargs(identifier, lc=item_lc)
 
-def import_volume(identifier, locale=None, dry_run=False):
+    start = time.time()
+    imported = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
 
-    try:
-        volume = Volume.objects.get(pk=identifier)
-        volume.locales.set([locale])
-        volume.update_place_counts()
+        city_futures = {executor.submit(get_city_volumes, city): city for city in cities}
+        item_futures = []
+        seen = set()
+        for future in as_completed(city_futures):
+            try:
+                vols = future.result()
+            except LOC_RESPONSE_ERRORS as e:
+                logger.error(f"{city_futures[future][0]} | city search failed: {e}")
+                continue
+            identifiers = [i['identifier'] for i in vols if i['identifier'] not in seen]
+            seen.update(identifiers)
+            existing = set(Volume.objects.filter(pk__in=identifiers).values_list("pk", flat=True))
+            item_futures += [executor.submit(get_item_kwargs, i) for i in identifiers if i not in existing]
 
-        # make sure a main-content layerset exists for this volume
-        main_ls, _ = AnnotationSet.objects.get_or_create(
-            category=SetCategory.objects.get(slug="main-content"),
-            volume=volume,
-        )
-        return volume
-    except Volume.DoesNotExist:
-        pass
+        for n, future in enumerate(as_completed(item_futures), start=1):
+            try:
+                identifier, volume_kwargs = future.result()
+            except LOC_RESPONSE_ERRORS as e:
+                logger.error(f"item fetch failed: {e}")
+                continue
+            if volume_kwargs is None:
+                logger.warning(f"{identifier} | no item returned, skipping")
+                continue
+            volume = create_volume(volume_kwargs, update_counts=False)
+            imported.append(volume)
+            if verbose:
+                print(f"{n}/{len(item_futures)} {volume}")
+
+    # one recount for the whole batch, and trim the response cache to size
+    update_volume_counts([i.pk for i in imported])
+    cache.evict()
+
+    if verbose:
+        print(f"imported {len(imported)} volumes in {round(time.time() - start, 2)} seconds")
+        print(f"LoC response cache | {lc.cache.summary()}")
 
-    lc = LOCConnection(delay=0, verbose=True)
+    return imported
+
+def get_volume_kwargs(identifier, lc=None):
+    """Fetch and parse the LoC item for a volume, and return the kwargs to
+    create it with. Returns None if the item doesn't exist. This doesn't
+    touch the database, so it is safe to run in a thread pool."""
+
+    if lc is None:
+        lc = LOCConnection(verbose=True)
     response = lc.get_item(identifier)
-    if response.get("status") == 404:
+    if not response or response.get("status") == 404:
         return None
 
     parsed = LOCParser(item=response['item'])
@@ -139,18 +178,51 @@ def import_volume(identifier, locale=None, dry_run=False):
     # add resources to args, not in item (they exist adjacent)
     volume_kwargs["lc_resources"] = response['resources']
 
-    if dry_run:
-        return volume_kwargs
-    else:
-        volume = Volume.objects.create(**volume_kwargs)
+    return volume_kwargs
+
+def create_volume(volume_kwargs, locale=None, update_counts=True):
+    """Create a new Volume from parsed kwargs. Pass update_counts=False when
+    creating many volumes at once, and recalculate Place counts afterward."""
+
+    volume = Volume.objects.create(**volume_kwargs)
+    if locale is not None:
         volume.locales.add(locale)
+    if update_counts:
         volume.update_place_counts()
+    # make sure a main-content layerset exists for this volume
+    AnnotationSet.objects.get_or_create(
+        category=SetCategory.objects.get(slug="main-content"),
+        volume=volume,
+    )
+    return volume
+
+def import_volume(identifier, locale=None, dry_run=False, update_counts=True):
+
+    try:
+        volume = Volume.objects.get(pk=identifier)
+        volume.locales.set([locale])
+        # a full recount, as the volume may have been moved off of its
+        # previous locale
+        if update_counts:
+            update_volume_counts()
+
         # make sure a main-content layerset exists for this volume
-        main_ls, _ = AnnotationSet.objects.get_or_create(
+        AnnotationSet.objects.get_or_create(
             category=SetCategory.objects.get(slug="main-content"),
             volume=volume,
         )
         return volume
+    except Volume.DoesNotExist:
+        pass
+
+    volume_kwargs = get_volume_kwargs(identifier)
+    if volume_kwargs is None:
+        return None
+
+    if dry_run:
+        return volume_kwargs
+    else:
+        return create_volume(volume_kwargs, locale=locale, update_counts=update_counts)
 
 
 class LOCParser(object):
@@ -380,32 +452,20 @@ class LOCParser(object):
 
 class LOCConnection(object):
 
-    def __init__(self, verbose=False, delay=5):
+    def __init__(self, verbose=False, cache=None):
 
         self.baseurl = "https://www.loc.gov"
         self.data = None
         self.results = []
         self.verbose = verbose
         self.query_url = ""
-        self.delay = delay
+        # pass a shared ResponseCache to pool metrics across connections
+        self.cache = cache if cache is not None else ResponseCache()
 
     def reset(self):
         self.data = None
         self.results = []
 
-    def make_cache_path(self, url=None):
-
-        if url is None:
-            url = self.query_url
-
-        cache_dir = settings.CACHE_DIR
-        if not os.path.isdir(cache_dir):
-            os.mkdir(cache_dir)
-        file_name = url.replace("/", "__") + ".json"
-        cache_path = os.path.join(cache_dir, file_name)
-
-        return cache_path
-
     def initialize_query(self, collection=None, identifier=None):
 
         if collection:
@@ -433,17 +493,10 @@ class LOCConnection(object):
         self.query_url += date_qry
 
     def load_cache(self, url):
-
-        path = self.make_cache_path(url)
-        if os.path.isfile(path):
-            with open(path, "r") as op:
-                self.data = json.loads(op.read())
+        self.data = self.cache.get(url)
 
     def save_cache(self, url):
-
-        path = self.make_cache_path(url)
-        with open(path, "w") as op:
-            json.dump(self.data, op, indent=1)
+        self.cache.set(url, self.data)
 
     def perform_search(self, no_cache=False, page=1):
 
@@ -456,30 +509,18 @@ class LOCConnection(object):
         self.load_cache(url)
         run_search = no_cache is True or self.data is None
         if self.verbose:
-            print(f"query url: {url} | delay: {self.delay} | using cache: {not run_search}")
+            print(f"query url: {url} | using cache: {not run_search}")
         if run_search:
-            if self.verbose and self.delay > 0:
-                print(f"waiting {self.delay} seconds before making a request...")
-            time.sleep(self.delay)
             if self.verbose:
                 print("making request")
-            try:
-                response = requests.get(url)
-                if response.status_code in [500, 503]:
-                    msg = f"{response.status_code} error, retrying in 5 seconds..."
-                    logger.warn(msg)
-                    if self.verbose:
-                        print(msg)
-                    time.sleep(5)
-                    if self.verbose:
-                        print("making request")
-                    response = requests.get(url)
-            except (ConnectionError, ConnectionRefusedError, ConnectionAbortedError, ConnectionResetError) as e:
-                msg = f"API Error: {e}"
+            # pooled session, rate limited per host, with backoff retries on errors
+            response = get_with_retries(url)
+            if response is None or response.status_code != 200:
+                msg = f"API Error: {'no response' if response is None else response.status_code}"
                 print(msg)
-                logger.warn(e)
+                logger.warn(msg)
                 return
-            
+
             self.data = json.loads(response.content)
             self.save_cache(url)
         else:
@@ -1,15 +1,27 @@
 import csv
+import time
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Q
 from django.contrib.auth import get_user_model
 
-from ohmg.core.importers.loc_sanborn import import_volume
+from ohmg.core.importers.loc_sanborn import import_volume, import_all_available_volumes
+from ohmg.core.renderers import generate_thumbnail_content
 from ohmg.loc_insurancemaps.models import Volume
 from ohmg.places.models import Place
 from ohmg.places.management.utils import reset_volume_counts
 from ohmg.georeference.models import ItemBase, Layer, DocumentLink
 
+def refresh_volume_lookups(identifier):
+    """Module-level so it can be run in a process pool. Only called in the
+    worker processes, where each task closes its own db connection."""
+    Volume.objects.get(pk=identifier).refresh_lookups()
+    connections.close_all()
+    return identifier
+
 class Command(BaseCommand):
     help = 'command to search the Library of Congress API.'
 
@@ -18,9 +30,11 @@ class Command(BaseCommand):
             "operation",
             choices=[
                 "import",
+                "import-state",
                 "remove",
                 "refresh-lookups-old",
                 "refresh-lookups",
+                "refresh-progress",
                 "make-sheets",
                 "generate-mosaic-cog",
                 "generate-mosaic-json",
@@ -87,6 +101,18 @@ class Command(BaseCommand):
             nargs="*",
             help="identifiers of volumes to exclude, used in conjunction with --all."
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of processes to use for thumbnail rendering, lookup refreshes, and "\
+                "document conversion during make-sheets, or threads for LoC requests during "\
+                "import-state. defaults to 1"
+        )
+        parser.add_argument(
+            "--state",
+            help="full name of the state to import all available volumes from"
+        )
 
     def handle(self, *args, **options):
 
@@ -103,12 +129,33 @@ class Command(BaseCommand):
         i = options['identifier']
         if options['operation'] == "refresh-lookups":
             if i is not None:
-                vols = Volume.objects.filter(pk=i)
+                vol_ids = [i]
+            else:
+                vol_ids = list(Volume.objects.all().values_list("pk", flat=True))
+            start = time.time()
+            if options['workers'] > 1 and len(vol_ids) > 1:
+                # vol_ids is already a list, so no queries are made between
+                # closing the db connections and forking the workers
+                connections.close_all()
+                with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                    for n, vol_id in enumerate(executor.map(refresh_volume_lookups, vol_ids), start=1):
+                        print(f"{n}/{len(vol_ids)} {vol_id}")
             else:
-                vols = Volume.objects.all()
-            for v in vols:
-                v.refresh_lookups()
-            print(f"refreshed lookups on {len(vols)} volumes")
+                for n, vol_id in enumerate(vol_ids, start=1):
+                    Volume.objects.get(pk=vol_id).refresh_lookups()
+                    print(f"{n}/{len(vol_ids)} {vol_id}")
+            print(f"refreshed lookups on {len(vol_ids)} volumes in {round(time.time() - start, 2)}s")
+
+        if options['operation'] == "refresh-progress":
+            # also backfills VolumeProgress rows for volumes that don't have one
+            if i is not None:
+                volumes = Volume.objects.filter(pk=i)
+            else:
+                volumes = Volume.objects.all()
+            total = volumes.count()
+            for n, vol in enumerate(volumes.order_by("pk"), start=1):
+                vol.update_progress()
+                print(f"{n}/{total} {vol.pk}")
 
         if options['operation'] == "import":
 
@@ -150,14 +197,26 @@ class Command(BaseCommand):
                 vol = import_volume(
                     identifier,
                     locale=locale,
-                    dry_run=options['dry_run']
+                    dry_run=options['dry_run'],
+                    update_counts=False,
                 )
-                if vol:
+                if vol and not options['dry_run']:
                     vol.access = options['access']
                     vol.sponsor = sponsor
                     vol.save()
                 print(vol)
 
+            # recount place volumes once for the whole batch
+            if not options['dry_run']:
+                reset_volume_counts()
+
+        if options['operation'] == "import-state":
+            import_all_available_volumes(
+                options['state'],
+                verbose=True,
+                workers=options['workers'],
+            )
+
         if options['operation'] == "remove":
             vol = Volume.objects.get(pk=i)
 
@@ -207,7 +266,11 @@ class Command(BaseCommand):
                 vol.loaded_by = user
                 vol.load_date = datetime.now()
                 vol.save(update_fields=["loaded_by", "load_date"])
-                vol.load_sheet_docs(force_reload=True)
+                vol.load_sheet_docs(
+                    force_reload=True,
+                    convert_workers=options['workers'],
+                    use_processes=options['workers'] > 1,
+                )
 
         if options['operation'] == "set-extent":
             if i is not None:
@@ -220,20 +283,53 @@ class Command(BaseCommand):
                 volumes += [Volume.objects.get(pk=options['identifier'])]
             elif options['all']:
                 volumes += Volume.objects.all()
+            exclude = options['exclude'] if options['exclude'] else []
 
-            for v in volumes:
-                print(v)
-                for i in v.document_lookup.keys():
-                    print(i)
-                    d = ItemBase.objects.get(pk=i)
-                    d.set_thumbnail()
-                for i in v.layer_lookup.keys():
-                    s = ItemBase.objects.filter(slug=i)
-                    for ss in s:
-                        print(ss)
-                        ss.set_thumbnail()
-                print("refreshing volume lookup.")
-                v.refresh_lookups()
+            def report(stage, count, elapsed):
+                rate = round(count / elapsed, 2) if elapsed else count
+                print(f"  {stage}: {count} in {round(elapsed, 2)}s ({rate}/s)")
+
+            total_ct, start = 0, time.time()
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                for v in volumes:
+                    if v.identifier in exclude:
+                        print(f"skipping excluded: {v.identifier}")
+                        continue
+                    print(v)
+
+                    a = time.time()
+                    items = ItemBase.objects.filter(
+                        Q(pk__in=list(v.document_lookup.keys())) |
+                        Q(slug__in=list(v.layer_lookup.keys()))
+                    )
+                    items = [i for i in items if i.file and i.type in ("document", "layer")]
+                    report("load", len(items), time.time() - a)
+
+                    a = time.time()
+                    # the workers are forked on the first submit, and must not
+                    # inherit the connection used for the queries above. this
+                    # is repeated per volume, at the cost of one reconnect.
+                    connections.close_all()
+                    contents = list(executor.map(
+                        generate_thumbnail_content,
+                        [i.type for i in items],
+                        [i.file.path for i in items],
+                        chunksize=4,
+                    ))
+                    report("render", len(items), time.time() - a)
+
+                    a = time.time()
+                    for item, content in zip(items, contents):
+                        item.set_thumbnail(content=content, save=False)
+                    ItemBase.objects.bulk_update(items, ["thumbnail"], batch_size=500)
+                    report("write", len(items), time.time() - a)
+
+                    a = time.time()
+                    v.refresh_lookups()
+                    report("refresh lookups", 1, time.time() - a)
+                    total_ct += len(items)
+
+            report("total", total_ct, time.time() - start)
 
         if options['operation'] == 'warp-layers':
             volumes = []
@@ -1,14 +1,67 @@
+import os
+import math
 from io import BytesIO
+
+import numpy as np
+from osgeo import gdal
 from PIL import Image, ImageOps
 
 from django.conf import settings
 
 Image.MAX_IMAGE_PIXELS = None
 
+def get_thumbnail_size(width, height, size):
+    """Return the dimensions that an image of width x height would be reduced
+    to by PIL's Image.thumbnail(size), i.e. fit within size while preserving
+    aspect ratio and never enlarging the image."""
+
+    x, y = map(math.floor, size)
+    if x >= width and y >= height:
+        return width, height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+def open_reduced_image(image_file_path, size):
+    """Open an image reduced to near the requested size. For JPEGs, draft
+    mode lets libjpeg scale by 1/2, 1/4, or 1/8 during decode, so the full
+    resolution image is never decoded. Other formats are fully decoded and
+    then box-reduced by an integer factor, which only keeps the expensive
+    final resample from running against the full resolution image. The
+    returned image is at least as large as size, and still needs a final
+    resize."""
+
+    img = Image.open(image_file_path)
+    if img.format == "JPEG":
+        img.draft(img.mode, size)
+    else:
+        factor = min(img.size[0] // size[0], img.size[1] // size[1])
+        if factor > 1:
+            img = img.reduce(factor)
+    return img
+
 def generate_document_thumbnail_content(image_file_path):
 
-    full_image = Image.open(image_file_path)
-    width, height = full_image.size
+    # tiled documents are read straight from their overviews
+    if os.path.splitext(image_file_path)[1].lower() in (".tif", ".tiff"):
+        max_dim = settings.DEFAULT_MAX_THUMBNAIL_DIMENSION
+        rgba = read_reduced_rgba(image_file_path, (max_dim, max_dim))
+        output = BytesIO()
+        Image.fromarray(rgba[..., :3]).save(output, format='JPEG')
+        content = output.getvalue()
+        output.close()
+        return content
+
+    with Image.open(image_file_path) as full_image:
+        width, height = full_image.size
+
     # only resize if one of the dimensions is larger than 200
     if width > settings.DEFAULT_MAX_THUMBNAIL_DIMENSION or height > settings.DEFAULT_MAX_THUMBNAIL_DIMENSION:
         biggest_dim = max([width, height])
@@ -17,51 +70,81 @@ def generate_document_thumbnail_content(image_file_path):
         new_size = (new_width, new_height)
         if 0 in new_size:
             return b''
-        image = ImageOps.fit(full_image, new_size, Image.ANTIALIAS)
+        reduced_image = open_reduced_image(image_file_path, new_size)
+        image = ImageOps.fit(reduced_image, new_size, Image.ANTIALIAS)
+        reduced_image.close()
     else:
-        image = full_image
+        image = Image.open(image_file_path)
 
     output = BytesIO()
     image.save(output, format='JPEG')
     content = output.getvalue()
     output.close()
 
+    image.close()
     del image
 
     return content
 
+def read_reduced_rgba(image_file_path, size):
+    """Read a raster at (roughly) thumbnail resolution and return an RGBA
+    uint8 array of shape (height, width, 4). Because the requested buffer
+    is smaller than the raster, GDAL will read from the closest internal
+    overview, so the full resolution data is never decoded."""
+
+    ds = gdal.Open(image_file_path)
+    if ds is None:
+        raise Exception(f"unable to open raster: {image_file_path}")
+
+    out_w, out_h = get_thumbnail_size(ds.RasterXSize, ds.RasterYSize, size)
+    read_kwargs = {
+        "buf_xsize": out_w,
+        "buf_ysize": out_h,
+        "resample_alg": gdal.GRIORA_Average,
+    }
+
+    band_ct = ds.RasterCount
+    rgb_bands = [1, 2, 3] if band_ct >= 3 else [1, 1, 1]
+    rgb = np.stack([ds.GetRasterBand(b).ReadAsArray(**read_kwargs) for b in rgb_bands])
+
+    # the alpha is either a 4th band, or (with the COG driver and JPEG
+    # compression) an internal mask on the first band
+    if band_ct >= 4:
+        alpha = ds.GetRasterBand(4).ReadAsArray(**read_kwargs)
+    else:
+        alpha = ds.GetRasterBand(1).GetMaskBand().ReadAsArray(**read_kwargs)
+
+    ds = None
+
+    rgba = np.empty((out_h, out_w, 4), dtype=np.uint8)
+    rgba[..., :3] = np.moveaxis(rgb, 0, -1)
+    rgba[..., 3] = alpha
+    return rgba
+
 def generate_layer_thumbnail_content(image_file_path):
 
     # generate blank thumbnail canvas, off-white background (geonode strategy)
     size = settings.DEFAULT_THUMBNAIL_SIZE
     background_color = (255, 255, 255)
-    background = Image.new("RGB", size, background_color)
+    background = np.full((size[1], size[0], 3), background_color, dtype=np.uint8)
 
-    # open full image and reduce to thumbnail
-    img = Image.open(image_file_path)
-    img.thumbnail(size)
-
-    # convert to RGB if necessary, this will turn the transparent areas black
-    if img.mode == 'RGBA':
-        img = img.convert('RGB')
+    # read a reduced version of the layer straight from the overviews
+    rgba = read_reduced_rgba(image_file_path, size)
+    img = rgba[..., :3]
 
-    # iterate all pixels, turn true black to white, i.e. transparent
-    for y in range(img.size[1]):
-        for x in range(img.size[0]):
-            if img.getpixel((x,y)) == (0, 0, 0):
-                img.putpixel((x,y), background_color)
+    # turn transparent and true black pixels to white
+    to_white = (rgba[..., 3] == 0) | np.all(img == 0, axis=-1)
+    img[to_white] = background_color
 
     # paste onto background with horizontal/vertical centering
-    paste_x, paste_y = 0, 0
-    if img.size[0] != size[0]:
-        paste_x = int((size[0] - img.size[0]) / 2)
-    if img.size[1] != size[1]:
-        paste_y = int((size[1] - img.size[1]) / 2)
-    background.paste(img, (paste_x, paste_y))
+    h, w = img.shape[:2]
+    paste_x = int((size[0] - w) / 2)
+    paste_y = int((size[1] - h) / 2)
+    background[paste_y:paste_y + h, paste_x:paste_x + w] = img
 
     # write to bytes
     output = BytesIO()
-    background.save(output, format='JPEG')
+    Image.fromarray(background).save(output, format='JPEG')
     content = output.getvalue()
     output.close()
 
@@ -69,3 +152,13 @@ def generate_layer_thumbnail_content(image_file_path):
     del background
 
     return content
+
+def generate_thumbnail_content(item_type, image_file_path):
+    """Dispatch to the document or layer renderer based on item type. Kept
+    at module level so it can be pickled and run in a process pool."""
+
+    if item_type == "document":
+        return generate_document_thumbnail_content(image_file_path)
+    elif item_type == "layer":
+        return generate_layer_thumbnail_content(image_file_path)
+    return None
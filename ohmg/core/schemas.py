@@ -67,20 +67,7 @@ class MapFullSchema(Schema):
         return obj.extent.extent if obj.extent else None
 
     def resolve_progress(obj):
-        items = obj.sort_lookups()
-        unprep_ct = len(items['unprepared'])
-        prep_ct = len(items['prepared'])
-        georef_ct = len(items['georeferenced'])
-        percent = 0
-        if georef_ct > 0:
-            percent = int((georef_ct / (unprep_ct + prep_ct + georef_ct)) * 100)
-
-        return {
-            "unprep_ct": unprep_ct,
-            "prep_ct": prep_ct,
-            "georef_ct": georef_ct,
-            "percent": percent,
-        }
+        return obj.get_progress().as_progress()
 
 
 class MapListSchema(Schema):
@@ -0,0 +1,304 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from osgeo import gdal
+from PIL import Image
+
+from django.test import SimpleTestCase, override_settings
+
+from ohmg.core import http
+from ohmg.core.renderers import (
+    generate_document_thumbnail_content,
+    generate_layer_thumbnail_content,
+    get_thumbnail_size,
+    open_reduced_image,
+)
+from ohmg.core.utils import full_reverse, full_reverse_pk, get_file_metadata
+
+CONTENT = os.urandom(256 * 1024)
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serves CONTENT at any path (HEAD requests only get its size, and
+    aren't recorded in requests). Behavior is adjusted per test through
+    attributes on the server: fail_count (503s before succeeding),
+    ignore_range, and truncate_at (stop sending after this many bytes)."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get("Range"))
+
+        if server.fail_count > 0:
+            server.fail_count -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and not server.ignore_range:
+            start = int(range_header.replace("bytes=", "").split("-")[0])
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        body = CONTENT[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if server.truncate_at is not None:
+            body = body[:server.truncate_at]
+            server.truncate_at = None
+        self.wfile.write(body)
+
+
+@override_settings(HTTP_RETRY_BACKOFF=0, HTTP_HOST_RATE_LIMITS={})
+class DownloadFileTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+        self.server.requests = []
+        self.server.fail_count = 0
+        self.server.ignore_range = False
+        self.server.truncate_at = None
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/00001.jp2"
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.out_path = os.path.join(self.tmpdir, "00001.jp2")
+        # the limiter is created lazily from settings, so start fresh
+        http._rate_limiter = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def read_output(self):
+        with open(self.out_path, "rb") as f:
+            return f.read()
+
+    def test_download(self):
+        result = http.download_file(self.url, self.out_path)
+        self.assertEqual(result, self.out_path)
+        self.assertEqual(self.read_output(), CONTENT)
+        self.assertFalse(os.path.exists(self.out_path + ".part"))
+
+    def test_existing_file_is_not_downloaded(self):
+        with open(self.out_path, "wb") as f:
+            f.write(CONTENT)
+        http.download_file(self.url, self.out_path)
+        self.assertEqual(self.server.requests, [])
+
+    def test_incomplete_existing_file_is_downloaded(self):
+        with open(self.out_path, "wb") as f:
+            f.write(CONTENT[:1000])
+        result = http.download_file(self.url, self.out_path)
+        self.assertEqual(result, self.out_path)
+        self.assertEqual(self.server.requests, [None])
+        self.assertEqual(self.read_output(), CONTENT)
+
+    def test_resume_from_partial_file(self):
+        with open(self.out_path + ".part", "wb") as f:
+            f.write(CONTENT[:1000])
+        http.download_file(self.url, self.out_path)
+        self.assertEqual(self.server.requests, ["bytes=1000-"])
+        self.assertEqual(self.read_output(), CONTENT)
+
+    def test_resume_after_interrupted_response(self):
+        self.server.truncate_at = 5000
+        result = http.download_file(self.url, self.out_path, retries=1)
+        self.assertEqual(result, self.out_path)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.read_output(), CONTENT)
+
+    def test_server_ignores_range(self):
+        self.server.ignore_range = True
+        with open(self.out_path + ".part", "wb") as f:
+            f.write(b"x" * 1000)
+        http.download_file(self.url, self.out_path)
+        self.assertEqual(self.read_output(), CONTENT)
+
+    def test_retry_status_codes(self):
+        self.server.fail_count = 2
+        result = http.download_file(self.url, self.out_path, retries=2)
+        self.assertEqual(result, self.out_path)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retries_exhausted(self):
+        self.server.fail_count = 5
+        result = http.download_file(self.url, self.out_path, retries=1)
+        self.assertIsNone(result)
+        self.assertFalse(os.path.exists(self.out_path))
+
+    def test_checksum(self):
+        checksum = hashlib.sha256(CONTENT).hexdigest()
+        result = http.download_file(self.url, self.out_path, checksum=checksum)
+        self.assertEqual(result, self.out_path)
+
+    def test_checksum_mismatch(self):
+        result = http.download_file(self.url, self.out_path, retries=0, checksum="0" * 64)
+        self.assertIsNone(result)
+        self.assertFalse(os.path.exists(self.out_path))
+        self.assertFalse(os.path.exists(self.out_path + ".part"))
+
+
+class RateLimiterTests(SimpleTestCase):
+
+    def test_interval_is_shared_across_threads(self):
+        limiter = http.RateLimiter(intervals={"tile.loc.gov": 0.1})
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(limiter.wait, ["https://tile.loc.gov/a.jp2"] * 4))
+        # the first request goes immediately, the next three wait in turn
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+
+    def test_hosts_are_limited_separately(self):
+        limiter = http.RateLimiter(intervals={"tile.loc.gov": 1})
+        start = time.monotonic()
+        limiter.wait("https://tile.loc.gov/a.jp2")
+        limiter.wait("https://www.loc.gov/item/")
+        limiter.wait("https://www.loc.gov/item/")
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class ResponseCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = http.ResponseCache(path=os.path.join(self.tmpdir, "cache.sqlite3"), ttl=0, max_size=1)
+        self.cache.EVICT_INTERVAL = 3
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_and_set(self):
+        self.cache.set("https://www.loc.gov/item/a", {"item": "a"})
+        self.assertEqual(self.cache.get("https://www.loc.gov/item/a"), {"item": "a"})
+        self.assertIsNone(self.cache.get("https://www.loc.gov/item/b"))
+
+    def test_eviction_runs_every_interval(self):
+        for i in range(2):
+            self.cache.set(f"https://www.loc.gov/item/{i}", {"item": i})
+        self.assertEqual(self.cache.metrics["evictions"], 0)
+        self.cache.set("https://www.loc.gov/item/2", {"item": 2})
+        self.assertEqual(self.cache.metrics["evictions"], 3)
+        self.assertIsNone(self.cache.get("https://www.loc.gov/item/0"))
+
+
+class FileMetadataTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "sheet.png")
+        Image.new("RGB", (300, 200), "white").save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_metadata(self):
+        with open(self.path, "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        metadata = get_file_metadata(self.path)
+        self.assertEqual((metadata["image_width"], metadata["image_height"]), (300, 200))
+        self.assertEqual(metadata["file_format"], "PNG")
+        self.assertEqual(metadata["file_size"], os.path.getsize(self.path))
+        self.assertEqual(metadata["file_checksum"], checksum)
+
+    def test_metadata_without_checksum(self):
+        metadata = get_file_metadata(self.path, checksum=False)
+        self.assertEqual((metadata["image_width"], metadata["image_height"]), (300, 200))
+        self.assertIsNone(metadata["file_checksum"])
+
+
+class FullReversePkTests(SimpleTestCase):
+
+    def test_matches_full_reverse(self):
+        for pk in (1, 987654321, 1987654321):
+            self.assertEqual(
+                full_reverse_pk("resource_detail", pk),
+                full_reverse("resource_detail", args=(pk, )),
+            )
+
+    @override_settings(SITEURL="http://example.com:8000/")
+    def test_follows_siteurl(self):
+        self.assertEqual(full_reverse_pk("resource_detail", 5), "http://example.com:8000/resource/5")
+
+
+@override_settings(DEFAULT_THUMBNAIL_SIZE=(100, 100), DEFAULT_MAX_THUMBNAIL_DIMENSION=200)
+class ThumbnailTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def open_content(self, content):
+        with Image.open(BytesIO(content)) as img:
+            return img.convert("RGB")
+
+    def assertColor(self, img, xy, color):
+        for actual, expected in zip(img.getpixel(xy), color):
+            self.assertAlmostEqual(actual, expected, delta=30)
+
+    def test_size_matches_pil_thumbnail(self):
+        for size in [(1000, 500), (333, 1000), (150, 90), (4001, 3999)]:
+            img = Image.new("RGB", size)
+            img.thumbnail((200, 200))
+            self.assertEqual(get_thumbnail_size(*size, (200, 200)), img.size)
+
+    def test_open_reduced_image(self):
+        path = os.path.join(self.tmpdir, "sheet.png")
+        Image.new("RGB", (1000, 500), "red").save(path)
+        with open_reduced_image(path, (200, 100)) as img:
+            self.assertEqual(img.size, (200, 100))
+
+    def test_document_thumbnail(self):
+        path = os.path.join(self.tmpdir, "sheet.png")
+        Image.new("RGB", (1000, 500), "red").save(path)
+        img = self.open_content(generate_document_thumbnail_content(path))
+        self.assertEqual(img.size, (200, 100))
+        self.assertColor(img, (100, 50), (255, 0, 0))
+
+    def test_layer_thumbnail(self):
+        # left half opaque red with a black square, right half transparent
+        data = np.zeros((4, 200, 400), dtype=np.uint8)
+        data[0, :, :200] = 255
+        data[3, :, :200] = 255
+        data[:3, 60:140, 100:180] = 0
+        path = os.path.join(self.tmpdir, "layer.tif")
+        ds = gdal.GetDriverByName("GTiff").Create(path, 400, 200, 4, gdal.GDT_Byte)
+        for n, band in enumerate(data, start=1):
+            ds.GetRasterBand(n).WriteArray(band)
+        ds = None
+
+        img = self.open_content(generate_layer_thumbnail_content(path))
+        self.assertEqual(img.size, (100, 100))
+        # the 100 x 50 layer is centered vertically on a white background
+        self.assertColor(img, (5, 10), (255, 255, 255))
+        self.assertColor(img, (10, 50), (255, 0, 0))
+        # black and transparent pixels are turned white
+        self.assertColor(img, (35, 50), (255, 255, 255))
+        self.assertColor(img, (75, 50), (255, 255, 255))
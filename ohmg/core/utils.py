@@ -1,67 +1,215 @@
 import os
-import time
-import shutil
 import string
 import random
-import requests
+import hashlib
 import logging
+from functools import cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 from django.conf import settings
 from django.urls import reverse
 
+from osgeo import gdal
 from PIL import Image
 
+from ohmg.core.http import download_file
+
 logger = logging.getLogger(__name__)
 
 def download_image(url, out_path, retries=3):
+    """Download url to out_path, see ohmg.core.http.download_file()."""
+    return download_file(url, out_path, retries=retries)
 
-    # basic download code: https://stackoverflow.com/a/18043472/3873885
-    while True:
-        logger.debug(f"request {url}")
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(out_path, 'wb') as out_file:
-                shutil.copyfileobj(response.raw, out_file)
-            return out_path
-        else:
-            logger.warn(f"response code: {response.status_code} retries left: {retries}")
-            time.sleep(5)
-            retries -= 1
-            if retries == 0:
-                logger.warn("request failed, cancelling")
-                return None
-            
+# creation options for documents stored as tiled, pyramidal TIFFs in pixel
+# space (there is no georeferencing, the COG driver is used for its layout)
+DOCUMENT_COG_CREATION_OPTIONS = [
+    "BLOCKSIZE=512",
+    "COMPRESS=JPEG",
+    "QUALITY=90",
+    "OVERVIEWS=AUTO",
+    "OVERVIEW_RESAMPLING=AVERAGE",
+    "NUM_THREADS=ALL_CPUS",
+]
 
 def convert_img_format(input_img, format="JPEG"):
 
-    ext_map = {"PNG":".png", "JPEG":".jpg", "TIFF": ".tif"}
+    ext_map = {"PNG":".png", "JPEG":".jpg", "TIFF": ".tif", "COG": ".tif"}
     ext = os.path.splitext(input_img)[1]
 
     outpath = input_img.replace(ext, ext_map[format])
 
+    if format == "COG":
+        to = gdal.TranslateOptions(format="COG", creationOptions=DOCUMENT_COG_CREATION_OPTIONS)
+        ds = gdal.Translate(outpath, input_img, options=to)
+        if ds is None:
+            raise Exception(f"unable to convert {os.path.basename(input_img)} to COG")
+        ds = None
+        return outpath
+
     img = Image.open(input_img)
     img.save(outpath, format=format)
 
     return outpath
 
-def get_jpg_from_jp2_url(jp2_url):
+def get_file_metadata(file_path, checksum=True, chunk_size=1048576):
+    """Return a dict with the pixel dimensions, format, byte size, and
+    sha256 checksum of an image file. Only the image header is parsed, and
+    the checksum is calculated in chunks, so large files are never held in
+    memory. Hashing still reads the whole file, so pass checksum=False to
+    skip it (file_checksum will be None). Files that PIL can't read (like
+    some GeoTIFFs) fall back on GDAL for dimensions and format, and tiled
+    TIFFs with overviews get the format "COG"."""
+
+    file_checksum = None
+    if checksum:
+        h = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+        file_checksum = h.hexdigest()
+
+    metadata = {
+        "image_width": None,
+        "image_height": None,
+        "file_size": os.path.getsize(file_path),
+        "file_checksum": file_checksum,
+        "file_format": None,
+    }
+
+    try:
+        with Image.open(file_path) as img:
+            metadata["image_width"], metadata["image_height"] = img.size
+            metadata["file_format"] = img.format
+    except Exception as e:
+        ds = gdal.Open(file_path)
+        if ds is None:
+            logger.warn(f"unable to read image metadata from {file_path}: {e}")
+        else:
+            metadata["image_width"], metadata["image_height"] = ds.RasterXSize, ds.RasterYSize
+            metadata["file_format"] = ds.GetDriver().ShortName
+            ds = None
+
+    # tiled TIFFs are recorded as COG, so that whether a document can be
+    # served through the IIIF image views is known without opening it
+    if metadata["file_format"] in ("TIFF", "GTiff") and raster_is_tiled(file_path):
+        metadata["file_format"] = "COG"
+
+    return metadata
+
+def raster_is_tiled(file_path):
+    """True if the raster is internally tiled (square blocks, not strips)
+    and has overviews, unless it's small enough to fit in one tile."""
+
+    ds = gdal.Open(file_path)
+    if ds is None:
+        return False
+    block_w, block_h = ds.GetRasterBand(1).GetBlockSize()
+    overview_ct = ds.GetRasterBand(1).GetOverviewCount()
+    width, height = ds.RasterXSize, ds.RasterYSize
+    ds = None
+
+    if block_w != block_h or block_w <= 1:
+        return False
+    return overview_ct > 0 or max(width, height) <= block_w
+
+def get_source_img_format(source_format=None):
+    """Return the convert_img_format() format for a document source format,
+    either "jpeg" (a single baseline JPEG) or "cog" (a tiled TIFF with
+    overviews). Defaults to settings.DOCUMENT_SOURCE_FORMAT."""
+
+    if source_format is None:
+        source_format = settings.DOCUMENT_SOURCE_FORMAT
+    img_format = {"jpeg": "JPEG", "cog": "COG"}.get(source_format)
+    if img_format is None:
+        raise Exception(f"invalid document source format: {source_format}")
+    return img_format
+
+def get_jp2_cache_path(jp2_url):
+    """Return the path that a JP2 is downloaded to in CACHE_DIR. The name is
+    prefixed with a hash of the url because LoC file names (e.g. 00001.jp2)
+    repeat across volumes, and it must be stable for interrupted downloads
+    to be resumed."""
 
     temp_img_dir = os.path.join(settings.CACHE_DIR, "img")
-    if not os.path.isdir(temp_img_dir):
-        os.mkdir(temp_img_dir)
+    os.makedirs(temp_img_dir, exist_ok=True)
+    url_hash = hashlib.sha1(jp2_url.encode()).hexdigest()[:10]
+    return os.path.join(temp_img_dir, f"{url_hash}_{jp2_url.split('/')[-1]}")
+
+def convert_jp2(jp2_path, img_format="JPEG"):
+    """Convert a downloaded JP2 to the document storage format and remove the
+    JP2. Kept at module level so it can be run in a process pool."""
+
+    # convert the downloaded jp2 to jpeg (needed for OpenLayers static image)
+    # or to a tiled tif (served through the IIIF image endpoint)
+    out_path = convert_img_format(jp2_path, format=img_format)
+    os.remove(jp2_path)
 
-    tmp_path = os.path.join(temp_img_dir, jp2_url.split("/")[-1])
+    return out_path
 
-    tmp_path = download_image(jp2_url, tmp_path)
-    print(tmp_path)
+def get_document_from_jp2_url(jp2_url, source_format=None):
+    """Download a JP2 and convert it to the format that documents are stored
+    in (see get_source_img_format)."""
+
+    img_format = get_source_img_format(source_format)
+    tmp_path = download_image(jp2_url, get_jp2_cache_path(jp2_url))
     if tmp_path is None:
         return
 
-    # convert the downloaded jp2 to jpeg (needed for OpenLayers static image)
-    jpg_path = convert_img_format(tmp_path, format="JPEG")
-    os.remove(tmp_path)
+    return convert_jp2(tmp_path, img_format)
+
+def get_documents_from_jp2_urls(jp2_urls, source_format=None, download_workers=None,
+        convert_workers=None, use_processes=False, progress=None):
+    """Download and convert many JP2s at once. Downloads run in a thread pool
+    (bounded by settings.LOC_DOWNLOAD_WORKERS, and subject to the per-host
+    rate limits in ohmg.core.http), and each finished download is handed
+    straight to a second pool for conversion, so downloading and converting
+    overlap. Conversions run in threads unless use_processes=True, which is
+    only safe outside of Celery workers (their daemonic processes can't
+    start child processes). progress is an optional callable that is given
+    (url, path) as each file is ready. Returns a dict of output paths keyed
+    by url, with None for any that failed."""
+
+    if download_workers is None:
+        download_workers = settings.LOC_DOWNLOAD_WORKERS
+    img_format = get_source_img_format(source_format)
+    convert_executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
 
-    return jpg_path
+    results = {}
+    with ThreadPoolExecutor(max_workers=download_workers) as downloads, \
+            convert_executor(max_workers=convert_workers) as conversions:
+
+        download_futures = {
+            downloads.submit(download_image, url, get_jp2_cache_path(url)): url for url in jp2_urls
+        }
+        convert_futures = {}
+        for future in as_completed(download_futures):
+            url = download_futures[future]
+            try:
+                jp2_path = future.result()
+            except Exception as e:
+                logger.error(f"download error for {url}: {e}")
+                jp2_path = None
+            if jp2_path is None:
+                results[url] = None
+                if progress:
+                    progress(url, None)
+                continue
+            convert_futures[conversions.submit(convert_jp2, jp2_path, img_format)] = url
+
+        for future in as_completed(convert_futures):
+            url = convert_futures[future]
+            try:
+                results[url] = future.result()
+            except Exception as e:
+                logger.error(f"conversion error for {url}: {e}")
+                results[url] = None
+            if progress:
+                progress(url, results[url])
+
+    return results
+
+def get_jpg_from_jp2_url(jp2_url):
+    return get_document_from_jp2_url(jp2_url, source_format="jpeg")
 
 def full_capitalize(in_str):
     return " ".join([i.capitalize() for i in in_str.split(" ")])
@@ -72,6 +220,29 @@ def full_reverse(view_name, **kwargs):
     full_url = base + reverse(view_name, **kwargs)
     return full_url
 
+# stands in for the pk when a URL is reversed as a template
+URL_PK_PLACEHOLDER = 987654321
+
+@cache
+def get_pk_url_parts(view_name, base):
+    """Reverse a URL that takes a single pk argument once per view (and
+    base url), and return the (prefix, suffix) on either side of the pk.
+    Returns None if the placeholder can't be told apart from the rest of
+    the URL. See full_reverse_pk()."""
+    parts = (base + reverse(view_name, args=(URL_PK_PLACEHOLDER, ))).split(str(URL_PK_PLACEHOLDER))
+    if len(parts) != 2:
+        return None
+    return tuple(parts)
+
+def full_reverse_pk(view_name, pk):
+    """Equivalent to full_reverse(view_name, args=(pk, )), but the URL
+    resolver only runs the first time a view is requested. This matters when
+    serializing many items at once."""
+    parts = get_pk_url_parts(view_name, settings.SITEURL.rstrip("/"))
+    if parts is None:
+        return full_reverse(view_name, args=(pk, ))
+    return f"{parts[0]}{pk}{parts[1]}"
+
 def slugify(input_string, join_char="-"):
 
     output = input_string.lower()
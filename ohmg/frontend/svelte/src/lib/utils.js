@@ -1,5 +1,6 @@
 import VectorSource from 'ol/source/Vector';
 import ImageStatic from 'ol/source/ImageStatic';
+import IIIF from 'ol/source/IIIF';
 import OSM from 'ol/source/OSM';
 import XYZ from 'ol/source/XYZ';
 import TileWMS from 'ol/source/TileWMS';
@@ -8,6 +9,7 @@ import MousePosition from 'ol/control/MousePosition';
 import {createStringXY} from 'ol/coordinate';
 
 import GeoJSON from 'ol/format/GeoJSON';
+import IIIFInfo from 'ol/format/IIIFInfo';
 
 import {transformExtent} from 'ol/proj';
 
@@ -23,6 +25,7 @@ import RegularShape from 'ol/style/RegularShape';
 import {Modify} from 'ol/interaction';
 
 import TileLayer from 'ol/layer/Tile';
+import ImageLayer from 'ol/layer/Image';
 import VectorLayer from 'ol/layer/Vector';
 import LayerGroup from 'ol/layer/Group';
 import MapboxVector from 'ol/layer/MapboxVector';
@@ -130,6 +133,34 @@ export function makeBasemaps (mapboxKey) {
 	]
 }
 
+export function makeDocumentImageLayer (document, projection, extent) {
+	// tiled documents (see DOCUMENT_SOURCE_FORMAT) can't be decoded by the
+	// browser as a single image, so they are read through the IIIF image
+	// service, one tile at a time. The source is added once info.json loads.
+	if (document.urls.iiif_info) {
+		const layer = new TileLayer();
+		fetch(document.urls.iiif_info)
+			.then(response => response.json())
+			.then(info => {
+				const options = new IIIFInfo(info).getTileSourceOptions();
+				layer.setSource(new IIIF({
+					...options,
+					projection: projection,
+					extent: extent,
+					zDirection: -1,
+				}));
+			});
+		return layer
+	}
+	return new ImageLayer({
+		source: new ImageStatic({
+			url: document.urls.image,
+			projection: projection,
+			imageExtent: extent,
+		}),
+	})
+}
+
 export function makeModifyInteraction(hitDetection, source, targetElement, style) {
 	const modify = new Modify({
 		hitDetection: hitDetection,
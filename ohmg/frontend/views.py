@@ -2,6 +2,7 @@ import os
 import logging
 
 from django.conf import settings
+from django.core.cache import caches
 from django.http import JsonResponse, Http404, HttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.views import View
@@ -16,7 +17,7 @@ from ohmg.core.schemas import AnnotationSetSchema
 
 from ohmg.loc_insurancemaps.models import Volume
 
-from ohmg.places.models import Place
+from ohmg.places.models import Place, get_viewer_volume_key
 
 
 if settings.ENABLE_NEWSLETTER:
@@ -217,11 +218,22 @@ class Viewer(View):
         else:
             place = Place.objects.get(slug="louisiana")
 
-        place_data = place.serialize()
-        for v in Volume.objects.filter(locales__id__exact=place.id).order_by("year","volume_no").reverse():
+        place_data = place.serialize_cached()
+
+        # volume payloads are cached individually, and expired by the
+        # receivers in ohmg.places.receivers whenever a volume changes
+        cache = caches["places"]
+        volume_ids = list(Volume.objects.filter(locales__id__exact=place.id) \
+            .order_by("year","volume_no").reverse().values_list("pk", flat=True))
+        keys = [get_viewer_volume_key(i) for i in volume_ids]
+        cached = cache.get_many(keys)
+        missing = [i for i, key in zip(volume_ids, keys) if key not in cached]
+        for v in Volume.objects.filter(pk__in=missing):
             v_serialized = v.serialize()
             v_serialized['main_annotation_set'] = AnnotationSetSchema.from_orm(v.get_annotation_set('main-content')).dict()
-            volumes.append(v_serialized)
+            cached[get_viewer_volume_key(v.pk)] = v_serialized
+            cache.set(get_viewer_volume_key(v.pk), v_serialized)
+        volumes = [cached[key] for key in keys if key in cached]
 
         context_dict = {
             "svelte_params": {
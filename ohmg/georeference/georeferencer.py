@@ -1,9 +1,15 @@
 import os
 import sys
 import time
+import hashlib
 import logging
-import requests
-from osgeo import gdal, osr, ogr
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from osgeo import gdal, osr
 
 from io import StringIO
 
@@ -44,6 +50,42 @@ TRANSFORMATION_LOOKUP = {
     }
 }
 
+# named sets of COG creation options. the COG driver writes RGB JPEG as YCbCr
+# on its own, and turns the alpha band into an internal mask for JPEG/WEBP.
+COG_ENCODING_PROFILES = {
+    "jpeg": {
+        "name": "JPEG",
+        "creation_options": ["COMPRESS=JPEG"],
+    },
+    "jpeg-ycbcr-q75": {
+        "name": "JPEG (YCbCr, quality 75)",
+        "creation_options": ["COMPRESS=JPEG", "QUALITY=75"],
+    },
+    "webp": {
+        "name": "WEBP (quality 75)",
+        "creation_options": ["COMPRESS=WEBP", "QUALITY=75"],
+    },
+    "deflate-pred2": {
+        "name": "DEFLATE (horizontal predictor)",
+        "creation_options": ["COMPRESS=DEFLATE", "PREDICTOR=YES"],
+    },
+}
+
+def get_cog_creation_options(profile=None):
+    """Return the full list of COG creation options for the named encoding
+    profile, falling back on settings.COG_ENCODING_PROFILE if it's None or
+    blank (as stored by an AnnotationSet that uses the site default)."""
+
+    if not profile:
+        profile = settings.COG_ENCODING_PROFILE
+    if profile not in COG_ENCODING_PROFILES:
+        raise Exception(f"invalid encoding profile, must be one of {list(COG_ENCODING_PROFILES.keys())}")
+
+    return COG_ENCODING_PROFILES[profile]["creation_options"] + [
+        "TILING_SCHEME=GoogleMapsCompatible",
+        f"NUM_THREADS={settings.GEOREFERENCE_NUM_THREADS}",
+    ]
+
 class CapturingStdout(list):
     def __enter__(self):
         self._stdout = sys.stdout
@@ -86,6 +128,31 @@ def anticipate_polynomial_order(gcp_count):
         ## though there are enough GCPs for poly3
         return "poly3"
 
+def delete_stale_previews(directory=None, max_age=None):
+    """Remove preview VRTs (see Georeferencer.warp_preview) that haven't been
+    created or reused in the last max_age seconds (defaults to
+    settings.PREVIEW_VRT_MAX_AGE), along with any abandoned temp files.
+    Returns the number of files removed."""
+
+    if directory is None:
+        directory = os.path.join(settings.MEDIA_ROOT, "documents")
+    if max_age is None:
+        max_age = settings.PREVIEW_VRT_MAX_AGE
+
+    removed = 0
+    cutoff = time.time() - max_age
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if "_preview-" not in entry.name or not entry.name.endswith((".vrt", ".tmp")):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
 def get_path_variant(original_path, variant, outdir=None):
     """Used to standardize the derivative names of Document files created
     during the georeferencing process"""
@@ -107,23 +174,136 @@ def get_path_variant(original_path, variant, outdir=None):
     
     return os.path.join(outdir, filename)
 
+class _OSRRegistry(threading.local):
+    """LRU cache of osr.SpatialReference and osr.CoordinateTransformation
+    objects. These objects (and the PROJ contexts behind them) are not safe
+    to share across threads, so subclassing threading.local gives each
+    thread its own cache, with no locking needed on lookup."""
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self, key, factory):
+        try:
+            self.items.move_to_end(key)
+            return self.items[key]
+        except KeyError:
+            value = factory()
+            self.items[key] = value
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+            return value
+
+_osr_registry = _OSRRegistry()
+
+def get_srs(epsg, traditional=False):
+    """Return a cached osr.SpatialReference for the given EPSG code, built
+    from GDAL's own PROJ database (no network access). Use traditional=True
+    for lng/lat (x/y) axis order, otherwise the authority order is used.
+    Callers must not modify the returned object."""
+
+    epsg = int(epsg)
+
+    def make_srs():
+        sr = osr.SpatialReference()
+        sr.ImportFromEPSG(epsg)
+        if traditional:
+            sr.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        return sr
+
+    return _osr_registry.get(("srs", epsg, traditional), make_srs)
+
+def get_transformation(src_epsg, dst_epsg, traditional=False):
+    """Return a cached osr.CoordinateTransformation between two EPSG codes.
+    Axis order follows get_srs()."""
+
+    src_epsg, dst_epsg = int(src_epsg), int(dst_epsg)
+
+    def make_transformation():
+        return osr.CoordinateTransformation(
+            get_srs(src_epsg, traditional),
+            get_srs(dst_epsg, traditional),
+        )
+
+    return _osr_registry.get(("ct", src_epsg, dst_epsg, traditional), make_transformation)
+
+@lru_cache(maxsize=64)
 def retrieve_srs_wkt(code):
 
-    srs_cache_dir = os.path.join(settings.CACHE_DIR, 'srs_wkt')
-    if not os.path.isdir(srs_cache_dir):
-        os.makedirs(srs_cache_dir, exist_ok=True)
-    cache_path = os.path.join(srs_cache_dir, f"{code}-wkt.txt")
-    if os.path.isfile(cache_path):
-        with open(cache_path, "r") as o:
-            wkt = o.read()
-    else:
-        url = f"https://epsg.io/{code}.wkt"
-        response = requests.get(url)
-        wkt = response.content.decode("utf-8")
-        with open(cache_path, "w") as o:
-            o.write(wkt)
+    return get_srs(code).ExportToWkt()
+
+def _format_pixel(value):
+    return int(value) if float(value).is_integer() else value
+
+class GCPSet:
+    """Array-backed collection of ground control points. Pixel and map
+    coordinates are held in (n, 2) numpy arrays, so the whole set can be
+    reprojected with one TransformPoints call, and then output as GDAL GCPs,
+    a QGIS points file, or GeoJSON. Map coordinates are always x/y in
+    traditional GIS axis order (lng/lat for EPSG:4326)."""
+
+    def __init__(self, pixels, coords, epsg=4326, properties=None):
+        self.pixels = np.asarray(pixels, dtype=float).reshape(-1, 2)
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.epsg = int(epsg)
+        if properties is None:
+            properties = [{} for i in range(len(self.pixels))]
+        self.properties = properties
+
+    def __len__(self):
+        return len(self.pixels)
+
+    @classmethod
+    def from_geojson(cls, geo_json):
+        features = geo_json['features']
+        return cls(
+            [f['properties']['image'] for f in features],
+            [f['geometry']['coordinates'][:2] for f in features],
+            epsg=4326,
+            properties=[f['properties'] for f in features],
+        )
 
-    return wkt
+    def transform(self, epsg):
+        """Return a new GCPSet with coordinates reprojected to epsg."""
+
+        if int(epsg) == self.epsg or len(self) == 0:
+            return GCPSet(self.pixels, self.coords.copy(), epsg, self.properties)
+        ct = get_transformation(self.epsg, epsg, traditional=True)
+        coords = np.array(ct.TransformPoints(self.coords.tolist()))[:, :2]
+        return GCPSet(self.pixels, coords, epsg, self.properties)
+
+    def to_gdal_gcps(self):
+        return [
+            gdal.GCP(float(x), float(y), 0, float(px), float(py))
+            for (x, y), (px, py) in zip(self.coords, self.pixels)
+        ]
+
+    def to_points_file(self):
+        content = "mapX,mapY,pixelX,pixelY,enable\n"
+        for (x, y), (px, py) in zip(self.coords, self.pixels):
+            # pixel_y must be inverted b/c qgis puts origin at top left corner
+            content += f"{x},{y},{_format_pixel(px)},-{_format_pixel(py)},1\n"
+        return content
+
+    def to_geojson(self, swap_xy=False):
+        geo_json = {
+          "type": "FeatureCollection",
+          "features": []
+        }
+        for (x, y), (px, py), props in zip(self.coords, self.pixels, self.properties):
+            properties = dict(props)
+            properties["image"] = [_format_pixel(px), _format_pixel(py)]
+            coords = [float(y), float(x)] if swap_xy else [float(x), float(y)]
+            geo_json['features'].append({
+                "type": "Feature",
+                "properties": properties,
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": coords,
+                }
+            })
+        return geo_json
 
 class Georeferencer:
 
@@ -136,6 +316,7 @@ class Georeferencer:
             gcps_geojson=None,
             gcps_points_file=None,
 
+            encoding_profile=None,
             verbose=False,
         ):
 
@@ -143,12 +324,10 @@ class Georeferencer:
         if ":" not in crs:
             raise Exception("Invalid CRS format, must be 'AUTHORITY:CODE', e.g. 'EPSG:3857'")
         self.crs_code = crs
+        self.crs_epsg = int(self.crs_code.split(":")[1])
 
-        self.crs_wkt = retrieve_srs_wkt(self.crs_code.split(":")[1])
-
-        sr = osr.SpatialReference()
-        sr.ImportFromWkt(self.crs_wkt)
-        self.crs_sr = sr
+        self.crs_wkt = retrieve_srs_wkt(self.crs_epsg)
+        self.crs_sr = get_srs(self.crs_epsg)
 
         # handle the input transformation
         self.transformation = TRANSFORMATION_LOOKUP.get(transformation)
@@ -167,6 +346,9 @@ class Georeferencer:
         else:
             raise Exception("no valid gcps_* argument provided")
 
+        # named COG encoding profile, None will use the default from settings
+        self.encoding_profile = encoding_profile
+
         self.workspace = None
 
         # verbose can trigger extra print statements in certain contexts
@@ -203,27 +385,8 @@ class Georeferencer:
 
         # geo_json is assumed to be WGS84, so it must be transformed to the
         # CRS of this Georeferencer instance
-        self.gcps = []
-
-        wgs84 = osr.SpatialReference()
-        wgs84.ImportFromEPSG(4326)
-        ct = osr.CoordinateTransformation(wgs84, self.crs_sr)
-
-        for feature in geo_json['features']:
-
-            lat = feature['geometry']['coordinates'][1]
-            lng = feature['geometry']['coordinates'][0]
-            point = ogr.CreateGeometryFromWkt(f"POINT ({lat} {lng})")
-            point.Transform(ct)
-
-            gcp = gdal.GCP(
-                float(point.GetX()),
-                float(point.GetY()),
-                0,
-                float(feature['properties']['image'][0]),
-                float(feature['properties']['image'][1])
-            )
-            self.gcps.append(gcp)
+        gcp_set = GCPSet.from_geojson(geo_json)
+        self.gcps = gcp_set.transform(self.crs_epsg).to_gdal_gcps()
 
     def set_workspace(self, directory):
 
@@ -231,33 +394,86 @@ class Georeferencer:
             os.mkdir(directory)
         self.workspace = directory
 
-    def warp(self, src_path, output_directory=None, return_vrt=False, preview_id=None):
+    def get_preview_key(self, src_path):
+        """Return a short hash that uniquely identifies the warp of src_path
+        with this CRS, transformation, and set of GCPs. The source file's
+        size and modification time are included so that a replaced file
+        does not reuse an old preview."""
+
+        stat = os.stat(src_path)
+        h = hashlib.sha1()
+        h.update(f"{os.path.basename(src_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+        h.update(f"{self.crs_code}|{self.transformation['id']}".encode())
+        for gcp in self.gcps:
+            h.update(f"{gcp.GCPPixel:.3f},{gcp.GCPLine:.3f},{gcp.GCPX:.6f},{gcp.GCPY:.6f};".encode())
+        return h.hexdigest()[:16]
+
+    def warp_preview(self, src_path):
         """
-        This is (now) the only entry point for creating an output warped file. By default,
-        this will be a Cloud Optimized GeoTIFF (COG), via the COG driver in GDAL.
-
-        Use return_vrt=True to stop short of creating an actual COG and only get a VRT.
-
-        Use preview_id to append an extra string on the end of the output file. This is only
-        needed/used in conjunction with return_vrt, in order to get a brand new VRT to force
-        a new preview layer during georeferencing.
+        Create a lightweight warped VRT for previewing the result of these GCPs
+        during georeferencing. The preview file name is derived from the inputs
+        (see get_preview_key()), so an identical set of GCPs will reuse the
+        existing file and skip GDAL entirely. Because any number of clients
+        may be showing the same file, previews are never deleted per request,
+        only once they are unused for a while (see delete_stale_previews()).
+
+        The intermediate GCP VRT and warp are built in /vsimem/. Because the
+        warped VRT carries its own serialized GCP transformer, its source can
+        then be pointed directly at the original file, leaving only a single
+        small VRT written next to the document (which must be on disk, as the
+        tile server reads it over HTTP).
         """
 
-        gdal.SetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
-
         fname = os.path.basename(src_path)
+        key = self.get_preview_key(src_path)
+        preview_path = get_path_variant(src_path, "VRT").replace(".vrt", f"_preview-{key}.vrt")
+
+        if os.path.isfile(preview_path):
+            try:
+                # previews are removed by age (see delete_stale_previews), so
+                # reset the clock whenever one is handed out again
+                os.utime(preview_path)
+                logger.debug(f"{fname} | using cached preview: {preview_path}")
+                return preview_path
+            except FileNotFoundError:
+                pass
 
-        logger.debug(f"{fname} | start")
         a = time.time()
-
-        if output_directory is None:
-            self.set_workspace(os.path.dirname(src_path))
-        else:
-            self.set_workspace(output_directory)
-
-        vrt_with_gcps_path = get_path_variant(src_path, "gcps", outdir=self.workspace)
-
-        to = gdal.TranslateOptions(
+        mem_gcps_path = f"/vsimem/{key}_gcps.vrt"
+        mem_warp_path = f"/vsimem/{key}_modified.vrt"
+        try:
+            gdal.Translate(mem_gcps_path, src_path, options=self._get_gcps_translate_options())
+            gdal.Warp(mem_warp_path, mem_gcps_path, options=self._get_warp_options())
+
+            f = gdal.VSIFOpenL(mem_warp_path, "rb")
+            gdal.VSIFSeekL(f, 0, 2)
+            size = gdal.VSIFTellL(f)
+            gdal.VSIFSeekL(f, 0, 0)
+            vrt_xml = gdal.VSIFReadL(1, size, f).decode("utf-8")
+            gdal.VSIFCloseL(f)
+        finally:
+            gdal.Unlink(mem_gcps_path)
+            gdal.Unlink(mem_warp_path)
+
+        # point the warp source at the original file, relative to the VRT
+        root = ET.fromstring(vrt_xml)
+        source = root.find("GDALWarpOptions/SourceDataset")
+        source.text = os.path.basename(src_path)
+        source.set("relativeToVRT", "1")
+
+        # write to a temp name and rename, so a concurrent request never
+        # sees a partially written file
+        tmp_path = f"{preview_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as o:
+            o.write(ET.tostring(root, encoding="unicode"))
+        os.replace(tmp_path, preview_path)
+
+        logger.debug(f"{fname} | preview created in {round(time.time() - a, 3)} seconds.")
+        return preview_path
+
+    def _get_gcps_translate_options(self):
+
+        return gdal.TranslateOptions(
             GCPs=self.gcps,
             format="VRT",
             creationOptions=[
@@ -265,16 +481,8 @@ class Georeferencer:
                 "BLOCKYSIZE=512",
             ]
         )
-        try:
-            gdal.Translate(vrt_with_gcps_path, src_path, options=to)
-        except Exception as e:
-            logger.error(f"{fname} | translate error: {str(e)}")
-            raise e
 
-        logger.debug(f"{fname} | running warp...")
-
-        if self.verbose:
-            print(gdal.Info(vrt_with_gcps_path))
+    def _get_warp_options(self):
 
         ## if a jpg is passed in, assume that white (255, 255, 255) should be
         ## interpreted as the no data value
@@ -286,7 +494,7 @@ class Georeferencer:
 
         # gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
 
-        wo = gdal.WarpOptions(
+        return gdal.WarpOptions(
             creationOptions=[
             #     "NUM_THREADS=ALL_CPUS",
             #     ## originally used this set of flags used
@@ -313,43 +521,84 @@ class Georeferencer:
             # srcAlpha=True,
             dstAlpha=True,
             resampleAlg='nearest',
+            # stored in the warped VRT and applied when it is read
+            warpMemoryLimit=settings.GEOREFERENCE_WARP_MEMORY_LIMIT,
+            multithread=True,
+            warpOptions=[f"NUM_THREADS={settings.GEOREFERENCE_NUM_THREADS}"],
         )
 
-        warped_vrt_path = get_path_variant(src_path, "VRT", outdir=output_directory)
-        if preview_id:
-            warped_vrt_path = warped_vrt_path.replace('.vrt', f'_{preview_id}.vrt')
+    def warp(self, src_path, output_directory=None, return_vrt=False, preview_id=None):
+        """
+        This is (now) the only entry point for creating an output warped file. By default,
+        this will be a Cloud Optimized GeoTIFF (COG), via the COG driver in GDAL. The
+        intermediate GCP and warp VRTs are held in /vsimem/ and always removed, so only
+        the COG is written to disk.
 
-        gdal.Warp(warped_vrt_path, vrt_with_gcps_path, options=wo)
+        Use return_vrt=True to stop short of creating an actual COG and only get a VRT
+        (along with its GCP VRT) written to disk.
+
+        Use preview_id to append an extra string on the end of the output file. This is only
+        needed/used in conjunction with return_vrt, in order to get a brand new VRT to force
+        a new preview layer during georeferencing.
+        """
 
-        logger.debug(f"{fname} | warp completed in {round(time.time() - a, 3)} seconds.")
+        fname = os.path.basename(src_path)
+
+        logger.debug(f"{fname} | start")
+        a = time.time()
+
+        if output_directory is None:
+            self.set_workspace(os.path.dirname(src_path))
+        else:
+            self.set_workspace(output_directory)
 
         if return_vrt:
-            logger.debug(f"{fname} | returning VRT: {warped_vrt_path}")
-            return warped_vrt_path
+            vrt_with_gcps_path = get_path_variant(src_path, "gcps", outdir=self.workspace)
+            warped_vrt_path = get_path_variant(src_path, "VRT", outdir=output_directory)
+            if preview_id:
+                warped_vrt_path = warped_vrt_path.replace('.vrt', f'_{preview_id}.vrt')
+        else:
+            mem_id = f"{os.getpid()}-{threading.get_ident()}-{fname}"
+            vrt_with_gcps_path = f"/vsimem/{mem_id}_gcps.vrt"
+            warped_vrt_path = f"/vsimem/{mem_id}_modified.vrt"
 
-        dst_path = get_path_variant(src_path, "GTiff", outdir=output_directory)
+        try:
+            try:
+                gdal.Translate(vrt_with_gcps_path, src_path, options=self._get_gcps_translate_options())
+            except Exception as e:
+                logger.error(f"{fname} | translate error: {str(e)}")
+                raise e
 
-        b = time.time()
-        logger.debug(f"{fname} | translating to COG: {dst_path}")
-        to  = gdal.TranslateOptions(
-            # format="GTiff",
-            format="COG",
-            # maskBand="mask",
-            creationOptions=[
-                # 'COMPRESS=DEFLATE',
-                # 'PREDICTOR=2',
-                'COMPRESS=JPEG',
-                # 'TILED=YES',
-                # 'BLOCKXSIZE=512',
-                # 'BLOCKYSIZE=512',
-                # "PHOTOMETRIC=YCBCR",
-                'TILING_SCHEME=GoogleMapsCompatible',
-            ],
-            resampleAlg="nearest"
-        )
-        gdal.Translate(dst_path, warped_vrt_path, options=to)
+            logger.debug(f"{fname} | running warp...")
+
+            if self.verbose:
+                print(gdal.Info(vrt_with_gcps_path))
+
+            gdal.Warp(warped_vrt_path, vrt_with_gcps_path, options=self._get_warp_options())
+
+            logger.debug(f"{fname} | warp completed in {round(time.time() - a, 3)} seconds.")
+
+            if return_vrt:
+                logger.debug(f"{fname} | returning VRT: {warped_vrt_path}")
+                return warped_vrt_path
+
+            dst_path = get_path_variant(src_path, "GTiff", outdir=output_directory)
+
+            b = time.time()
+            logger.debug(f"{fname} | translating to COG: {dst_path}")
+            to  = gdal.TranslateOptions(
+                format="COG",
+                creationOptions=get_cog_creation_options(self.encoding_profile),
+                resampleAlg="nearest"
+            )
+            gdal.Translate(dst_path, warped_vrt_path, options=to)
+
+            logger.debug(f"{fname} | translate completed in {round(time.time() - b, 3)} seconds.")
 
-        logger.debug(f"{fname} | translate completed in {round(time.time() - b, 3)} seconds.")
+        finally:
+            if not return_vrt:
+                gdal.Unlink(vrt_with_gcps_path)
+                gdal.Unlink(warped_vrt_path)
 
         logger.info(f"{fname} | georeference successful in {round(time.time() - a, 3)} seconds.")
 
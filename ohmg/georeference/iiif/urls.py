@@ -1,6 +1,6 @@
 from django.urls import path
 
-from .views import iiif2_endpoint
+from .views import iiif2_endpoint, iiif2_image
 
 urlpatterns = [
     ## IIIF v2.1 paths
@@ -8,4 +8,5 @@ urlpatterns = [
     path('iiif/2/<str:docid>/canvas', iiif2_endpoint, {"iiif_object_requested": "canvas"}, name="document_canvas"),
     path('iiif/2/<str:docid>/resource', iiif2_endpoint, {"iiif_object_requested": "resource"}, name="document_resource"),
     path('iiif/2/<str:docid>/info.json', iiif2_endpoint, {"iiif_object_requested": "info"}, name="document_info"),
-]
\ No newline at end of file
+    path('iiif/2/<str:docid>/<str:region>/<str:size>/<str:rotation>/<str:quality>.<str:format>', iiif2_image, name="document_image"),
+]
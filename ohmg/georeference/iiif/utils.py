@@ -1,6 +1,9 @@
 import os
 import json
 #import base64
+from io import BytesIO
+
+from osgeo import gdal
 from PIL import Image
 
 from django.conf import settings
@@ -8,10 +11,182 @@ from django.urls import reverse
 
 ## ~~ IIIF support ~~
 
+# tile size advertised in info.json, matches the block size of tiled sources
+IIIF_TILE_SIZE = 512
+IIIF_FORMATS = {"jpg": "JPEG", "png": "PNG"}
+# largest output that a single image request may produce, advertised in
+# info.json. anything larger is rejected before any pixels are read.
+IIIF_MAX_WIDTH = 4096
+IIIF_MAX_HEIGHT = 4096
+IIIF_MAX_AREA = IIIF_MAX_WIDTH * IIIF_MAX_HEIGHT
+
+class IIIFRequestError(Exception):
+    """Raised for an image request that can't be parsed or fulfilled."""
+    pass
+
+def document_is_tiled(document):
+    """True if the document's file is a tiled, overviewed TIFF (see the
+    "cog" DOCUMENT_SOURCE_FORMAT) that tiles can be read from directly.
+    This only checks the stored file_format (see get_file_metadata), so
+    the file is never opened."""
+
+    return getattr(document, "file_format", None) == "COG"
+
+def get_iiif_image_base(document):
+    this_url = reverse('document_info', args=(document.id,))
+    return settings.SITEURL.rstrip("/") + this_url.replace("/info.json", "")
+
+def get_scale_factors(width, height):
+    """Powers of two down to the level where the whole image fits in a tile,
+    which is how the COG overviews are laid out."""
+    factors = [1]
+    while max(width, height) / factors[-1] > IIIF_TILE_SIZE:
+        factors.append(factors[-1] * 2)
+    return factors
+
+def document_as_iiif_info(document):
+    """Level 1 info.json for a document served by iiif2_image()."""
+
+    width, height = document.image_size
+    return {
+        "@context": "http://iiif.io/api/image/2/context.json",
+        "@id": get_iiif_image_base(document),
+        "protocol": "http://iiif.io/api/image",
+        "width": width,
+        "height": height,
+        "tiles": [{
+            "width": IIIF_TILE_SIZE,
+            "scaleFactors": get_scale_factors(width, height),
+        }],
+        "profile": [
+            "http://iiif.io/api/image/2/level1.json",
+            {
+                "formats": list(IIIF_FORMATS.keys()),
+                "qualities": ["default", "color"],
+                "maxWidth": IIIF_MAX_WIDTH,
+                "maxHeight": IIIF_MAX_HEIGHT,
+                "maxArea": IIIF_MAX_AREA,
+            },
+        ],
+    }
+
+def parse_iiif_region(region, width, height):
+    """Return (x, y, w, h) in full resolution pixels."""
+
+    if region == "full":
+        return 0, 0, width, height
+    try:
+        if region.startswith("pct:"):
+            px, py, pw, ph = [float(i) for i in region[4:].split(",")]
+            x, y = round(px * width / 100), round(py * height / 100)
+            w, h = round(pw * width / 100), round(ph * height / 100)
+        else:
+            x, y, w, h = [int(i) for i in region.split(",")]
+    except ValueError:
+        raise IIIFRequestError(f"invalid region: {region}")
+    # clip to the image, as the spec requires
+    w, h = min(w, width - x), min(h, height - y)
+    if x < 0 or y < 0 or w <= 0 or h <= 0:
+        raise IIIFRequestError(f"region out of bounds: {region}")
+    return x, y, w, h
+
+def fit_iiif_max(w, h):
+    """Scale w x h down (keeping the aspect ratio) to fit the size limits."""
+    scale = min(1, IIIF_MAX_WIDTH / w, IIIF_MAX_HEIGHT / h, (IIIF_MAX_AREA / (w * h)) ** 0.5)
+    return max(int(w * scale), 1), max(int(h * scale), 1)
+
+def check_iiif_size(w, h):
+    if w <= 0 or h <= 0:
+        raise IIIFRequestError(f"invalid size: {w},{h}")
+    if w > IIIF_MAX_WIDTH or h > IIIF_MAX_HEIGHT or w * h > IIIF_MAX_AREA:
+        raise IIIFRequestError(
+            f"requested size {w},{h} is larger than the maximum "\
+            f"({IIIF_MAX_WIDTH},{IIIF_MAX_HEIGHT}, area {IIIF_MAX_AREA})"
+        )
+    return w, h
+
+def parse_iiif_size(size, w, h):
+    """Return the (width, height) of the output for a region of w x h. "max"
+    is the largest size within the limits in info.json, and any other size
+    beyond those limits raises an IIIFRequestError."""
+
+    if size == "max":
+        return fit_iiif_max(w, h)
+    if size == "full":
+        return check_iiif_size(w, h)
+    return check_iiif_size(*_parse_iiif_size(size, w, h))
+
+def _parse_iiif_size(size, w, h):
+
+    try:
+        if size.startswith("pct:"):
+            pct = float(size[4:])
+            return max(round(w * pct / 100), 1), max(round(h * pct / 100), 1)
+        best_fit = size.startswith("!")
+        sw, sh = size.lstrip("!").split(",")
+        sw, sh = int(sw) if sw else None, int(sh) if sh else None
+    except ValueError:
+        raise IIIFRequestError(f"invalid size: {size}")
+    if sw is None and sh is None:
+        raise IIIFRequestError(f"invalid size: {size}")
+    # best fit ("!w,h") needs both dimensions to fit within
+    if best_fit and (sw is None or sh is None):
+        raise IIIFRequestError(f"invalid size: {size}")
+    if best_fit:
+        scale = min(sw / w, sh / h)
+        return max(round(w * scale), 1), max(round(h * scale), 1)
+    if sw is None:
+        return max(round(w * sh / h), 1), sh
+    if sh is None:
+        return sw, max(round(h * sw / w), 1)
+    return sw, sh
+
+def read_iiif_image(path, region="full", size="max", out_format="jpg"):
+    """Read a region of a raster at the requested size and return it encoded
+    as bytes. Because the output buffer is (usually) smaller than the region,
+    GDAL reads from the closest overview and only the tiles that intersect
+    the region are decoded."""
+
+    if out_format not in IIIF_FORMATS:
+        raise IIIFRequestError(f"unsupported format: {out_format}")
+
+    ds = gdal.Open(path)
+    if ds is None:
+        raise IIIFRequestError(f"unable to open {os.path.basename(path)}")
+
+    x, y, w, h = parse_iiif_region(region, ds.RasterXSize, ds.RasterYSize)
+    out_w, out_h = parse_iiif_size(size, w, h)
+
+    band_list = [1, 2, 3] if ds.RasterCount >= 3 else [1, 1, 1]
+    # read straight into pixel-interleaved RGB for PIL
+    data = ds.ReadRaster(
+        x, y, w, h,
+        buf_xsize=out_w,
+        buf_ysize=out_h,
+        band_list=band_list,
+        buf_pixel_space=3,
+        buf_line_space=3 * out_w,
+        buf_band_space=1,
+        resample_alg=gdal.GRIORA_Average,
+    )
+    ds = None
+
+    img = Image.frombytes("RGB", (out_w, out_h), data)
+    output = BytesIO()
+    img.save(output, format=IIIF_FORMATS[out_format])
+    content = output.getvalue()
+    output.close()
+
+    return content
+
 def document_as_iiif_resource(document, iiif_server=False):
 
-    img = Image.open(document.doc_file)
-    width, height = img.size
+    # use the stored dimensions if this document has them
+    width = getattr(document, "image_width", None)
+    height = getattr(document, "image_height", None)
+    if width is None or height is None:
+        with Image.open(document.file) as img:
+            width, height = img.size
 
     resource = {
       "@type": "dctypes:Image",
@@ -21,16 +196,25 @@ def document_as_iiif_resource(document, iiif_server=False):
 
     if iiif_server is True:
         iiif2_base = f"{settings.IIIF_SERVER_LOCATION}/iiif/2"
-        fname = os.path.basename(document.doc_file.name)
-        resource["@id"] = f"{iiif2_base}/{fname}/full/max/0/default.jpg",
+        fname = os.path.basename(document.file.name)
+        resource["@id"] = f"{iiif2_base}/{fname}/full/max/0/default.jpg"
         resource["service"] = {
             "@context": "http://iiif.io/api/image/2/context.json",
             "@id": f"{iiif2_base}/{fname}",
             "profile": "http://iiif.io/api/image/2/level2.json",
             "protocol": "http://iiif.io/api/image"
         }
+    elif document_is_tiled(document):
+        iiif2_base = get_iiif_image_base(document)
+        resource["@id"] = f"{iiif2_base}/full/max/0/default.jpg"
+        resource["service"] = {
+            "@context": "http://iiif.io/api/image/2/context.json",
+            "@id": iiif2_base,
+            "profile": "http://iiif.io/api/image/2/level1.json",
+            "protocol": "http://iiif.io/api/image"
+        }
     else:
-        img_url = settings.SITEURL.rstrip("/") + document.doc_file.url
+        img_url = settings.SITEURL.rstrip("/") + document.file.url
         resource["@id"] = img_url
 
     return resource
@@ -83,7 +267,7 @@ def document_as_iiif_manifest(document, canvas=None, iiif_server=False):
       "label": document.title,
       "description": "Description.",
       "attribution": "Attribution",
-      "thumbnail": document.thumbnail_url,
+      "thumbnail": document.thumbnail.url if document.thumbnail else "",
       "sequences": [
         {
           "@type": "sc:Sequence",
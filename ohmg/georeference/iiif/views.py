@@ -1,29 +1,31 @@
 import os
 from django.conf import settings
 from django.template import loader
-from django.shortcuts import redirect
-from django.http import HttpResponse, JsonResponse
-from geonode.documents.models import Document
-from geonode.documents.views import _resolve_document
+from django.shortcuts import redirect, get_object_or_404
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.views.decorators.cache import cache_control
+
+from ohmg.georeference.models import Document
 from .utils import (
+    IIIFRequestError,
+    IIIF_FORMATS,
+    document_as_iiif_info,
     document_as_iiif_resource,
     document_as_iiif_canvas,
     document_as_iiif_manifest,
+    document_is_tiled,
+    read_iiif_image,
 )
 
-# Create your views here.
-## DEPRECATED - IIIF is not currently implemented, retain for future reference.
 def iiif2_endpoint(request, docid, iiif_object_requested):
     """ create a iiif v2 manifest, canvas, resource, or info.json object for a
-    document image. info.json is not possible if an IIIF server is not enabled.
+    document image. info.json is only available if an IIIF server is enabled,
+    or if the document is stored in a tiled format (see iiif2_image).
     """
-    
 
     IIIF_SERVER_ENABLED = getattr(settings, "IIIF_SERVER_ENABLED", False)
 
-    document = _resolve_document(request, docid)
-    if not isinstance(document, Document):
-        return document
+    document = get_object_or_404(Document, pk=docid)
 
     if iiif_object_requested == "manifest":
         return JsonResponse(document_as_iiif_manifest(
@@ -47,11 +49,15 @@ def iiif2_endpoint(request, docid, iiif_object_requested):
         # if there is a iiif server set up, then this will redirect to that url
         # to supply the info.json generated there.
         if IIIF_SERVER_ENABLED is True:
-            fname = os.path.basename(document.doc_file.name)
+            fname = os.path.basename(document.file.name)
             info_url = f"{settings.IIIF_SERVER_LOCATION}/iiif/2/{fname}/info.json"
             return redirect(info_url)
 
-        # if there is no iiif server, info.json is not supported.
+        # tiled documents are served directly from their file
+        elif document_is_tiled(document):
+            return JsonResponse(document_as_iiif_info(document))
+
+        # otherwise, info.json is not supported.
         # see: https://github.com/IIIF/api/issues/1983
         else:
             return JsonResponse({
@@ -63,4 +69,24 @@ def iiif2_endpoint(request, docid, iiif_object_requested):
         return HttpResponse(
             loader.render_to_string(
                 "404.html", context={
-                }, request=request), status=404)
\ No newline at end of file
+                }, request=request), status=404)
+
+@cache_control(max_age=86400)
+def iiif2_image(request, docid, region, size, rotation, quality, format):
+    """ IIIF v2 image requests (level 1, no rotation) for documents that are
+    stored as tiled TIFFs. Each request only decodes the source tiles that
+    intersect the region, read from the overview closest to the output size.
+    """
+
+    document = get_object_or_404(Document, pk=docid)
+    if not document_is_tiled(document):
+        return HttpResponseBadRequest("image requests are only supported for tiled documents")
+    if rotation != "0" or quality not in ("default", "color"):
+        return HttpResponseBadRequest("only rotation 0 and default/color quality are supported")
+
+    try:
+        content = read_iiif_image(document.file.path, region=region, size=size, out_format=format)
+    except IIIFRequestError as e:
+        return HttpResponseBadRequest(str(e))
+
+    return HttpResponse(content, content_type=f"image/{IIIF_FORMATS[format].lower()}")
@@ -0,0 +1,162 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+def _get_state():
+    if not hasattr(_state, "depth"):
+        _state.items = set()
+        _state.volume_ids = set()
+        _state.depth = 0
+    return _state
+
+
+class LookupBatch:
+    """The Documents and Layers (and whole volumes) whose lookups need to be
+    refreshed when a transaction commits. A batch only exists as an
+    on_commit callback, so if the transaction (or the savepoint it was
+    registered in) is rolled back, its contents are discarded with it."""
+
+    def __init__(self):
+        self.items = set()
+        self.volume_ids = set()
+
+    def __call__(self):
+        flush_dirty_lookups(self.items, self.volume_ids)
+
+def _queue_refresh(items, volume_ids):
+    """Add to the LookupBatch registered at the current savepoint level,
+    registering a new one if there isn't one yet. Batches aren't shared
+    across savepoints, so rolling one back only discards what was marked
+    within it. In autocommit mode the new batch runs immediately."""
+
+    connection = transaction.get_connection()
+    sids = set(connection.savepoint_ids)
+    batch = next((
+        i[1] for i in connection.run_on_commit
+        if isinstance(i[1], LookupBatch) and i[0] == sids
+    ), None)
+    if batch is not None:
+        batch.items.update(items)
+        batch.volume_ids.update(volume_ids)
+        return
+    batch = LookupBatch()
+    batch.items.update(items)
+    batch.volume_ids.update(volume_ids)
+    transaction.on_commit(batch)
+
+def mark_lookup_dirty(item_type, pk=None, volume_id=None):
+    """Record that a Document or Layer has changed and its volume's lookups
+    need to be refreshed. Pass volume_id (with no pk) to request a full
+    refresh of a volume, e.g. after a delete. Refreshes are coalesced and
+    run once per volume when the current transaction commits, or, within a
+    defer_lookup_refresh() block, when the outermost block exits."""
+
+    items = {(item_type, pk)} if volume_id is None and pk is not None else set()
+    volume_ids = {volume_id} if volume_id is not None else set()
+
+    state = _get_state()
+    if state.depth > 0:
+        state.items.update(items)
+        state.volume_ids.update(volume_ids)
+    else:
+        _queue_refresh(items, volume_ids)
+
+@contextmanager
+def defer_lookup_refresh():
+    """Hold all lookup refreshes triggered within this block (which may span
+    many individual saves and commits) and run them once on exit. They are
+    handed to the transaction that is open at that point (if any), so an
+    exception that rolls it back discards them. Can also be used as a
+    decorator."""
+
+    state = _get_state()
+    state.depth += 1
+    try:
+        yield
+    finally:
+        state.depth -= 1
+        if state.depth == 0:
+            items, volume_ids = state.items, state.volume_ids
+            state.items, state.volume_ids = set(), set()
+            if items or volume_ids:
+                _queue_refresh(items, volume_ids)
+
+def get_item_volume_ids(items):
+    """Return the volume pk for each (item_type, pk) in items that has one,
+    following the same path as find_volume() (layer -> document -> parent
+    document -> sheet), but in a fixed number of queries."""
+
+    from ohmg.georeference.models import DocumentLink
+    from ohmg.loc_insurancemaps.models import Sheet
+
+    layer_ids = {pk for item_type, pk in items if item_type == "layer"}
+    layer_docs = dict(DocumentLink.objects.filter(
+        link_type="georeference", target_id__in=layer_ids,
+    ).values_list("target_id", "source_id"))
+
+    doc_ids = {pk for item_type, pk in items if item_type == "document"}
+    doc_ids.update(layer_docs.values())
+    parents = dict(DocumentLink.objects.filter(
+        link_type="split", target_id__in=doc_ids,
+    ).values_list("target_id", "source_id"))
+
+    roots = {pk: parents.get(pk, pk) for pk in doc_ids}
+    sheets = dict(Sheet.objects.filter(
+        doc_id__in=set(roots.values()),
+    ).values_list("doc_id", "volume_id"))
+
+    volume_ids = {}
+    for item_type, pk in items:
+        doc_id = layer_docs.get(pk) if item_type == "layer" else pk
+        volume_id = sheets.get(roots.get(doc_id))
+        if volume_id is not None:
+            volume_ids[(item_type, pk)] = volume_id
+    return volume_ids
+
+def flush_dirty_lookups(items, volume_ids):
+    """Refresh the lookups of every volume touched by items, and fully
+    refresh the volumes in volume_ids, writing each volume only once."""
+
+    from ohmg.georeference.models import Document, Layer
+    from ohmg.loc_insurancemaps.models import Volume
+
+    if not items and not volume_ids:
+        return
+
+    item_volumes = {k: v for k, v in get_item_volume_ids(items).items() if v not in volume_ids}
+    docs = Document.objects.in_bulk([pk for t, pk in item_volumes if t == "document"])
+    layers = Layer.objects.in_bulk([pk for t, pk in item_volumes if t == "layer"])
+    volumes = Volume.objects.in_bulk(set(item_volumes.values()) | set(volume_ids))
+
+    for volume_id in volume_ids:
+        if volume_id in volumes:
+            logger.debug(f"{volumes[volume_id]} | full lookup refresh")
+            volumes[volume_id].refresh_lookups()
+
+    updates = {}
+    for (item_type, pk), volume_id in item_volumes.items():
+        item = docs.get(pk) if item_type == "document" else layers.get(pk)
+        if item is None or volume_id not in volumes:
+            continue
+        volume_docs, volume_layers = updates.setdefault(volume_id, ([], []))
+        if item_type == "document":
+            volume_docs.append(item)
+        else:
+            volume_layers.append(item)
+
+    for volume_id, (volume_docs, volume_layers) in updates.items():
+        volume = volumes[volume_id]
+        logger.debug(f"{volume} | refreshing {len(volume_docs)} documents and {len(volume_layers)} layers in lookups")
+        for doc in volume_docs:
+            volume.update_doc_lookup(doc, save=False)
+        for layer in volume_layers:
+            volume.update_lyr_lookup(layer, save=False)
+        volume.set_extent(save=False)
+        volume.save(update_fields=["document_lookup", "layer_lookup", "extent"])
+        volume.update_progress()
@@ -1,6 +1,7 @@
 from argparse import Namespace
 from django.core.management.base import BaseCommand
 from ohmg.georeference.models import AnnotationSet
+from ohmg.georeference.tasks import generate_mosaic_cog_task, generate_mosaic_json_task
 
 class Command(BaseCommand):
     help = 'command to search the Library of Congress API.'
@@ -31,7 +32,19 @@ class Command(BaseCommand):
         parser.add_argument(
             "--background",
             action="store_true",
-            help="a pk can also be used to identify the layerset",
+            help="run the operation in the background with celery",
+        )
+        parser.add_argument(
+            "--trim-all",
+            action="store_true",
+            default=False,
+            help="re-trim all layers, instead of reusing those that haven't changed",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="number of processes to trim layers with (and threads to read mosaic windows with), defaults to all cpus",
         )
 
     def handle(self, *args, **options):
@@ -46,16 +59,32 @@ class Command(BaseCommand):
         if options.operation == "inspect":
             print(ls.multimask_extent)
 
+        def progress(n, total, job, error):
+            status = f"failed: {error}" if error else "done"
+            print(f"{n}/{total} {job['layer']} {status}")
+
+        def report_failed(failed):
+            if failed:
+                print(f"{len(failed)} layers failed and were omitted, re-run to retry them:")
+                for job in failed:
+                    print(f"  {job['layer']}: {job['error']}")
+
         if options.operation == "generate-mosaic-cog":
             if options.background:
-                raise NotImplementedError
-                # generate_mosaic_cog_task.delay(ls.pk)
+                generate_mosaic_cog_task.delay(ls.pk, trim_all=options.trim_all)
             else:
-                ls.generate_mosaic_cog()
+                report_failed(ls.generate_mosaic_cog(
+                    trim_all=options.trim_all,
+                    workers=options.workers,
+                    progress=progress,
+                ))
 
         if options.operation == "generate-mosaic-json":
             if options.background:
-                raise NotImplementedError
-                # generate_mosaic_json_task.delay(ls.pk, trim_all=options.trim_all)
+                generate_mosaic_json_task.delay(ls.pk, trim_all=options.trim_all)
             else:
-                ls.generate_mosaic_json(trim_all=options.trim_all)
+                report_failed(ls.generate_mosaic_json(
+                    trim_all=options.trim_all,
+                    workers=options.workers,
+                    progress=progress,
+                ))
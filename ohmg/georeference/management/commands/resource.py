@@ -1,14 +1,27 @@
+import os
+import time
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from osgeo import gdal
+
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError # noqa: F401
+from django.db import connections
+from django.db.models import Q
 
-from ohmg.georeference.models import Document, Layer
+from ohmg.georeference.models import Document, Layer, ItemBase
+from ohmg.georeference.georeferencer import Georeferencer, COG_ENCODING_PROFILES
 from ohmg.core.renderers import generate_layer_thumbnail_content
+from ohmg.core.utils import get_file_metadata
 
 class Command(BaseCommand):
     help = 'Command line access point for the internal georeferencing utilities.'
     def add_arguments(self, parser):
         parser.add_argument(
             "operation",
-            choices=['georeference', 'thumbnail', 'set-extent'],
+            choices=['georeference', 'thumbnail', 'set-extent', 'benchmark-encoding', 'backfill-file-metadata'],
             help="operation to perform",
         )
         parser.add_argument(
@@ -53,6 +66,35 @@ class Command(BaseCommand):
             default=False,
             help="Uses a VRT during the georeferencing process."
         )
+        parser.add_argument(
+            "--profiles",
+            nargs="*",
+            help="encoding profiles to benchmark, defaults to all profiles.",
+        )
+        parser.add_argument(
+            "--sample",
+            type=int,
+            default=5,
+            help="number of recent layers to benchmark if no --docid/--lyrid is given.",
+        )
+        parser.add_argument(
+            "--tile-reads",
+            type=int,
+            default=50,
+            help="number of random tile reads per output file when benchmarking.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of processes to use when reading file metadata.",
+        )
+        parser.add_argument(
+            "--overwrite",
+            action="store_true",
+            default=False,
+            help="re-read file metadata for items that already have it.",
+        )
 
     def handle(self, *args, **options):
 
@@ -87,3 +129,131 @@ class Command(BaseCommand):
                 content = generate_layer_thumbnail_content(options['file'])
                 with open('thumb_output.jpg', 'wb') as out:
                     out.write(content)
+
+        elif op == "benchmark-encoding":
+            profiles = options['profiles'] if options['profiles'] else list(COG_ENCODING_PROFILES.keys())
+            for p in profiles:
+                if p not in COG_ENCODING_PROFILES:
+                    raise CommandError(f"invalid profile: {p}")
+
+            if options['docid']:
+                documents = [Document.objects.get(pk=options['docid'])]
+            elif options['lyrid']:
+                documents = [Layer.objects.get(pk=options['lyrid']).get_document()]
+            else:
+                layers = Layer.objects.exclude(file="").order_by("-pk")[:options['sample']]
+                documents = [i.get_document() for i in layers]
+
+            out_dir = os.path.join(settings.TEMP_DIR, "benchmark-encoding")
+            os.makedirs(out_dir, exist_ok=True)
+
+            results = {p: {"encode": [], "size": [], "read": []} for p in profiles}
+            try:
+                for doc in documents:
+                    sessions = list(doc.georeference_sessions)
+                    if not sessions:
+                        print(f"{doc} | no georeference session, skipping")
+                        continue
+                    data = sessions[-1].data
+                    for profile in profiles:
+                        g = Georeferencer(
+                            crs=f"EPSG:{data['epsg']}",
+                            transformation=data['transformation'],
+                            gcps_geojson=data['gcps'],
+                            encoding_profile=profile,
+                        )
+                        a = time.time()
+                        out_path = g.warp(doc.file.path, output_directory=out_dir)
+                        encode_time = time.time() - a
+                        size = os.path.getsize(out_path)
+                        read_time = benchmark_tile_reads(out_path, options['tile_reads'])
+                        os.remove(out_path)
+
+                        results[profile]["encode"].append(encode_time)
+                        results[profile]["size"].append(size)
+                        results[profile]["read"].append(read_time)
+                        print(f"{doc} | {profile}: encode {round(encode_time, 2)}s, "\
+                            f"size {round(size / 1048576, 2)}MB, tile read {round(read_time * 1000, 2)}ms")
+            finally:
+                shutil.rmtree(out_dir, ignore_errors=True)
+
+            print("\nprofile, files, mean encode (s), total size (MB), mean tile read (ms)")
+            for profile, r in results.items():
+                ct = len(r["encode"])
+                if ct == 0:
+                    continue
+                print(", ".join([
+                    profile,
+                    str(ct),
+                    str(round(sum(r["encode"]) / ct, 3)),
+                    str(round(sum(r["size"]) / 1048576, 2)),
+                    str(round(sum(r["read"]) / ct * 1000, 2)),
+                ]))
+
+        elif op == "backfill-file-metadata":
+            items = ItemBase.objects.exclude(file="").exclude(file__isnull=True)
+            if options['docid']:
+                items = items.filter(pk=options['docid'])
+            elif options['lyrid']:
+                items = items.filter(pk=options['lyrid'])
+            elif not options['overwrite']:
+                items = items.filter(Q(file_size__isnull=True) | Q(file_checksum__isnull=True))
+            items = list(items.only("pk", "file"))
+            print(f"reading file metadata for {len(items)} items, {options['workers']} workers")
+
+            # db connections must not be shared with forked workers
+            connections.close_all()
+
+            start = time.time()
+            lookup = {i.pk: i for i in items}
+            updated, failed = [], []
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                futures = [executor.submit(_read_file_metadata, i.pk, i.file.path) for i in items]
+                for n, future in enumerate(as_completed(futures), start=1):
+                    pk, metadata, error = future.result()
+                    if error:
+                        print(f"{pk} | error: {error}")
+                        failed.append(pk)
+                    else:
+                        lookup[pk].set_file_metadata(metadata)
+                        updated.append(lookup[pk])
+                    if n % 100 == 0:
+                        print(f"{n}/{len(items)}")
+
+            ItemBase.objects.bulk_update(updated, ItemBase.FILE_METADATA_FIELDS, batch_size=500)
+            print(f"updated {len(updated)} items, {len(failed)} failed, {round(time.time() - start, 2)} seconds")
+
+def _read_file_metadata(pk, path):
+    """Kept at module level so it can be run in a process pool."""
+    try:
+        return pk, get_file_metadata(path), None
+    except Exception as e:
+        return pk, None, str(e)
+
+def benchmark_tile_reads(path, count, tile_size=256):
+    """Return the mean time in seconds to read one random tile-sized window from
+    a raster, with each read going to a random overview level (or full
+    resolution). The dataset is reopened for every read so that GDAL's block
+    cache doesn't hide decode time, as is the case for a tile server."""
+
+    ds = gdal.Open(path)
+    level_ct = ds.GetRasterBand(1).GetOverviewCount()
+    ds = None
+
+    elapsed = 0
+    for i in range(count):
+        level = random.randint(-1, level_ct - 1)
+        a = time.time()
+        ds = gdal.Open(path)
+        bands = [ds.GetRasterBand(b) for b in range(1, ds.RasterCount + 1)]
+        if level >= 0:
+            bands = [b.GetOverview(level) for b in bands]
+        x_size, y_size = bands[0].XSize, bands[0].YSize
+        w, h = min(tile_size, x_size), min(tile_size, y_size)
+        x, y = random.randint(0, x_size - w), random.randint(0, y_size - h)
+        for band in bands:
+            band.ReadRaster(x, y, w, h)
+        ds = None
+        elapsed += time.time() - a
+
+    return elapsed / count if count else 0
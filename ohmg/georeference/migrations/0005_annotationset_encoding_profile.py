@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('georeference', '0004_alter_setcategory_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotationset',
+            name='encoding_profile',
+            field=models.CharField(blank=True, choices=[('jpeg', 'JPEG'), ('jpeg-ycbcr-q75', 'JPEG (YCbCr, quality 75)'), ('webp', 'WEBP (quality 75)'), ('deflate-pred2', 'DEFLATE (horizontal predictor)')], help_text='COG encoding for layers and mosaics in this set, leave blank to use the site default.', max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-18 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('georeference', '0005_annotationset_encoding_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotationset',
+            name='trim_manifest',
+            field=models.JSONField(blank=True, help_text='Trimmed layer files used in mosaics, keyed by layer slug.', null=True),
+        ),
+    ]
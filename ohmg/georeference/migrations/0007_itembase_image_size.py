@@ -0,0 +1,23 @@
+# Generated by Django 3.2.18 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('georeference', '0006_annotationset_trim_manifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itembase',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, help_text="Height in pixels of the file, stored so it doesn't need to be opened.", null=True),
+        ),
+        migrations.AddField(
+            model_name='itembase',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, help_text="Width in pixels of the file, stored so it doesn't need to be opened.", null=True),
+        ),
+    ]
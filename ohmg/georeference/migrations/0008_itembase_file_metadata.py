@@ -0,0 +1,28 @@
+# Generated by Django 3.2.18 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('georeference', '0007_itembase_image_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itembase',
+            name='file_checksum',
+            field=models.CharField(blank=True, help_text='sha256 checksum of the file.', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='itembase',
+            name='file_format',
+            field=models.CharField(blank=True, help_text='Image format of the file, e.g. JPEG or TIFF.', max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='itembase',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, help_text='Size in bytes of the file.', null=True),
+        ),
+    ]
@@ -5,6 +5,8 @@ from .resources import Layer
 from .resources import GCP
 from .resources import GCPGroup
 from .resources import DocumentLink
+from .resources import prime_items
+from .resources import prime_documents
 from .resources import AnnotationSet
 from .resources import SetCategory
 
@@ -1,11 +1,9 @@
 import os
-import glob
 import uuid
 import json
 import logging
 from datetime import timedelta, datetime
-from osgeo import gdal, osr
-from PIL import Image
+from osgeo import gdal
 from itertools import chain
 
 from django.conf import settings
@@ -25,10 +23,23 @@ from cogeo_mosaic.backends import MosaicBackend
 
 from ohmg.core.utils import (
     full_reverse,
+    full_reverse_pk,
+    get_file_metadata,
     slugify,
     random_alnum,
 )
-from ohmg.core.renderers import generate_document_thumbnail_content, generate_layer_thumbnail_content
+from ohmg.core.renderers import generate_thumbnail_content
+from ohmg.georeference.georeferencer import (
+    COG_ENCODING_PROFILES,
+    GCPSet,
+    get_transformation,
+)
+from ohmg.georeference.mosaic import (
+    get_trim_key,
+    get_trim_path,
+    trim_layers,
+    write_mosaic_geotiff,
+)
 from ohmg.georeference.storage import OverwriteStorage
 
 logger = logging.getLogger(__name__)
@@ -109,55 +120,37 @@ class GCPGroup(models.Model):
     def gcps(self):
         return GCP.objects.filter(gcp_group=self)
 
+    def get_gcp_set(self):
+        """Load all GCPs into a GCPSet. The stored points are (lat, lng),
+        and are kept in that x/y order here so that transformations match
+        Django's GEOSGeometry.transform()."""
+
+        gcps = self.__dict__.get("prefetched_gcps")
+        if gcps is None:
+            gcps = list(self.gcps.select_related("last_modified_by"))
+        return GCPSet(
+            [(gcp.pixel_x, gcp.pixel_y) for gcp in gcps],
+            [(gcp.geom.x, gcp.geom.y) for gcp in gcps],
+            epsg=4326,
+            properties=[{
+                "id": str(gcp.pk),
+                "username": gcp.last_modified_by.username,
+                "note": gcp.note,
+            } for gcp in gcps],
+        )
+
     @property
     def gdal_gcps(self):
-        gcp_list = []
-        for gcp in self.gcps:
-            geom = gcp.geom.clone()
-            geom.transform(self.crs_epsg)
-            p = gdal.GCP(geom.x, geom.y, 0, gcp.pixel_x, gcp.pixel_y)
-            gcp_list.append(p)
-        return gcp_list
+        return self.get_gcp_set().transform(self.crs_epsg).to_gdal_gcps()
 
     @property
     def as_geojson(self):
-
-        geo_json = {
-          "type": "FeatureCollection",
-          "features": []
-        }
-
-        for gcp in self.gcps:
-            coords = json.loads(gcp.geom.geojson)["coordinates"]
-            newcoords = [coords[1], coords[0]]
-            # see note on this variable in settings.py
-            if settings.SWAP_COORDINATE_ORDER is True:
-                newcoords = coords
-            geo_json['features'].append({
-                "type": "Feature",
-                "properties": {
-                  "id": str(gcp.pk),
-                  "image": [gcp.pixel_x, gcp.pixel_y],
-                  "username": gcp.last_modified_by.username,
-                  "note": gcp.note,
-                },
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": newcoords,
-                }
-            })
-        return geo_json
+        # see note on this variable in settings.py
+        swap_xy = settings.SWAP_COORDINATE_ORDER is not True
+        return self.get_gcp_set().to_geojson(swap_xy=swap_xy)
 
     def as_points_file(self):
-
-        content = "mapX,mapY,pixelX,pixelY,enable\n"
-        for gcp in self.gcps:
-            geom = gcp.geom.clone()
-            geom.transform(self.crs_epsg)
-            # pixel_y must be inverted b/c qgis puts origin at top left corner
-            content += f"{geom.x},{geom.y},{gcp.pixel_x},-{gcp.pixel_y},1\n"
-
-        return content
+        return self.get_gcp_set().transform(self.crs_epsg).to_points_file()
 
     def save_from_geojson(self, geojson, document, transformation=None):
 
@@ -339,6 +332,33 @@ class ItemBase(models.Model):
         max_length=255,
         storage=OverwriteStorage(),
     )
+    image_width = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Width in pixels of the file, stored so it doesn't need to be opened.",
+    )
+    image_height = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Height in pixels of the file, stored so it doesn't need to be opened.",
+    )
+    file_size = models.BigIntegerField(
+        null=True,
+        blank=True,
+        help_text="Size in bytes of the file.",
+    )
+    file_checksum = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        help_text="sha256 checksum of the file.",
+    )
+    file_format = models.CharField(
+        max_length=20,
+        null=True,
+        blank=True,
+        help_text="Image format of the file, e.g. JPEG or TIFF.",
+    )
     thumbnail = models.FileField(
         upload_to='thumbnails',
         null=True,
@@ -363,6 +383,12 @@ class ItemBase(models.Model):
     def __str__(self):
         return str(self.title)
 
+    @property
+    def prefetched(self):
+        """Related objects that have been loaded in bulk for this instance,
+        see prime_documents(). Any key that is missing is queried as usual."""
+        return self.__dict__.setdefault("_prefetched", {})
+
     @property
     def _base_urls(self):
         return {
@@ -421,21 +447,49 @@ class ItemBase(models.Model):
         else:
             logger.warn(f"{self.type} resource ({self.pk}): no existing lock to extend.")
 
-    def set_thumbnail(self):
+    def set_thumbnail(self, content=None, save=True):
+        """Generate and save a new thumbnail from this item's file. Pass
+        pre-rendered content to skip rendering (used for batch regeneration),
+        and save=False to defer the database write to the caller."""
         if self.file is not None:
+            if self.type not in ("document", "layer"):
+                return None
             if self.thumbnail:
-                self.thumbnail.delete()
+                self.thumbnail.delete(save=False)
             path = self.file.path
             name = os.path.splitext(os.path.basename(path))[0]
-            if self.type == "document":
-                content = generate_document_thumbnail_content(path)
-                tname = f"{name}-doc-thumb.jpg"
-            elif self.type == "layer":
-                content = generate_layer_thumbnail_content(path)
-                tname = f"{name}-lyr-thumb.jpg"
-            else:
-                return None
-            self.thumbnail.save(tname, ContentFile(content))
+            if content is None:
+                content = generate_thumbnail_content(self.type, path)
+            suffix = "doc" if self.type == "document" else "lyr"
+            tname = f"{name}-{suffix}-thumb.jpg"
+            self.thumbnail.save(tname, ContentFile(content), save=save)
+
+    FILE_METADATA_FIELDS = [
+        "image_width",
+        "image_height",
+        "file_size",
+        "file_checksum",
+        "file_format",
+    ]
+
+    def set_file_metadata(self, metadata=None, checksum=True):
+        """Read the dimensions, format, size, and checksum of this item's file
+        and store them on the instance (the caller is responsible for saving).
+        Pass pre-computed metadata (see get_file_metadata) to skip reading the
+        file, which is how the backfill command works. With checksum=False the
+        file isn't hashed, and any existing checksum is left as it is."""
+        if not self.file:
+            return
+        if metadata is None:
+            try:
+                metadata = get_file_metadata(self.file.path, checksum=checksum)
+            except Exception as e:
+                logger.warn(f"error reading file {self.file}: {e}")
+                return
+        for field in self.FILE_METADATA_FIELDS:
+            if field == "file_checksum" and not checksum:
+                continue
+            setattr(self, field, metadata[field])
 
     def set_extent(self):
         """ https://gis.stackexchange.com/a/201320/28414 """
@@ -448,11 +502,7 @@ class ItemBase(models.Model):
             src = None
             del src
 
-            webMerc = osr.SpatialReference()
-            webMerc.ImportFromEPSG(3857)
-            wgs84 = osr.SpatialReference()
-            wgs84.ImportFromEPSG(4326)
-            transform = osr.CoordinateTransformation(webMerc, wgs84)
+            transform = get_transformation(3857, 4326)
 
             ul = transform.TransformPoint(ulx, uly)
             lr = transform.TransformPoint(lrx, lry)
@@ -484,11 +534,19 @@ class ItemBase(models.Model):
         self.save(update_fields=["vrs"])
         logger.info(f"{self.pk} added to vrs {self.vrs.pk}")
 
-    def save(self, set_slug=False, set_thumbnail=False, set_extent=False, *args, **kwargs):
+    def save(self, set_slug=False, set_thumbnail=False, set_extent=False, set_file_metadata=False, *args, **kwargs):
 
         if set_slug or not self.slug:
             self.slug = slugify(self.title, join_char="_")
 
+        # new files are hashed here, while older files missing metadata only
+        # get the cheap fields (the checksum is left to backfill-file-metadata).
+        # partial saves (locks, status, etc.) would discard the metadata.
+        if set_file_metadata:
+            self.set_file_metadata()
+        elif self.file and self.file_size is None and not kwargs.get("update_fields"):
+            self.set_file_metadata(checksum=False)
+
         if set_thumbnail or (self.file and not self.thumbnail):
             self.set_thumbnail()
 
@@ -512,35 +570,38 @@ class Document(ItemBase):
         verbose_name = "Document"
         verbose_name_plural = "Documents"
 
-    @cached_property
+    @property
     def image_size(self):
-        size = None
-        if self.file:
-            try:
-                img = Image.open(self.file)
-                size = img.size
-                img.close()
-            except Exception as e:
-                logger.warn(f"error opening file {self.file}: {e}")
-        return size
+        # documents saved before file metadata was stored have no dimensions
+        # until `manage.py resource backfill-file-metadata` is run, and
+        # callers fall back on reading the file themselves
+        if self.image_width is None:
+            return None
+        return (self.image_width, self.image_height)
 
     @property
     def urls(self):
         urls = self._base_urls
         urls.update({
-            "resource": full_reverse("resource_detail", args=(self.pk, )),
+            "resource": full_reverse_pk("resource_detail", self.pk),
             # # remove detail and progress_page urls once InfoPanel has been fully
             # # deprecated and volume summary has been updated.
             # "detail": f"/documents/{self.pk}",
             # "progress_page": f"/documents/{self.pk}#georeference",
-            "split": full_reverse("split_view", args=(self.pk, )),
-            "georeference": full_reverse("georeference_view", args=(self.pk, )),
+            "split": full_reverse_pk("split_view", self.pk),
+            "georeference": full_reverse_pk("georeference_view", self.pk),
         })
+        # tiled documents must be viewed through their IIIF image service
+        from ohmg.georeference.iiif.utils import document_is_tiled
+        if document_is_tiled(self):
+            urls["iiif_info"] = full_reverse_pk("document_info", self.pk)
         return urls
 
     @property
     def preparation_session(self):
         from ohmg.georeference.models import PrepSession
+        if "preparation_session" in self.prefetched:
+            return self.prefetched["preparation_session"]
         try:
             return PrepSession.objects.get(doc=self)
         except PrepSession.DoesNotExist:
@@ -555,6 +616,8 @@ class Document(ItemBase):
     @property
     def georeference_sessions(self):
         from ohmg.georeference.models import GeorefSession
+        if "georeference_sessions" in self.prefetched:
+            return self.prefetched["georeference_sessions"]
         return GeorefSession.objects.filter(doc=self.id).order_by("date_run")
 
     @property
@@ -649,6 +712,8 @@ class Document(ItemBase):
             return []
 
     def get_layer(self):
+        if "layer" in self.prefetched:
+            return self.prefetched["layer"]
         try:
             link = DocumentLink.objects.get(link_type="georeference", source=self)
             layer = link.target
@@ -717,7 +782,7 @@ class Layer(ItemBase):
         urls = self._base_urls
         doc = self.get_document()
         urls.update({
-            "resource": full_reverse("resource_detail", args=(self.pk, )),
+            "resource": full_reverse_pk("resource_detail", self.pk),
             # remove detail and progress_page urls once InfoPanel has been fully
             # deprecated and volume summary has been updated.
             # note the geonode: prefix is still necessary until non-geonode
@@ -729,8 +794,8 @@ class Layer(ItemBase):
         })
         if doc is not None:
             urls.update({
-                "georeference": doc.urls['georeference'],
-                "document": doc.urls['image'],
+                "georeference": full_reverse_pk("georeference_view", doc.pk),
+                "document": doc.file.url if doc.file else "",
             })
         return urls
 
@@ -744,6 +809,8 @@ class Layer(ItemBase):
         return self.get_document().get_georeference_summary()
 
     def get_document(self):
+        if "document" in self.prefetched:
+            return self.prefetched["document"]
         try:
             link = DocumentLink.objects.get(link_type="georeference", target_id=self.pk)
             document = link.source
@@ -805,6 +872,117 @@ class DocumentLink(models.Model):
     def __str__(self):
         return f"{self.source} --> {self.target}"
 
+def prime_items(items):
+    """Bulk load everything that Document.serialize() and Layer.serialize()
+    need for this list of documents and/or layers, and prime each instance
+    with it. The split parents and children of each document are followed
+    (one query per level of splitting), along with layers, GCPs, and
+    sessions, so serializing any of these items afterward runs no further
+    queries. Returns a dict of every Document that was loaded, by pk."""
+
+    from ohmg.georeference.models import PrepSession, GeorefSession
+
+    all_docs = {i.pk: i for i in items if i.type == "document"}
+    given_layers = {i.pk: i for i in items if i.type == "layer"}
+
+    layer_links = DocumentLink.objects.filter(target_id__in=given_layers.keys(), link_type="georeference")
+    layer_doc_ids = {link.target_id: link.source_id for link in layer_links}
+    all_docs.update(Document.objects.in_bulk(
+        [i for i in layer_doc_ids.values() if i not in all_docs]
+    ))
+
+    # walk up to the split parents...
+    pending = set(all_docs.keys())
+    while pending:
+        parent_ids = dict(DocumentLink.objects.filter(
+            target_id__in=pending, link_type="split",
+        ).values_list("target_id", "source_id"))
+        new_docs = Document.objects.in_bulk([i for i in set(parent_ids.values()) if i not in all_docs])
+        all_docs.update(new_docs)
+        for pk in pending:
+            all_docs[pk].__dict__['parent'] = all_docs.get(parent_ids.get(pk))
+        pending = set(new_docs.keys())
+
+    # ...and down to the split children
+    pending = set(all_docs.keys())
+    while pending:
+        children_ids = {}
+        for source_id, target_id in DocumentLink.objects.filter(
+            source_id__in=pending, link_type="split",
+        ).values_list("source_id", "target_id").order_by("pk"):
+            children_ids.setdefault(source_id, []).append(target_id)
+        new_docs = Document.objects.in_bulk([i for ids in children_ids.values() for i in ids if i not in all_docs])
+        all_docs.update(new_docs)
+        for pk in pending:
+            children = [all_docs[i] for i in children_ids.get(pk, []) if i in all_docs]
+            all_docs[pk].__dict__['children'] = children
+            for child in children:
+                child.__dict__['parent'] = all_docs[pk]
+        pending = set(new_docs.keys())
+
+    layer_links = DocumentLink.objects.filter(source_id__in=all_docs.keys(), link_type="georeference")
+    layer_doc_ids = {link.target_id: link.source_id for link in layer_links}
+    layers = dict(given_layers)
+    layers.update(Layer.objects.in_bulk([i for i in layer_doc_ids.keys() if i not in layers]))
+    for layer in given_layers.values():
+        layer.prefetched['document'] = None
+    for doc in all_docs.values():
+        doc.prefetched['layer'] = None
+    for layer_id, doc_id in layer_doc_ids.items():
+        layer = layers.get(layer_id)
+        if layer:
+            all_docs[doc_id].prefetched['layer'] = layer
+            layer.prefetched['document'] = all_docs[doc_id]
+
+    gcp_groups = {i.doc_id: i for i in GCPGroup.objects.filter(doc_id__in=all_docs.keys())}
+    gcps = {}
+    for gcp in GCP.objects.filter(gcp_group__in=gcp_groups.values()).select_related("last_modified_by"):
+        gcps.setdefault(gcp.gcp_group_id, []).append(gcp)
+    for group in gcp_groups.values():
+        group.__dict__['prefetched_gcps'] = gcps.get(group.pk, [])
+    for pk, doc in all_docs.items():
+        doc.__dict__['gcp_group'] = gcp_groups.get(pk)
+
+    prep_sessions = {}
+    for sesh in PrepSession.objects.filter(doc_id__in=all_docs.keys()).select_related("user").order_by("pk"):
+        if sesh.doc_id in prep_sessions:
+            logger.warn(f"Multiple PrepSessions found for Document {sesh.doc_id}")
+            continue
+        prep_sessions[sesh.doc_id] = sesh
+    georef_sessions = {}
+    for sesh in GeorefSession.objects.filter(doc_id__in=all_docs.keys()).select_related("user").order_by("date_run"):
+        georef_sessions.setdefault(sesh.doc_id, []).append(sesh)
+
+    def get_prep_session(doc):
+        # children without their own prep session fall back on the parent's
+        if doc.pk in prep_sessions:
+            return prep_sessions[doc.pk]
+        parent = doc.__dict__['parent']
+        return get_prep_session(parent) if parent else None
+
+    for pk, doc in all_docs.items():
+        doc.prefetched['georeference_sessions'] = georef_sessions.get(pk, [])
+        doc.prefetched['preparation_session'] = get_prep_session(doc)
+
+    return all_docs
+
+def prime_documents(documents):
+    """Prime a list of documents with prime_items(), and return a tuple of
+    (documents, layers), where documents is the input list with each split
+    document replaced by its children, in order (as with Sheet.real_docs),
+    and layers is a list of their layers."""
+
+    prime_items(documents)
+
+    real_docs, real_layers = [], []
+    for doc in documents:
+        real_docs += doc.__dict__['children'] if doc.__dict__['children'] else [doc]
+    for doc in real_docs:
+        if doc.prefetched['layer']:
+            real_layers.append(doc.prefetched['layer'])
+
+    return real_docs, real_layers
+
 
 class SetCategory(models.Model):
 
@@ -849,6 +1027,18 @@ class AnnotationSet(models.Model):
         max_length=255,
         storage=OverwriteStorage(),
     )
+    encoding_profile = models.CharField(
+        max_length=50,
+        null=True,
+        blank=True,
+        choices=[(k, v["name"]) for k, v in COG_ENCODING_PROFILES.items()],
+        help_text="COG encoding for layers and mosaics in this set, leave blank to use the site default.",
+    )
+    trim_manifest = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="Trimmed layer files used in mosaics, keyed by layer slug.",
+    )
 
     def __str__(self):
         return f"{self.volume} - {self.category}"
@@ -957,227 +1147,215 @@ class AnnotationSet(models.Model):
             self.multimask = None
         self.save(update_fields=['multimask'])
 
-    def generate_mosaic_vrt(self):
+    def generate_mosaic_vrt(self, trim_list):
         """ A helpful reference from the BPLv used during the creation of this method:
         https://github.com/bplmaps/atlascope-utilities/blob/master/new-workflow/atlas-tools.py
-        """
-
-        gdal.SetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
-        gdal.SetConfigOption("GDAL_TIFF_INTERNAL_MASK", "YES")
-
-        multimask_geojson = self.multimask_geojson
-        multimask_file_name = f"multimask-{self.category.slug}-{self.volume.identifier}"
-        multimask_file = os.path.join(settings.TEMP_DIR, f"{multimask_file_name}.geojson")
-        with open(multimask_file, "w") as out:
-            json.dump(multimask_geojson, out, indent=1)
-
-        trim_list = []
-        layer_extent_polygons = []
-        for feature in multimask_geojson['features']:
-
-            layer_name = feature['properties']['layer']
-
-            layer = Layer.objects.get(slug=layer_name)
-            if not layer.file:
-                raise Exception(f"no layer file for this layer {layer_name}")
-
-            if layer.extent:
-                extent_poly = Polygon.from_bbox(layer.extent)
-                layer_extent_polygons.append(extent_poly)
-
-            latest_sesh = list(layer.get_document().georeference_sessions)[-1]
-            in_path = latest_sesh.run(return_vrt=True)
-            trim_name = os.path.basename(in_path).replace(".vrt", "_trim.vrt")
-            out_path = os.path.join(settings.TEMP_DIR, trim_name)
-
-            wo = gdal.WarpOptions(
-                format="VRT",
-                dstSRS = "EPSG:3857",
-                cutlineDSName = multimask_file,
-                cutlineLayer = multimask_file_name,
-                cutlineWhere = f"layer='{layer_name}'",
-                cropToCutline = True,
-                # srcAlpha = True,
-                # dstAlpha = True,
-                # creationOptions= [
-                #     'COMPRESS=JPEG',
-                # ]
-                # creationOptions= [
-                #     'COMPRESS=DEFLATE',
-                #     'PREDICTOR=2',
-                # ]
-            )
-            gdal.Warp(out_path, in_path, options=wo)
-            print("warped")
-
-            trim_list.append(out_path)
 
-        if len(layer_extent_polygons) > 0:
-            multi = MultiPolygon(layer_extent_polygons, srid=4326)
+        Build a VRT over a list of trimmed layer tifs (see build_mosaic_trims).
+        The trims are already warped, cut to their masks, and carry an alpha
+        band, so nothing is warped again here. Returns the path to the VRT.
+        """
 
-        bounds = multi.transform(3857, True).extent
         vo = gdal.BuildVRTOptions(
             resolution = 'highest',
             outputSRS="EPSG:3857",
-            outputBounds=bounds,
             separate = False,
         )
-        print("building vrt")
+        logger.debug(f"{self} | building vrt from {len(trim_list)} trimmed tifs")
 
         mosaic_vrt = os.path.join(settings.TEMP_DIR, f"{self.volume.identifier}-{self.category.slug}.vrt")
         gdal.BuildVRT(mosaic_vrt, trim_list, options=vo)
 
         return mosaic_vrt
 
-    def generate_mosaic_cog(self):
+    def write_mosaic_geotiff(self, trim_list, workers=None):
+        """Create a mosaic GeoTIFF from a list of trimmed tif paths and save
+        it to this AnnotationSet. The file is written straight to the storage
+        location for the mosaic_geotiff field, see
+        ohmg.georeference.mosaic.write_mosaic_geotiff."""
 
         start = datetime.now()
-
-        mosaic_vrt = self.generate_mosaic_vrt()
+        mosaic_vrt = self.generate_mosaic_vrt(trim_list)
 
         print("building final geotiff")
 
-        to = gdal.TranslateOptions(
-            format="COG",
-            creationOptions = [
-                "BIGTIFF=YES",
-                "COMPRESS=JPEG",
-                "TILING_SCHEME=GoogleMapsCompatible",
-            ],
-        )
-
-        mosaic_tif = mosaic_vrt.replace(".vrt", ".tif")
-        gdal.Translate(mosaic_tif, mosaic_vrt, options=to)
-
         existing_file_path = None
         if self.mosaic_geotiff:
             existing_file_path = self.mosaic_geotiff.path
 
         file_name = f"{self.volume.identifier}-{self.category.slug}__{datetime.now().strftime('%Y-%m-%d')}__{random_alnum(6)}.tif"
+        name = self.mosaic_geotiff.field.generate_filename(self, file_name)
+        out_path = self.mosaic_geotiff.storage.path(name)
 
-        with open(mosaic_tif, 'rb') as f:
-            self.mosaic_geotiff.save(file_name, File(f))
+        try:
+            write_mosaic_geotiff(
+                mosaic_vrt,
+                out_path,
+                encoding_profile=self.encoding_profile,
+                workers=workers,
+            )
+        finally:
+            os.remove(mosaic_vrt)
+
+        self.mosaic_geotiff.name = name
+        self.save(update_fields=["mosaic_geotiff"])
 
-        os.remove(mosaic_tif)
-        if existing_file_path:
+        if existing_file_path and existing_file_path != out_path and os.path.isfile(existing_file_path):
             os.remove(existing_file_path)
 
         print(f"completed - elapsed time: {datetime.now() - start}")
+        return out_path
+
+    def generate_mosaic_cog(self, trim_all=False, workers=None, retries=2, progress=None):
+        """Trim all layers in the multimask (in parallel, reusing trims that are
+        still valid, the same as for the MosaicJSON) and then write a tiled
+        mosaic GeoTIFF with internal overviews from them. Layers that fail after all retries are left out of the
+        mosaic and returned in a list of failed jobs."""
+
+        logger.info(f"{self} | generating mosaic cog")
+        trim_list, failed = self.build_mosaic_trims(
+            trim_all=trim_all,
+            workers=workers,
+            retries=retries,
+            progress=progress,
+        )
+        self.write_mosaic_geotiff(trim_list, workers=workers)
+        return failed
 
-    def generate_mosaic_json(self, trim_all=False):
-
-        def write_trim_feature_cache(feature, file_path):
-            with open(file_path, "w") as f:
-                json.dump(feature, f, indent=2)
-
-        def read_trim_feature_cache(file_path):
-            with open(file_path, "r") as f:
-                feature = json.load(f)
-            return feature
+    def get_mosaic_trim_jobs(self, trim_all=False):
+        """Check each layer in the multimask against the trim manifest, and
+        return a tuple of (jobs, reused), where jobs is a list of trim jobs
+        (see ohmg.georeference.mosaic.trim_layers) for layers that need to be
+        (re)trimmed, and reused is a dict of layer slug to the path of an
+        existing trimmed tif that is still valid. Trims are content-addressed
+        by the layer file, mask geometry, and trim options, see get_trim_key."""
 
-        logger.info(f"{self.vol.identifier} | generating mosaic json")
+        multimask_geojson = self.multimask_geojson
+        if not multimask_geojson:
+            return [], {}
 
-        multimask_geojson = self.vol.multimask_geojson
-        multimask_file_name = f"multimask-{self.vol.identifier}"
-        multimask_file = os.path.join(settings.TEMP_DIR, f"{multimask_file_name}.geojson")
-        with open(multimask_file, "w") as out:
-            json.dump(multimask_geojson, out, indent=1)
+        manifest = self.trim_manifest if self.trim_manifest else {}
+        layer_names = [i['properties']['layer'] for i in multimask_geojson['features']]
+        layers = Layer.objects.in_bulk(layer_names, field_name="slug")
 
-        logger.debug(f"{self.vol.identifier} | multimask loaded")
-        logger.info(f"{self.vol.identifier} | iterating and trimming layers")
-        trim_list = []
+        jobs, reused = [], {}
         for feature in multimask_geojson['features']:
 
             layer_name = feature['properties']['layer']
-            layer = Layer.objects.get(slug=layer_name)
-            if not layer.file:
-                logger.error(f"{self.vol.identifier} | no layer file for this layer {layer_name}")
+            layer = layers.get(layer_name)
+            if not layer or not layer.file:
+                logger.error(f"{self} | no layer file for this layer {layer_name}")
                 raise Exception(f"no layer file for this layer {layer_name}")
             in_path = layer.file.path
 
-            layer_dir = os.path.dirname(in_path)
-            file_name = os.path.basename(in_path)
-            logger.debug(f"{self.vol.identifier} | processing layer file {file_name}")
-
-            file_root = os.path.splitext(file_name)[0]
-            existing_trimmed_tif = glob.glob(f"{layer_dir}/{file_root}*_trim.tif")
-            print(existing_trimmed_tif)
-
-            feat_cache_path = in_path.replace(".tif", "_trim-feature.json")
-            if os.path.isfile(feat_cache_path):
-                cached_feature = read_trim_feature_cache(feat_cache_path)
-                logger.debug(f"{self.vol.identifier} | using cached trim json boundary")
-            else:
-                cached_feature = None
-                write_trim_feature_cache(feature, feat_cache_path)
-
-            unique_id = random_alnum(6)
-            trim_vrt_path = in_path.replace(".tif", f"_{unique_id}_trim.vrt")
-            out_path = trim_vrt_path.replace(".vrt", ".tif")
-
-            # compare this multimask feature to the cached one for this layer
-            # and only (re)create a trimmed tif if they do not match
-            if feature != cached_feature or trim_all is True:
-
-                wo = gdal.WarpOptions(
-                    format="VRT",
-                    dstSRS = "EPSG:3857",
-                    cutlineDSName = multimask_file,
-                    cutlineLayer = multimask_file_name,
-                    cutlineWhere = f"layer='{layer_name}'",
-                    cropToCutline = True,
-                    creationOptions = ['COMPRESS=LZW', 'BIGTIFF=YES'],
-                    resampleAlg = 'cubic',
-                    dstAlpha = False,
-                    dstNodata = "255 255 255",
-                )
-                gdal.Warp(trim_vrt_path, in_path, options=wo)
-
-                to = gdal.TranslateOptions(
-                    format="GTiff",
-                    bandList = [1,2,3],
-                    creationOptions = [
-                        "TILED=YES",
-                        "COMPRESS=LZW",
-                        "PREDICTOR=2",
-                        "NUM_THREADS=ALL_CPUS",
-                        ## the following is apparently in the COG spec but doesn't work??
-                        # "COPY_SOURCE_OVERVIEWS=YES",
-                    ],
-                )
-
-                logger.debug(f"writing trimmed tif {os.path.basename(out_path)}")
-                gdal.Translate(out_path, trim_vrt_path, options=to)
-                write_trim_feature_cache(feature, feat_cache_path)
-
-                img = gdal.Open(out_path, 1)
-                if img is None:
-                    logger.warn(f"{self.vol.identifier} | file was not properly created, omitting: {file_name}")
-                    continue   
-                logger.debug(f"{self.vol.identifier} | building overview: {file_name}")
-                gdal.SetConfigOption("COMPRESS_OVERVIEW", "LZW")
-                gdal.SetConfigOption("PREDICTOR", "2")
-                gdal.SetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
-                img.BuildOverviews("AVERAGE", [2, 4, 8, 16])
-
-            else:
-                logger.debug(f"{self.vol.identifier} | using existing trimmed tif {file_name}")
+            key = get_trim_key(in_path, feature)
+            out_path = get_trim_path(in_path, key)
+
+            if os.path.isfile(out_path) and trim_all is False:
+                logger.debug(f"{self} | using existing trimmed tif {os.path.basename(out_path)}")
+                reused[layer_name] = out_path
+                continue
+
+            previous = manifest.get(layer_name, {}).get("path")
+            jobs.append({
+                "layer": layer_name,
+                "in_path": in_path,
+                "out_path": out_path,
+                "feature": feature,
+                "key": key,
+                "stale_paths": [previous] if previous and previous != out_path else [],
+            })
 
-            trim_list.append(out_path)
+        return jobs, reused
+
+    def complete_mosaic_trim_jobs(self, jobs, reused=None):
+        """Update the trim manifest with the results of successful trim jobs
+        (and any reused trims), and remove the trimmed tifs they replace.
+        Layers that are no longer in the multimask are dropped from the
+        manifest and their trims are removed as well."""
+
+        manifest = self.trim_manifest if self.trim_manifest else {}
+        stale_paths = []
+        for job in jobs:
+            manifest[job['layer']] = {"key": job['key'], "path": job['out_path']}
+            stale_paths += job['stale_paths']
+        if reused:
+            for layer_name, path in reused.items():
+                previous = manifest.get(layer_name, {}).get("path")
+                if previous and previous != path:
+                    stale_paths.append(previous)
+                manifest[layer_name] = dict(manifest.get(layer_name, {}), path=path)
+
+        current_layers = set(self.multimask.keys()) if self.multimask else set()
+        for layer_name in [i for i in manifest if i not in current_layers]:
+            stale_paths.append(manifest.pop(layer_name).get("path"))
+
+        for path in stale_paths:
+            if path and os.path.isfile(path):
+                os.remove(path)
+
+        self.trim_manifest = manifest
+        self.save(update_fields=["trim_manifest"])
+
+    def build_mosaic_trims(self, trim_all=False, workers=None, retries=2, progress=None):
+        """Bring all trimmed layers for this set up to date, only trimming the
+        layers whose file or mask have changed. Returns a tuple of (trim_list,
+        failed), where trim_list is in the same order as the multimask."""
+
+        jobs, reused = self.get_mosaic_trim_jobs(trim_all=trim_all)
+        logger.info(f"{self} | trimming {len(jobs)} layers, reusing {len(reused)}")
+
+        completed, failed = trim_layers(jobs, workers=workers, retries=retries, progress=progress)
+        trim_list = self.get_mosaic_trim_list(completed, failed, reused)
+        return trim_list, failed
+
+    def get_mosaic_trim_list(self, completed, failed, reused):
+        """Record the completed (and reused) trims in the manifest, log the
+        failed ones, and return the trimmed tif paths in multimask order.
+        Used both here and when the trims are run as celery tasks."""
+
+        self.complete_mosaic_trim_jobs(completed, reused)
+        for job in failed:
+            logger.error(f"{self} | omitting layer {job['layer']} from mosaic: {job['error']}")
+
+        trim_paths = dict(reused)
+        trim_paths.update({job['layer']: job['out_path'] for job in completed})
+        return [trim_paths[i] for i in self.multimask if i in trim_paths]
+
+    def write_mosaic_json(self, trim_list):
+        """Create a MosaicJSON from a list of trimmed tif paths and save it to
+        this AnnotationSet."""
 
         trim_urls = [
             i.replace(os.path.dirname(settings.MEDIA_ROOT), settings.MEDIA_HOST.rstrip("/")) \
                 for i in trim_list
         ]
-        logger.info(f"{self.vol.identifier} | writing mosaic from {len(trim_urls)} trimmed tifs")
+        logger.info(f"{self} | writing mosaic from {len(trim_urls)} trimmed tifs")
         mosaic_data = MosaicJSON.from_urls(trim_urls, minzoom=14)
-        mosaic_json_path = os.path.join(settings.TEMP_DIR, f"{self.vol.identifier}-mosaic.json")
+        mosaic_json_path = os.path.join(settings.TEMP_DIR, f"{self.volume.identifier}-{self.category.slug}-mosaic.json")
         with MosaicBackend(mosaic_json_path, mosaic_def=mosaic_data) as mosaic:
             mosaic.write(overwrite=True)
 
         with open(mosaic_json_path, 'rb') as f:
-            self.vol.mosaic_json = File(f, name=os.path.basename(mosaic_json_path))
-            self.vol.save()
-
-        logger.info(f"{self.vol.identifier} | mosaic created: {os.path.basename(mosaic_json_path)}")
-        return mosaic_json_path
+            self.mosaic_json = File(f, name=os.path.basename(mosaic_json_path))
+            self.save(update_fields=["mosaic_json"])
+        os.remove(mosaic_json_path)
+
+        logger.info(f"{self} | mosaic created: {os.path.basename(mosaic_json_path)}")
+        return self.mosaic_json.path
+
+    def generate_mosaic_json(self, trim_all=False, workers=None, retries=2, progress=None):
+        """Trim all layers in the multimask (in parallel, reusing trims that are
+        still valid) and then build a MosaicJSON from them. Layers that fail
+        after all retries are left out of the mosaic and returned in a list of
+        failed jobs, and will be retried the next time this is run."""
+
+        logger.info(f"{self} | generating mosaic json")
+        trim_list, failed = self.build_mosaic_trims(
+            trim_all=trim_all,
+            workers=workers,
+            retries=retries,
+            progress=progress,
+        )
+        self.write_mosaic_json(trim_list)
+        return failed
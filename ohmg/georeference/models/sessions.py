@@ -16,6 +16,7 @@ from ohmg.georeference.models import (
     DocumentLink
 )
 from ohmg.georeference.georeferencer import Georeferencer
+from ohmg.georeference.lookups import defer_lookup_refresh
 from ohmg.georeference.splitter import Splitter
 from ohmg.core.utils import (
     full_reverse,
@@ -209,10 +210,10 @@ class SessionBase(models.Model):
         # handle the non- js-serializable attributes
         doc_id, layer_alt, d_create, d_mod, d_run = None, None, None, None, None
         d_run_d, d_run_t = None, None
-        if self.doc:
-            doc_id = self.doc.pk
-        if self.lyr:
-            layer_alt = self.lyr.pk
+        if self.doc_id:
+            doc_id = self.doc_id
+        if self.lyr_id:
+            layer_alt = self.lyr_id
         if self.date_created:
             d_create = self.date_created.strftime("%Y-%m-%d - %H:%M")
         if self.date_modified:
@@ -307,6 +308,7 @@ class PrepSession(SessionBase):
         child_ids = DocumentLink.objects.filter(source=self.doc).values_list("target_id", flat=True)
         return list(Document.objects.filter(pk__in=child_ids))
 
+    @defer_lookup_refresh()
     def run(self):
         """
         Runs the document split process based on prestored segmentation info
@@ -333,7 +335,7 @@ class PrepSession(SessionBase):
             self.doc.remove_lock()
         else:
             self.update_status("splitting document image")
-            s = Splitter(image_file=self.doc.file.path)
+            s = Splitter(image_file=self.doc.file.path, image_size=self.doc.image_size)
             self.data['divisions'] = s.generate_divisions(self.data['cutlines'])
             new_images = s.split_image()
 
@@ -347,7 +349,7 @@ class PrepSession(SessionBase):
                 new_doc.title = f"{self.doc.title} [{n}]"
                 with open(file_path, "rb") as openf:
                     new_doc.file.save(fname, File(openf))
-                new_doc.save(set_thumbnail=True, set_slug=True)
+                new_doc.save(set_thumbnail=True, set_slug=True, set_file_metadata=True)
 
                 os.remove(file_path)
 
@@ -466,6 +468,21 @@ class GeorefSession(SessionBase):
     def __str__(self):
         return f"Georeference Session ({self.pk})"
 
+    def get_volume(self):
+        """Return the Volume that this session's document (or its parent)
+        is a sheet of, or None."""
+        from ohmg.loc_insurancemaps.models import Sheet
+
+        pdoc = self.doc
+        if pdoc.parent:
+            pdoc = pdoc.parent
+        try:
+            return Sheet.objects.get(doc=pdoc).volume
+        except Sheet.DoesNotExist:
+            logger.warn(f"error getting Sheet for document {pdoc.pk}")
+            return None
+
+    @defer_lookup_refresh()
     def run(self, return_vrt=False):
 
         logger.debug("in run()")
@@ -500,6 +517,14 @@ class GeorefSession(SessionBase):
         self.update_status("initializing georeferencer", save=False)
         self.save()
 
+        # use the encoding profile of the AnnotationSet that the layer will
+        # end up in: its current set, or else the volume's main-content set
+        volume = self.get_volume()
+        target_set = layer.vrs if layer else None
+        if target_set is None and volume is not None:
+            target_set = volume.get_annotation_set("main-content")
+        encoding_profile = target_set.encoding_profile if target_set else None
+
         try:
             # assume EPSG code for now, as making this completely
             # flexible is still in-development. see views.py line 277
@@ -508,6 +533,7 @@ class GeorefSession(SessionBase):
                 crs=crs_code,
                 transformation=self.data['transformation'],
                 gcps_geojson=self.data['gcps'],
+                encoding_profile=encoding_profile,
             )
         except Exception as e:
             self.update_stage("finished", save=False)
@@ -574,20 +600,13 @@ class GeorefSession(SessionBase):
             os.remove(existing_file_path)
 
         layer.set_status("georeferenced", save=False)
-        layer.save(set_thumbnail=True, set_extent=True)
+        layer.save(set_thumbnail=True, set_extent=True, set_file_metadata=True)
         self.lyr = layer
 
         # hack around to add the layer to the main-content AnnotationSet
-        pdoc = self.doc
-        if pdoc.parent:
-            pdoc = pdoc.parent
-        try:
-            from ohmg.loc_insurancemaps.models import Sheet
-            volume = Sheet.objects.get(doc=pdoc).volume
+        if volume is not None:
             layer.vrs = volume.get_annotation_set("main-content", create=True)
             layer.save()
-        except Sheet.DoesNotExist:
-            logger.warn(f"error getting Sheet for document {pdoc.pk}")
 
         self.update_status("saving control points")
 
@@ -0,0 +1,326 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connections
+from osgeo import gdal
+
+from ohmg.georeference.georeferencer import get_cog_creation_options
+
+logger = logging.getLogger(__name__)
+
+class MosaicError(Exception):
+    """Raised when GDAL fails to write a trimmed layer or a mosaic."""
+    pass
+
+# any change to these will invalidate all existing trims (see get_trim_key)
+# trims keep an alpha band (rather than white as nodata) so that the same
+# files can be used for both the MosaicJSON and the mosaic COG.
+TRIM_WARP_OPTIONS = {
+    "dstSRS": "EPSG:3857",
+    "resampleAlg": "cubic",
+    "dstAlpha": True,
+}
+TRIM_CREATION_OPTIONS = [
+    "TILED=YES",
+    "COMPRESS=LZW",
+    "PREDICTOR=2",
+    "PHOTOMETRIC=RGB",
+    "ALPHA=YES",
+]
+TRIM_OVERVIEW_LEVELS = [2, 4, 8, 16]
+
+def get_trim_key(in_path, feature):
+    """Return a hash that identifies the trimmed output of a layer file with
+    a given mask feature. The layer file's size and modification time are
+    included (along with its path) so a re-georeferenced layer invalidates
+    its trim, as does any change to the mask geometry or trim options."""
+
+    stat = os.stat(in_path)
+    h = hashlib.sha1()
+    h.update(f"{in_path}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    h.update(json.dumps(feature['geometry'], sort_keys=True).encode())
+    h.update(json.dumps([TRIM_WARP_OPTIONS, TRIM_CREATION_OPTIONS, TRIM_OVERVIEW_LEVELS]).encode())
+    return h.hexdigest()
+
+def get_trim_path(in_path, key):
+    """Return the deterministic path for a trimmed layer, next to the layer."""
+    return in_path.replace(".tif", f"_{key[:12]}_trim.tif")
+
+def trim_layer(in_path, out_path, feature):
+    """Trim a single layer COG to its multimask feature, and write the result
+    as a tiled RGBA GTiff with internal overviews. This function doesn't touch the
+    database, so it is safe to run in a worker process or celery task. The
+    output is written to a temporary name and only renamed into place after
+    it has been fully built, so a failure never leaves a partial trim at
+    out_path. Returns out_path."""
+
+    fname = os.path.basename(in_path)
+    mem_id = uuid.uuid4().hex
+    cutline_path = f"/vsimem/{mem_id}_cutline.geojson"
+    trim_vrt_path = f"/vsimem/{mem_id}_trim.vrt"
+    tmp_path = out_path.replace(".tif", f"_{mem_id}.tmp.tif")
+
+    # the cutline is a single feature, so no cutlineWhere is needed
+    cutline = {"type": "FeatureCollection", "features": [feature]}
+    gdal.FileFromMemBuffer(cutline_path, json.dumps(cutline))
+
+    try:
+        wo = gdal.WarpOptions(
+            format="VRT",
+            cutlineDSName = cutline_path,
+            cropToCutline = True,
+            **TRIM_WARP_OPTIONS,
+        )
+        if gdal.Warp(trim_vrt_path, in_path, options=wo) is None:
+            raise MosaicError(f"unable to warp layer to its mask: {fname}")
+
+        to = gdal.TranslateOptions(
+            format="GTiff",
+            bandList = [1,2,3,4],
+            creationOptions = TRIM_CREATION_OPTIONS + [
+                "NUM_THREADS=ALL_CPUS",
+                ## the following is apparently in the COG spec but doesn't work??
+                # "COPY_SOURCE_OVERVIEWS=YES",
+            ],
+        )
+        logger.debug(f"{fname} | writing trimmed tif {os.path.basename(out_path)}")
+        gdal.Translate(tmp_path, trim_vrt_path, options=to)
+
+        img = gdal.Open(tmp_path, 1)
+        if img is None:
+            raise MosaicError(f"trimmed file was not properly created: {fname}")
+        logger.debug(f"{fname} | building overviews")
+        gdal.SetConfigOption("COMPRESS_OVERVIEW", "LZW")
+        gdal.SetConfigOption("PREDICTOR_OVERVIEW", "2")
+        gdal.SetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
+        img.BuildOverviews("AVERAGE", TRIM_OVERVIEW_LEVELS)
+        img = None
+
+        os.replace(tmp_path, out_path)
+
+    finally:
+        gdal.Unlink(cutline_path)
+        gdal.Unlink(trim_vrt_path)
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    return out_path
+
+# errors that are worth retrying a trim for: GDAL failures and file system
+# problems (GDAL itself signals errors by returning None, see MosaicError)
+TRIM_ERRORS = (MosaicError, OSError, RuntimeError)
+
+def _trim_layer_job(job, retries):
+    """Run trim_layer() for a job dict, retrying on failure. Returns a tuple
+    of (job, error message)."""
+
+    error = None
+    for attempt in range(retries + 1):
+        try:
+            trim_layer(job['in_path'], job['out_path'], job['feature'])
+            return job, None
+        except TRIM_ERRORS as e:
+            error = str(e)
+            logger.warning(f"{job['layer']} | trim failed (attempt {attempt + 1}/{retries + 1}): {e}")
+    return job, error
+
+def trim_layers(jobs, workers=None, retries=2, progress=None):
+    """Trim many layers in a process pool. Each job is a dict with layer,
+    in_path, out_path, and feature keys. progress is an optional callable
+    that is given (completed count, total count, job, error) as each job
+    finishes. Returns a tuple of (completed jobs, failed jobs), where each
+    failed job has an "error" key added to it."""
+
+    completed, failed = [], []
+    if not jobs:
+        return completed, failed
+
+    # db connections must not be shared with forked workers
+    connections.close_all()
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_trim_layer_job, job, retries) for job in jobs]
+        for n, future in enumerate(as_completed(futures), start=1):
+            job, error = future.result()
+            if error:
+                job['error'] = error
+                failed.append(job)
+            else:
+                completed.append(job)
+            if progress:
+                progress(n, len(jobs), job, error)
+
+    logger.info(f"trimmed {len(completed)}/{len(jobs)} layers in {round(time.time() - start, 2)} seconds, {len(failed)} failed")
+    return completed, failed
+
+def get_mosaic_creation_options(encoding_profile=None):
+    """Translate a COG encoding profile (see COG_ENCODING_PROFILES) into the
+    GTiff creation options and overview config options for a mosaic. The
+    mosaic is written as RGB with an internal mask, so JPEG can be used for
+    any profile. Returns a tuple of (creation options, config options)."""
+
+    cog_options = dict(i.split("=", 1) for i in get_cog_creation_options(encoding_profile))
+    compress = cog_options.get("COMPRESS", "JPEG")
+    quality = cog_options.get("QUALITY")
+
+    creation_options = [
+        "TILED=YES",
+        "BLOCKXSIZE=512",
+        "BLOCKYSIZE=512",
+        "BIGTIFF=YES",
+        f"COMPRESS={compress}",
+    ]
+    config_options = {
+        "GDAL_TIFF_INTERNAL_MASK": "YES",
+        "COMPRESS_OVERVIEW": compress,
+    }
+    if compress == "JPEG":
+        creation_options.append("PHOTOMETRIC=YCBCR")
+        config_options["PHOTOMETRIC_OVERVIEW"] = "YCBCR"
+        if quality:
+            creation_options.append(f"JPEG_QUALITY={quality}")
+            config_options["JPEG_QUALITY_OVERVIEW"] = quality
+    elif compress == "WEBP":
+        if quality:
+            creation_options.append(f"WEBP_LEVEL={quality}")
+            config_options["WEBP_LEVEL_OVERVIEW"] = quality
+    if cog_options.get("PREDICTOR") in ("YES", "2"):
+        creation_options.append("PREDICTOR=2")
+        config_options["PREDICTOR_OVERVIEW"] = "2"
+
+    return creation_options, config_options
+
+def get_overview_levels(x_size, y_size, block_size=512):
+    """Return overview factors (2, 4, 8, ...) down to the first level that
+    fits within a single block."""
+    levels, factor = [], 2
+    while max(x_size, y_size) / (factor / 2) > block_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+def _iter_windows(x_size, y_size, window_size):
+    for y in range(0, y_size, window_size):
+        for x in range(0, x_size, window_size):
+            yield x, y, min(window_size, x_size - x), min(window_size, y_size - y)
+
+def write_mosaic_geotiff(vrt_path, out_path, encoding_profile=None, workers=None,
+        memory_limit=None, window_size=2048):
+    """Write a mosaic VRT to a tiled GeoTIFF with internal overviews at
+    out_path, in windows that are read (i.e. warped and composited)
+    in parallel.
+
+    Windows of window_size pixels (a multiple of the 512px block size, so
+    every write fills whole blocks) are read in a thread pool, each thread
+    with its own dataset handle as GDAL handles are not thread safe. The
+    main thread writes them in order, and GDAL compresses the blocks in
+    another workers threads. The number of windows in flight is capped so
+    they fit in half of memory_limit (MB, defaults to
+    settings.MOSAIC_MEMORY_LIMIT), and the other half goes to GDAL's block
+    cache. Overviews are then built in place.
+
+    The file is written under a temporary name in the destination directory
+    and renamed when complete, so there is never a second full-size copy.
+    It is tiled with internal overviews and a mask, which is what the tile
+    server needs, but it isn't laid out as a strict COG (overviews come
+    after the full resolution data), as that layout can't be written
+    window by window. GDAL's block cache size and config options are
+    process-wide, so they are restored afterward."""
+
+    if memory_limit is None:
+        memory_limit = settings.MOSAIC_MEMORY_LIMIT
+    if workers is None:
+        workers = os.cpu_count()
+
+    fname = os.path.basename(out_path)
+    start = time.time()
+
+    src = gdal.Open(vrt_path)
+    if src is None:
+        raise MosaicError(f"{fname} | unable to open mosaic vrt")
+    x_size, y_size = src.RasterXSize, src.RasterYSize
+    geotransform, projection = src.GetGeoTransform(), src.GetProjection()
+    src = None
+
+    # 3 bands of RGB plus 1 of mask per pixel
+    window_bytes = window_size * window_size * 4
+    max_in_flight = max(1, (memory_limit * 1048576 // 2) // window_bytes)
+
+    creation_options, config_options = get_mosaic_creation_options(encoding_profile)
+    creation_options.append(f"NUM_THREADS={workers}")
+    config_options["GDAL_NUM_THREADS"] = str(workers)
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = out_path.replace(".tif", f"_{uuid.uuid4().hex}.tmp.tif")
+
+    prev_cache_max = gdal.GetCacheMax()
+    prev_config = {k: gdal.GetConfigOption(k) for k in config_options}
+    gdal.SetCacheMax(memory_limit * 1048576 // 2)
+    for k, v in config_options.items():
+        gdal.SetConfigOption(k, v)
+    try:
+        dst = gdal.GetDriverByName("GTiff").Create(
+            tmp_path, x_size, y_size, 3, gdal.GDT_Byte, options=creation_options,
+        )
+        if dst is None:
+            raise MosaicError(f"{fname} | unable to create mosaic file")
+        dst.SetGeoTransform(geotransform)
+        dst.SetProjection(projection)
+        dst.CreateMaskBand(gdal.GMF_PER_DATASET)
+        mask = dst.GetRasterBand(1).GetMaskBand()
+
+        local = threading.local()
+
+        def read_window(window):
+            if not hasattr(local, "ds"):
+                local.ds = gdal.Open(vrt_path)
+            x, y, w, h = window
+            rgb = local.ds.ReadRaster(x, y, w, h, band_list=[1, 2, 3])
+            # the alpha band of the trims, exposed as the mask of each band
+            alpha = local.ds.GetRasterBand(1).GetMaskBand().ReadRaster(x, y, w, h)
+            return window, rgb, alpha
+
+        def write_window(future):
+            (x, y, w, h), rgb, alpha = future.result()
+            dst.WriteRaster(x, y, w, h, rgb, band_list=[1, 2, 3])
+            mask.WriteRaster(x, y, w, h, alpha)
+
+        windows = list(_iter_windows(x_size, y_size, window_size))
+        logger.info(f"{fname} | writing {len(windows)} windows, {max_in_flight} in flight, {workers} threads")
+
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for n, window in enumerate(windows, start=1):
+                if len(in_flight) >= max_in_flight:
+                    write_window(in_flight.popleft())
+                in_flight.append(executor.submit(read_window, window))
+                if n % 100 == 0:
+                    logger.debug(f"{fname} | {n}/{len(windows)} windows read")
+            while in_flight:
+                write_window(in_flight.popleft())
+
+        levels = get_overview_levels(x_size, y_size)
+        logger.debug(f"{fname} | building overviews {levels}")
+        dst.BuildOverviews("AVERAGE", levels)
+        dst = None
+
+        os.replace(tmp_path, out_path)
+
+    finally:
+        gdal.SetCacheMax(prev_cache_max)
+        for k, v in prev_config.items():
+            gdal.SetConfigOption(k, v)
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    logger.info(f"{fname} | mosaic written in {round(time.time() - start, 2)} seconds")
+    return out_path
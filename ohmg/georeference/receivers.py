@@ -9,7 +9,9 @@ from ohmg.georeference.models import (
     GeorefSession,
     Document,
     Layer,
+    AnnotationSet,
 )
+from ohmg.georeference.lookups import mark_lookup_dirty
 from ohmg.loc_insurancemaps.models import find_volume
 
 logger = logging.getLogger(__name__)
@@ -50,10 +52,23 @@ def session_on_pre_delete(sender, instance, **kwargs):
 
 @receiver([signals.post_delete, signals.post_save], sender=Document)
 @receiver([signals.post_delete, signals.post_save], sender=Layer)
-def refresh_volume_lookup(sender, instance, **kwargs):
-    volume = find_volume(instance)
-    if volume is not None:
-        if sender == Document:
-            volume.update_doc_lookup(instance)
-        if sender == Layer:
-            volume.update_lyr_lookup(instance)
+def refresh_volume_lookup(sender, instance, signal, **kwargs):
+    """Mark the item as dirty, so its volume's lookups are refreshed once
+    when the transaction commits (see ohmg.georeference.lookups). A deleted
+    item can't be reloaded later, so its volume gets a full refresh."""
+    item_type = "document" if sender == Document else "layer"
+    if signal == signals.post_delete:
+        volume = find_volume(instance)
+        if volume is not None:
+            mark_lookup_dirty(item_type, volume_id=volume.pk)
+    else:
+        mark_lookup_dirty(item_type, pk=instance.pk)
+
+@receiver(signals.post_save, sender=AnnotationSet)
+def refresh_volume_progress(sender, instance, update_fields=None, **kwargs):
+    """Multimask coverage is part of a volume's progress, so recalculate
+    it when a main-content multimask changes."""
+    if update_fields is not None and "multimask" not in update_fields:
+        return
+    if instance.category and instance.category.slug == "main-content":
+        instance.volume.update_progress()
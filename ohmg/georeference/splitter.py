@@ -2,20 +2,23 @@ import os
 import math
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
+from osgeo import ogr
 from PIL import Image, ImageDraw, ImageFilter
 
 from django.db import connection
 from django.conf import settings
-from django.contrib.gis.geos import GEOSGeometry, Polygon, LineString
+from django.contrib.gis.geos import GEOSGeometry, Polygon, MultiPolygon, LineString
 
 logger = logging.getLogger(__name__)
 
 class Splitter(object):
 
-    def __init__(self, image_file=None, divisions=[]):
+    def __init__(self, image_file=None, divisions=[], image_size=None):
 
         self.img_file = image_file
+        self.img_size = image_size
         self.divisions = divisions
 
         if os.path.isdir(settings.TEMP_DIR) is False:
@@ -23,13 +26,16 @@ class Splitter(object):
         self.temp_dir = settings.TEMP_DIR
 
     def make_border_geometry(self, image_file=None):
-        """ generates a Polygon from the dimensions of the input image file. """
-
-        if image_file is None:
-            image_file = self.img_file
-
-        img = Image.open(image_file)
-        w, h = img.size
+        """ generates a Polygon from the dimensions of the input image file.
+        if the image size was passed to the Splitter (e.g. as stored on the
+        Document) the file is not opened. """
+
+        if image_file is None and self.img_size:
+            w, h = self.img_size
+        else:
+            img = Image.open(image_file or self.img_file)
+            w, h = img.size
+            img.close()
         coords = [(0,0), (0,h), (w,h), (w,0), (0,0)]
 
         return Polygon(coords)
@@ -79,12 +85,84 @@ class Splitter(object):
 
         return LineString(coord_list)
 
-    def generate_divisions(self, cutlines):
+    def snap_to_grid(self, geom):
+        """ in-process equivalent of ST_SnapToGrid(geom, 1) for the Polygons
+        (with or without holes), MultiPolygons, and LineStrings used here: coordinates are rounded to the nearest
+        integer (half to even, as PostGIS does) and consecutive duplicate
+        points are dropped. """
+
+        def snap_coords(coords):
+            snapped = []
+            for x, y in coords:
+                pt = (float(round(x)), float(round(y)))
+                if not snapped or snapped[-1] != pt:
+                    snapped.append(pt)
+            return snapped
+
+        if isinstance(geom, MultiPolygon):
+            return MultiPolygon([self.snap_to_grid(i) for i in geom])
+        if isinstance(geom, Polygon):
+            # exterior ring and any holes
+            return Polygon(*[snap_coords(ring) for ring in geom.coords])
+        return LineString(snap_coords(geom.coords))
+
+    def split_polygon_geos(self, polygon, line):
+        """ in-process equivalent of the PostGIS query in split_polygon_postgis().
+        the polygon's boundary and the line are unioned (which nodes them at
+        every intersection) and the resulting linework is polygonized. any
+        dangling ends of the line are discarded by polygonize, and faces that
+        fall outside of the polygon are filtered out, so, as with ST_Split, a
+        line that doesn't fully cross the polygon returns it unchanged. """
+
+        border = ogr.CreateGeometryFromWkt(self.snap_to_grid(polygon).wkt)
+        cut = ogr.CreateGeometryFromWkt(self.snap_to_grid(line).wkt)
+
+        linework = ogr.ForceToMultiLineString(border.GetBoundary().Union(cut))
+        faces = linework.Polygonize()
+
+        parts = []
+        if faces is not None:
+            for i in range(faces.GetGeometryCount()):
+                face = faces.GetGeometryRef(i)
+                if border.Contains(face.PointOnSurface()):
+                    parts.append(GEOSGeometry(face.ExportToWkt()))
+        return parts
+
+    def split_polygon_postgis(self, polygon, line, cursor):
+        """ splits the polygon with the line using ST_Split in PostGIS. """
+
+        sql = f'''
+        SELECT ST_AsText((ST_Dump(ST_Split(border, cut))).geom) AS wkt
+        FROM (SELECT
+        ST_SnapToGrid(ST_GeomFromText(' {polygon.wkt} '), 1) AS border,
+        ST_SnapToGrid(ST_GeomFromText(' {line.wkt} '), 1) AS cut) AS foo;
+        '''
+        cursor.execute(sql)
+        return [GEOSGeometry(row[0]) for row in cursor.fetchall()]
+
+    def generate_divisions(self, cutlines, engine=None):
         """ takes the input border and then tries to cut it with the cutlines.
         any sub polygons resulting from the cut are also compared to the cutlines,
-        until all cutlines have been used. """
+        until all cutlines have been used. engine can be "geos" (in process) or
+        "postgis" (one query per cut), and defaults to settings.SPLIT_ENGINE.
+        both engines go through the same sequence of cuts. """
 
-        initial_geom = self.make_border_geometry(self.img_file)
+        if engine is None:
+            engine = settings.SPLIT_ENGINE
+
+        if engine == "postgis":
+            with connection.cursor() as cursor:
+                return self._generate_divisions(
+                    cutlines, lambda polygon, line: self.split_polygon_postgis(polygon, line, cursor)
+                )
+        elif engine == "geos":
+            return self._generate_divisions(cutlines, self.split_polygon_geos)
+        else:
+            raise ValueError(f"invalid split engine: {engine}")
+
+    def _generate_divisions(self, cutlines, split_polygon):
+
+        initial_geom = self.make_border_geometry()
 
         ## process input cutlines
         cut_shapes = []
@@ -102,67 +180,110 @@ class Splitter(object):
             "final": True
         }]
 
-        with connection.cursor() as cursor:
+        ## every cut either uses up a cutline or evaluates a candidate, so this
+        ## loop always ends once all of the candidates have been evaluated.
+        while not all([i["evaluated"] for i in candidates]):
+            ## evaluate one clipped shape at a time.
+            for candidate in [i for i in candidates if not i["evaluated"]]:
+                candidate["evaluated"] = True
+
+                ## iterate all of the clip lines to try against this one shape.
+                ## exclude those that have already been used to cut a shape.
+                for cut in [i for i in cut_shapes if not i["used"]]:
+
+                    ## quick skip this cutline if it doesn't even touch the
+                    ## polygon that is being evaluated.
+                    if not candidate["geom"].intersects(cut["geom"]):
+                        continue
+
+                    parts = split_polygon(candidate["geom"], cut["geom"])
+
+                    ## if only one part is returned it means that the line was
+                    ## insufficient to cut the polygon. This check is likely
+                    ## redundant at this point in the process though.
+                    if len(parts) > 1:
+
+                        ## if a proper cut has been made, this cutline should be
+                        ## ignored on future iterations.
+                        cut['used'] = True
+
+                        ## if this candidate has been split, it will not be one
+                        ## of the final polygons.
+                        candidate["final"] = False
+
+                        ## turn each of the resulting polygons from the cut into
+                        ## new candidates for future iterations.
+                        for geom in parts:
+                            candidates.append({
+                                "geom": geom,
+                                "evaluated": False,
+                                "final": True
+                            })
+                        break
 
-            while True:
-                ## evaluate one clipped shape at a time.
-                for candidate in [i for i in candidates if not i["evaluated"]]:
-                    candidate["evaluated"] = True
+        out_shapes = [i["geom"].coords[0] for i in candidates if i["final"] is True]
 
-                    ## iterate all of the clip lines to try against this one shape.
-                    ## exclude those that have already been used to cut a shape.
-                    for cut in [i for i in cut_shapes if not i["used"]]:
+        self.divisions = out_shapes
 
-                        ## quick skip this cutline if it doesn't even touch the
-                        ## polygon that is being evaluated.
-                        if not candidate["geom"].intersects(cut["geom"]):
-                            continue
+        return out_shapes
 
-                        sql = f'''
-        SELECT ST_AsText((ST_Dump(ST_Split(border, cut))).geom) AS wkt
-        FROM (SELECT
-        ST_SnapToGrid(ST_GeomFromText(' {candidate["geom"].wkt} '), 1) AS border,
-        ST_SnapToGrid(ST_GeomFromText(' {cut["geom"].wkt} '), 1) AS cut) AS foo;
-                        '''
-                        cursor.execute(sql)
-                        rows = cursor.fetchall()
-
-                        ## if only one row is returned it means that the line was
-                        ## insufficient to cut the polygon. This check is likely
-                        ## redundant at this point in the process though.
-                        if len(rows) > 1:
-
-                            ## if a proper cut has been made, this cutline should be
-                            ## ignored on future iterations.
-                            cut['used'] = True
-
-                            ## if this candidate has been split, it will not be one
-                            ## of the final polygons.
-                            candidate["final"] = False
-
-                            ## turn each of the resulting polygons from the cut into
-                            ## new candidates for future iterations.
-                            for row in rows:
-                                geom = GEOSGeometry(row[0])
-                                candidates.append({
-                                    "geom": geom,
-                                    "evaluated": False,
-                                    "final": True
-                                })
-                            break
-
-                ## break the while loop once all of the candidates have been evaluated
-                if all([i["evaluated"] for i in candidates]):
-                    break
+    def get_division_path(self, n, out_format):
+        """ returns the output path for the nth division of the image. """
 
-        out_shapes = [i["geom"].coords[0] for i in candidates if i["final"] is True]
+        filename = os.path.basename(self.img_file)
+        ext = os.path.splitext(filename)[1]
+        out_filename = filename.replace(ext, f"__{n}.{out_format}")
+        return os.path.join(self.temp_dir, out_filename)
 
-        self.divisions = out_shapes
+    def write_division(self, img, n, shape, out_format="jpg"):
+        """ cuts one division out of the (already decoded) image and saves it.
+        the image is cropped to the division's bounding box first, so the mask
+        and any compositing are only ever done at the size of the output, not
+        the full image. only reads from img, so this is safe to run in
+        multiple threads at once. """
 
-        return out_shapes
+        format_lookup = {"jpg": "JPEG", "png": "PNG", 'tif': "GTiff"}
 
-    def split_image(self, out_format="jpg"):
-        """ """
+        w, h = img.size
+        coords = self.transform_coordinates(shape, h)
+
+        # crop box around the polygon, padded for the edge blur on png output
+        pad = 6 if out_format == "png" else 1
+        xs, ys = [i[0] for i in coords], [i[1] for i in coords]
+        left, upper = max(math.floor(min(xs)) - pad, 0), max(math.floor(min(ys)) - pad, 0)
+        right, lower = min(math.ceil(max(xs)) + pad, w), min(math.ceil(max(ys)) + pad, h)
+
+        crop = img.crop((left, upper, right, lower))
+
+        # the mask is drawn at crop size, with the polygon shifted by the
+        # (integer) crop offset so it rasterizes exactly as it would full-size
+        shape_mask = Image.new("L", crop.size, 0)
+        draw = ImageDraw.Draw(shape_mask)
+        draw.polygon([(x - left, y - upper) for x, y in coords], fill=255)
+
+        if out_format == "png":
+            shape_mask = shape_mask.filter(ImageFilter.GaussianBlur(2))
+
+        bbox = shape_mask.getbbox()
+        if out_format == "jpg":
+            # paste onto white, instead of compositing over an RGBA background
+            out_image = Image.new("RGB", crop.size, (255, 255, 255))
+            out_image.paste(crop.convert("RGB"), mask=shape_mask)
+        else:
+            out_image = crop.convert("RGBA")
+            out_image.putalpha(shape_mask)
+        out_image = out_image.crop(bbox)
+
+        out_path = self.get_division_path(n, out_format)
+        out_image.save(out_path, format_lookup[out_format])
+
+        return out_path
+
+    def split_image(self, out_format="jpg", crop_first=True, workers=None):
+        """ cuts the image into one file per division. by default the image is
+        decoded once and each division is cropped, masked, and written in a
+        thread pool (see write_division()). crop_first=False uses the original
+        process, which builds a full-size mask and image copy per division. """
 
         start = time.time()
         format_lookup = {"jpg": "JPEG", "png": "PNG", 'tif': "GTiff"}
@@ -170,6 +291,20 @@ class Splitter(object):
         img = Image.open(self.img_file)
         w, h = img.size
 
+        if crop_first:
+            img.load()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                out_paths = list(executor.map(
+                    lambda division: self.write_division(img, division[0], division[1], out_format),
+                    enumerate(self.divisions, start=1),
+                ))
+            img.close()
+
+            t = round(time.time()-start, 3)
+            logger.info(f"{os.path.basename(self.img_file)} split completed | {t} seconds | {len(out_paths)} parts")
+
+            return out_paths
+
         out_paths = []
         for n, shape in enumerate(self.divisions, start=1):
 
@@ -205,10 +340,7 @@ class Splitter(object):
                 out_image = composite.convert("RGB")
 
             # set output file name
-            filename = os.path.basename(self.img_file)
-            ext = os.path.splitext(filename)[1]
-            out_filename = filename.replace(ext, f"__{n}.{out_format}")
-            out_path = os.path.join(self.temp_dir, out_filename)
+            out_path = self.get_division_path(n, out_format)
 
             # finally, save the image out to the specified format
             out_image.save(out_path, format_lookup[out_format])
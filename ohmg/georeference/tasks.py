@@ -1,12 +1,16 @@
-import os
 import logging
 
+from celery import chord
+
 from ohmg.celeryapp import app
 from ohmg.georeference.models import (
+    AnnotationSet,
     PrepSession,
     GeorefSession,
     delete_expired_sessions,
 )
+from ohmg.georeference.georeferencer import delete_stale_previews
+from ohmg.georeference.mosaic import TRIM_ERRORS, trim_layer
 
 logger = logging.getLogger(__name__)
 
@@ -27,15 +31,68 @@ def delete_expired():
     delete_expired_sessions()
 
 @app.task
-def delete_preview_vrt(base_file_path, preview_url_to_remove):
+def delete_stale_preview_vrts():
+    removed = delete_stale_previews()
+    logger.debug(f"removed {removed} stale preview VRTs")
 
-    if not preview_url_to_remove.endswith(".vrt"):
-        logger.warn("will not delete non-VRT")
-        return
-    prev_file = os.path.basename(preview_url_to_remove)
-    prev_file_path = os.path.join(os.path.dirname(base_file_path), prev_file)
+@app.task(bind=True, max_retries=2, default_retry_delay=30)
+def trim_mosaic_layer(self, job):
+    """Trim a single layer for a mosaic, retrying on failure. After the last
+    retry the error is returned instead of raised, so that the chord still
+    completes and one bad layer doesn't block the whole mosaic."""
     try:
-        if os.path.exists(prev_file_path):
-            os.remove(prev_file_path)
-    except Exception as e:
-        logger.warn(f"error while deleting preview VRT: {e}")
+        trim_layer(job['in_path'], job['out_path'], job['feature'])
+        return job
+    except TRIM_ERRORS as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+        logger.error(f"{job['layer']} | trim failed after {self.max_retries} retries: {e}")
+        job['error'] = str(e)
+        return job
+
+@app.task
+def assemble_mosaic_json(results, annotationset_id, reused):
+    annoset = AnnotationSet.objects.get(pk=annotationset_id)
+    completed = [i for i in results if not i.get('error')]
+    failed = [i for i in results if i.get('error')]
+    trim_list = annoset.get_mosaic_trim_list(completed, failed, reused)
+    annoset.write_mosaic_json(trim_list)
+
+@app.task
+def generate_mosaic_json_task(annotationset_id, trim_all=False):
+    """Fan out the per-layer trims for a mosaic across the mosaic queue, and
+    assemble the MosaicJSON once they have all finished. Returns the id of
+    the chord result, which can be used to check on progress."""
+    annoset = AnnotationSet.objects.get(pk=annotationset_id)
+    jobs, reused = annoset.get_mosaic_trim_jobs(trim_all=trim_all)
+    logger.info(f"{annoset} | queuing {len(jobs)} layer trims, reusing {len(reused)}")
+    if not jobs:
+        assemble_mosaic_json.delay([], annotationset_id, reused)
+        return None
+    result = chord(trim_mosaic_layer.s(job) for job in jobs)(
+        assemble_mosaic_json.s(annotationset_id, reused)
+    )
+    return result.id
+
+@app.task
+def assemble_mosaic_cog(results, annotationset_id, reused):
+    annoset = AnnotationSet.objects.get(pk=annotationset_id)
+    completed = [i for i in results if not i.get('error')]
+    failed = [i for i in results if i.get('error')]
+    trim_list = annoset.get_mosaic_trim_list(completed, failed, reused)
+    annoset.write_mosaic_geotiff(trim_list)
+
+@app.task
+def generate_mosaic_cog_task(annotationset_id, trim_all=False):
+    """Same as generate_mosaic_json_task, but writes the mosaic GeoTIFF from
+    the trims once they have all finished."""
+    annoset = AnnotationSet.objects.get(pk=annotationset_id)
+    jobs, reused = annoset.get_mosaic_trim_jobs(trim_all=trim_all)
+    logger.info(f"{annoset} | queuing {len(jobs)} layer trims, reusing {len(reused)}")
+    if not jobs:
+        assemble_mosaic_cog.delay([], annotationset_id, reused)
+        return None
+    result = chord(trim_mosaic_layer.s(job) for job in jobs)(
+        assemble_mosaic_cog.s(annotationset_id, reused)
+    )
+    return result.id
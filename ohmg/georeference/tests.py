@@ -0,0 +1,192 @@
+from django.db import DatabaseError, connection, transaction
+from django.test import SimpleTestCase, TestCase
+from django.contrib.gis.geos import Polygon, MultiPolygon, LineString
+
+from ohmg.georeference.lookups import LookupBatch, defer_lookup_refresh, get_item_volume_ids
+from ohmg.georeference.models import Document, DocumentLink, Layer
+from ohmg.georeference.iiif.utils import IIIFRequestError, parse_iiif_size
+from ohmg.georeference.splitter import Splitter
+from ohmg.loc_insurancemaps.models import Sheet, Volume
+
+
+def square(x, y, size):
+    return [(x, y), (x, y + size), (x + size, y + size), (x + size, y), (x, y)]
+
+
+class SplitEngineTests(TestCase):
+    """The in-process (GEOS/OGR) split must give the same parts as ST_Split.
+    Polygonize doesn't return parts in the same order as ST_Split, so parts
+    are compared by their sorted areas, and their total area is checked
+    against the original polygon."""
+
+    def setUp(self):
+        self.splitter = Splitter(image_size=(100, 200))
+
+    def split_both(self, polygon, line):
+        geos_parts = self.splitter.split_polygon_geos(polygon, line)
+        with connection.cursor() as cursor:
+            postgis_parts = self.splitter.split_polygon_postgis(polygon, line, cursor)
+        return geos_parts, postgis_parts
+
+    def assertSameParts(self, polygon, line, expected_ct):
+        geos_parts, postgis_parts = self.split_both(polygon, line)
+        self.assertEqual(len(geos_parts), expected_ct)
+        self.assertEqual(len(postgis_parts), expected_ct)
+        self.assertEqual(
+            sorted(round(i.area, 6) for i in geos_parts),
+            sorted(round(i.area, 6) for i in postgis_parts),
+        )
+        self.assertAlmostEqual(sum(i.area for i in geos_parts), self.splitter.snap_to_grid(polygon).area)
+        for part in geos_parts:
+            self.assertTrue(part.valid)
+
+    def test_straight_cut(self):
+        polygon = Polygon(square(0, 0, 100))
+        line = LineString([(50, -10), (50, 110)])
+        self.assertSameParts(polygon, line, 2)
+
+    def test_bent_cut(self):
+        polygon = Polygon(square(0, 0, 100))
+        line = LineString([(-10, 30), (60, 40), (70, 110)])
+        self.assertSameParts(polygon, line, 2)
+
+    def test_two_crossings(self):
+        polygon = Polygon(square(0, 0, 100))
+        line = LineString([(20, -10), (50, 110), (80, -10)])
+        self.assertSameParts(polygon, line, 3)
+
+    def test_line_does_not_cross(self):
+        polygon = Polygon(square(0, 0, 100))
+        line = LineString([(50, -10), (50, 60)])
+        self.assertSameParts(polygon, line, 1)
+
+    def test_coordinates_are_snapped(self):
+        polygon = Polygon([(0, 0), (0, 100.4), (99.6, 100.4), (99.6, 0), (0, 0)])
+        line = LineString([(33.3, -10.2), (66.7, 110.8)])
+        self.assertSameParts(polygon, line, 2)
+
+    def test_cut_through_hole(self):
+        polygon = Polygon(square(0, 0, 100), square(40, 40, 20))
+        line = LineString([(50, -10), (50, 110)])
+        self.assertSameParts(polygon, line, 2)
+
+    def test_cut_beside_hole(self):
+        polygon = Polygon(square(0, 0, 100), square(40, 40, 20))
+        line = LineString([(20, -10), (20, 110)])
+        self.assertSameParts(polygon, line, 2)
+
+    def test_cut_ending_in_hole(self):
+        polygon = Polygon(square(0, 0, 100), square(40, 40, 20))
+        line = LineString([(50, -10), (50, 50)])
+        self.assertSameParts(polygon, line, 1)
+
+    def test_multipart_both_cut(self):
+        polygon = MultiPolygon(Polygon(square(0, 0, 100)), Polygon(square(200, 0, 100)))
+        line = LineString([(-10, 50), (310, 50)])
+        self.assertSameParts(polygon, line, 4)
+
+    def test_multipart_one_cut(self):
+        polygon = MultiPolygon(Polygon(square(0, 0, 100)), Polygon(square(200, 0, 100)))
+        line = LineString([(50, -10), (50, 110)])
+        self.assertSameParts(polygon, line, 3)
+
+    def test_generate_divisions(self):
+        cutlines = [
+            [[-5, 100], [105, 100]],
+            [[50, 95], [50, 210]],
+            [[-5, 40], [40, 60], [105, 20]],
+        ]
+        results = {}
+        for engine in ("geos", "postgis"):
+            divisions = Splitter(image_size=(100, 200)).generate_divisions(cutlines, engine=engine)
+            results[engine] = sorted(round(Polygon(i).area, 6) for i in divisions)
+        self.assertEqual(len(results["geos"]), 4)
+        self.assertEqual(results["geos"], results["postgis"])
+        self.assertAlmostEqual(sum(results["geos"]), 100 * 200)
+
+
+class IIIFSizeTests(SimpleTestCase):
+
+    def test_width_or_height_keeps_aspect(self):
+        self.assertEqual(parse_iiif_size("400,", 2000, 1000), (400, 200))
+        self.assertEqual(parse_iiif_size(",200", 2000, 1000), (400, 200))
+        self.assertEqual(parse_iiif_size("pct:25", 2000, 1000), (500, 250))
+
+    def test_best_fit(self):
+        self.assertEqual(parse_iiif_size("!400,400", 2000, 1000), (400, 200))
+
+    def test_best_fit_needs_both_dimensions(self):
+        for size in ("!512,", "!,512", "!,", ","):
+            with self.assertRaises(IIIFRequestError):
+                parse_iiif_size(size, 2000, 1000)
+
+    def test_limits(self):
+        self.assertEqual(parse_iiif_size("max", 10000, 5000), (4096, 2048))
+        with self.assertRaises(IIIFRequestError):
+            parse_iiif_size("full", 10000, 5000)
+        with self.assertRaises(IIIFRequestError):
+            parse_iiif_size("abc,def", 2000, 1000)
+
+
+class LookupRefreshTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.volume = Volume.objects.create(
+            identifier="sanborn03375_001",
+            city="Plaquemine",
+            state="louisiana",
+            year=1885,
+        )
+        cls.doc = Document.objects.create(title="Plaquemine p1")
+        cls.child = Document.objects.create(title="Plaquemine p1 [1]")
+        cls.layer = Layer.objects.create(title="Plaquemine p1 [1] layer")
+        Sheet.objects.create(volume=cls.volume, doc=cls.doc, sheet_no="1")
+        DocumentLink.objects.create(source=cls.doc, target=cls.child, link_type="split")
+        DocumentLink.objects.create(source=cls.child, target=cls.layer, link_type="georeference")
+
+    def batches(self, callbacks):
+        return [i for i in callbacks if isinstance(i, LookupBatch)]
+
+    def test_item_volumes_are_found_together(self):
+        items = {("document", self.doc.pk), ("document", self.child.pk), ("layer", self.layer.pk)}
+        with self.assertNumQueries(3):
+            volume_ids = get_item_volume_ids(items)
+        self.assertEqual(volume_ids, {i: self.volume.pk for i in items})
+
+    def test_saves_are_coalesced(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            for _ in range(3):
+                self.doc.save()
+            self.layer.save()
+        batches = self.batches(callbacks)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0].items, {("document", self.doc.pk), ("layer", self.layer.pk)})
+
+    def test_deferred_saves_are_queued_on_exit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with defer_lookup_refresh():
+                self.doc.save()
+                with defer_lookup_refresh():
+                    self.child.save()
+                self.assertEqual(self.batches(callbacks), [])
+        self.assertEqual(len(self.batches(callbacks)), 1)
+
+    def test_rollback_discards_items(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            try:
+                with transaction.atomic(), defer_lookup_refresh():
+                    self.doc.save()
+                    raise DatabaseError
+            except DatabaseError:
+                pass
+            self.child.save()
+        batches = self.batches(callbacks)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0].items, {("document", self.child.pk)})
+
+    def test_flush_updates_lookup(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doc.save()
+        self.volume.refresh_from_db()
+        self.assertIn(str(self.doc.pk), self.volume.document_lookup)
@@ -1,4 +1,4 @@
-from django.urls import path
+from django.urls import include, path
 
 from .views import (
     SplitView,
@@ -9,5 +9,6 @@ from .views import (
 urlpatterns = [
     path('split/<int:docid>/', SplitView.as_view(), name="split_view"),
     path('georeference/<int:docid>/', GeoreferenceView.as_view(), name="georeference_view"),
-    path('annotation-set/', AnnotationSetView.as_view(), name="annotation_set_view")
+    path('annotation-set/', AnnotationSetView.as_view(), name="annotation_set_view"),
+    path('', include('ohmg.georeference.iiif.urls')),
 ]
@@ -1,6 +1,5 @@
 import os
 import json
-from datetime import datetime
 import logging
 
 from django.conf import settings
@@ -20,11 +19,11 @@ from ohmg.georeference.models import (
     PrepSession,
     GeorefSession,
     ItemBase,
+    prime_items,
 )
 from ohmg.core.schemas import AnnotationSetSchema
 from ohmg.georeference.georeferencer import Georeferencer
 from ohmg.georeference.splitter import Splitter
-from ohmg.georeference.tasks import delete_preview_vrt
 
 from ohmg.loc_insurancemaps.models import find_volume, Volume
 
@@ -48,6 +47,7 @@ class SplitView(View):
                 user=request.user
             )
             session.start()
+        prime_items([document])
         doc_data = document.serialize()
 
         volume = find_volume(document)
@@ -81,7 +81,7 @@ class SplitView(View):
 
         if operation == "preview":
 
-            s = Splitter(image_file=document.file.path)
+            s = Splitter(image_file=document.file.path, image_size=document.image_size)
             # s = Splitter(image_file=doc_proxy.resource.doc_file.path)
             divisions = s.generate_divisions(cutlines)
             return JsonResponse({"success": True, "divisions": divisions})
@@ -180,6 +180,7 @@ class GeoreferenceView(View):
                 user=request.user
             )
             session.start()
+        prime_items([doc])
         doc_data = doc.serialize()
 
         volume = find_volume(doc)
@@ -229,33 +230,12 @@ class GeoreferenceView(View):
         projection = body.get("projection", "EPSG:3857")
         operation = body.get("operation", "preview")
         sesh_id = body.get("sesh_id", None)
-        cleanup_preview = body.get("cleanup_preview", None)
 
         response = {
             "status": "",
             "message": ""
         }
 
-        def _generate_preview_id(request, sesh_id):
-
-            try:
-                ip_val = request.META.get('REMOTE_ADDR', '0.0.0.0.').replace(".", "-")
-            except Exception as e:
-                logger.warn(e)
-                ip_val = "000000000"
-
-            sesh_val = 0
-            if sesh_id:
-                sesh_val = sesh_id
-
-            return f"{ip_val}-{sesh_val}-{int(datetime.now().timestamp())}"
-
-        def _cleanup_preview(document, previous_url):
-            """ Run this deletion through celery, so that it doesn't delay
-            the return of whatever function called it. """
-            if previous_url:
-                delete_preview_vrt.delay(document.file.path, previous_url)
-
         def _get_georef_session(sesh_id):
 
             try:
@@ -279,16 +259,13 @@ class GeoreferenceView(View):
                 gcps_geojson=gcp_geojson,
                 transformation=transformation,
             )
-            preview_id = _generate_preview_id(request, sesh_id)
             try:
-                out_path = g.warp(document.file.path, return_vrt=True, preview_id=preview_id)
+                out_path = g.warp_preview(document.file.path)
                 out_path_relative = os.path.join(os.path.dirname(document.file.url), os.path.basename(out_path))
                 preview_url = settings.MEDIA_HOST.rstrip("/") + out_path_relative
                 response["status"] = "success"
                 response["message"] = "all good"
                 response["preview_url"] = preview_url
-                # queue clean up of the last preview
-                _cleanup_preview(document, cleanup_preview)
             except Exception as e:
                 logger.error(e)
                 response["status"] = "fail"
@@ -334,7 +311,6 @@ class GeoreferenceView(View):
                 logger.info(f"{sesh.__str__()} | begin run() as task")
                 run_georeference_session.apply_async((sesh.pk,))
                 print('task should be running')
-                _cleanup_preview(document, cleanup_preview)
                 return JsonResponse({
                     "success": True,
                     "message": "all good",
@@ -382,7 +358,6 @@ class GeoreferenceView(View):
 
                 sesh.delete()
 
-            _cleanup_preview(document, cleanup_preview)
             return JsonResponse({"success":True})
 
         else:
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.18 on 2026-10-18 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loc_insurancemaps', '0004_auto_20240116_1016'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VolumeProgress',
+            fields=[
+                ('volume', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='progress', serialize=False, to='loc_insurancemaps.volume')),
+                ('unprepared_ct', models.IntegerField(default=0)),
+                ('prepared_ct', models.IntegerField(default=0)),
+                ('georeferenced_ct', models.IntegerField(default=0)),
+                ('nonmap_ct', models.IntegerField(default=0)),
+                ('processing_ct', models.IntegerField(default=0)),
+                ('layer_ct', models.IntegerField(default=0)),
+                ('percent', models.IntegerField(db_index=True, default=0)),
+                ('main_layer_ct', models.IntegerField(default=0)),
+                ('multimask_ct', models.IntegerField(blank=True, null=True)),
+                ('prep_session_ct', models.IntegerField(default=0)),
+                ('prep_contributor_ct', models.IntegerField(default=0)),
+                ('georef_session_ct', models.IntegerField(default=0)),
+                ('georef_contributor_ct', models.IntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Volume progress',
+            },
+        ),
+    ]
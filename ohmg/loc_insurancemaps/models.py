@@ -12,7 +12,8 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.gis.geos import Polygon, MultiPolygon
 from django.core.files import File
-from django.db import transaction
+from django.db import connections
+from django.db.models import Count
 from django.contrib.gis.db import models
 from django.utils.safestring import mark_safe
 from django.utils.functional import cached_property
@@ -21,15 +22,17 @@ from django.urls import reverse
 from ohmg.georeference.models import (
     Document,
     Layer,
+    prime_documents,
     PrepSession,
     GeorefSession,
     SetCategory,
     AnnotationSet,
 )
 from ohmg.georeference.storage import OverwriteStorage
-from ohmg.places.models import Place
+from ohmg.places.models import Place, update_volume_counts
 from ohmg.core.utils import (
-    get_jpg_from_jp2_url,
+    get_document_from_jp2_url,
+    get_documents_from_jp2_urls,
     STATE_CHOICES,
     STATE_ABBREV,
     MONTH_CHOICES,
@@ -90,7 +93,11 @@ class Sheet(models.Model):
     def __str__(self):
         return f"{self.volume.__str__()} p{self.sheet_no}"
 
-    def load_doc(self, user=None):
+    def load_doc(self, user=None, file_path=None):
+        """Create (or get) the Document for this sheet, and load its file. A
+        file that has already been downloaded and converted can be passed in
+        with file_path (see Volume.load_sheet_docs), otherwise it is fetched
+        from the jp2_url here."""
 
         log_prefix = f"{self.volume} p{self.sheet_no} |"
         logger.info(f"{log_prefix} start load")
@@ -112,10 +119,18 @@ class Sheet(models.Model):
         self.save()
 
         if not self.doc.file:
-            jpg_path = get_jpg_from_jp2_url(self.jp2_url)
-            with open(jpg_path, "rb") as new_file:
-                self.doc.file.save(f"{self.doc.slug}.jpg", File(new_file))
-            os.remove(jpg_path)
+            # stored as jpg or tif, depending on settings.DOCUMENT_SOURCE_FORMAT
+            if file_path is None:
+                file_path = get_document_from_jp2_url(self.jp2_url)
+            if file_path is None:
+                logger.warn(f"{log_prefix} unable to get file - cancelling load")
+                return
+            ext = os.path.splitext(file_path)[1]
+            with open(file_path, "rb") as new_file:
+                self.doc.file.save(f"{self.doc.slug}{ext}", File(new_file), save=False)
+            os.remove(file_path)
+            # a new upload, so store the checksum along with the dimensions
+            self.doc.set_file_metadata()
 
         month = 1 if self.volume.month is None else int(self.volume.month)
         date = datetime(self.volume.year, month, 1, 12, 0)
@@ -153,6 +168,70 @@ class Sheet(models.Model):
             "doc_id": self.doc.pk,
         }
 
+class VolumeProgress(models.Model):
+    """Denormalized progress counts for a Volume, kept up-to-date whenever
+    its lookups change, so that listing progress for many volumes is a
+    single query rather than a scan of every document_lookup."""
+
+    volume = models.OneToOneField(
+        "Volume",
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="progress",
+    )
+    unprepared_ct = models.IntegerField(default=0)
+    prepared_ct = models.IntegerField(default=0)
+    georeferenced_ct = models.IntegerField(default=0)
+    nonmap_ct = models.IntegerField(default=0)
+    processing_ct = models.IntegerField(default=0)
+    layer_ct = models.IntegerField(default=0)
+    percent = models.IntegerField(default=0, db_index=True)
+    main_layer_ct = models.IntegerField(default=0)
+    # null if the main-content set has no multimask at all
+    multimask_ct = models.IntegerField(null=True, blank=True)
+    prep_session_ct = models.IntegerField(default=0)
+    prep_contributor_ct = models.IntegerField(default=0)
+    georef_session_ct = models.IntegerField(default=0)
+    georef_contributor_ct = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Volume progress"
+
+    def __str__(self):
+        return str(self.volume_id)
+
+    def as_progress(self):
+        return {
+            "unprep_ct": self.unprepared_ct,
+            "prep_ct": self.prepared_ct,
+            "georef_ct": self.georeferenced_ct,
+            "percent": self.percent,
+        }
+
+    def as_stats(self):
+        mm_todo, mm_percent = 0, 0
+        if self.main_layer_ct != 0:
+            # make sure 0/0 appears at the very bottom, then 0/1, 0/2, etc.
+            mm_percent = self.main_layer_ct * .000001
+        mm_display = f"0/{self.main_layer_ct}"
+        if self.multimask_ct is not None:
+            mm_todo = self.main_layer_ct - self.multimask_ct
+            if self.multimask_ct > 0 and self.main_layer_ct > 0:
+                mm_display = f"{self.multimask_ct}/{self.main_layer_ct}"
+                mm_percent = self.multimask_ct / self.main_layer_ct
+                mm_percent += self.main_layer_ct * .000001
+
+        return {
+            "unprepared_ct": self.unprepared_ct,
+            "prepared_ct": self.prepared_ct,
+            "georeferenced_ct": self.georeferenced_ct,
+            "percent": self.percent,
+            "mm_ct": mm_todo,
+            "mm_display": mm_display,
+            "mm_percent": mm_percent,
+        }
+
 def default_ordered_layers_dict():
     return {"layers": [], "index_layers": []}
 
@@ -298,40 +377,68 @@ class Volume(models.Model):
 
     @property
     def stats(self):
-        items = self.sort_lookups()
-        unprep_ct = len(items['unprepared'])
-        prep_ct = len(items['prepared'])
-        georef_ct = len(items['georeferenced'])
-        percent = 0
-        if georef_ct > 0:
-            percent = int((georef_ct / (unprep_ct + prep_ct + georef_ct)) * 100)
-
-        main_lyrs_ct = 0
-        main_anno = self.get_annotation_set('main-content')
-        if main_anno.annotations:
-            main_lyrs_ct = len(main_anno.annotations)
-        mm_ct, mm_todo, mm_percent = 0, 0, 0
-        if main_lyrs_ct != 0:
-            # make sure 0/0 appears at the very bottom, then 0/1, 0/2, etc.
-            mm_percent = main_lyrs_ct * .000001
-        mm_display = f"0/{main_lyrs_ct}"
-        if main_anno.multimask is not None:
-            mm_ct = len(main_anno.multimask)
-            mm_todo = main_lyrs_ct - mm_ct
-            if mm_ct > 0 and main_lyrs_ct > 0:
-                mm_display = f"{mm_ct}/{main_lyrs_ct}"
-                mm_percent = mm_ct / main_lyrs_ct
-                mm_percent += main_lyrs_ct * .000001
+        return self.get_progress().as_stats()
 
-        return {
-            "unprepared_ct": unprep_ct,
-            "prepared_ct": prep_ct,
-            "georeferenced_ct": georef_ct,
-            "percent": percent,
-            "mm_ct": mm_todo,
-            "mm_display": mm_display,
-            "mm_percent": mm_percent,
-        }
+    def get_progress(self):
+        """Return the VolumeProgress for this volume. This is called while
+        serving GET requests, so if the row doesn't exist yet (e.g. it hasn't
+        been backfilled with `volume refresh-progress`) the counts are
+        calculated but not saved."""
+        try:
+            return self.progress
+        except VolumeProgress.DoesNotExist:
+            return self.update_progress(save=False)
+
+    def update_progress(self, save=True):
+        """Recalculate and save the denormalized progress counts for this
+        volume. Document and layer counts come from the lookups (which are
+        already up-to-date whenever this is called), while session and
+        multimask counts are aggregated in the database. With save=False
+        the counts are returned on an unsaved VolumeProgress."""
+
+        try:
+            progress = VolumeProgress.objects.get(volume=self)
+        except VolumeProgress.DoesNotExist:
+            progress = VolumeProgress(volume=self)
+
+        status_cts = {}
+        for v in self.document_lookup.values():
+            status_cts[v['status']] = status_cts.get(v['status'], 0) + 1
+        progress.unprepared_ct = status_cts.get("unprepared", 0) + status_cts.get("splitting", 0)
+        progress.prepared_ct = status_cts.get("prepared", 0) + status_cts.get("georeferencing", 0)
+        progress.georeferenced_ct = sum([status_cts.get(i, 0) for i in ["georeferenced", "trimming", "trimmed"]])
+        progress.nonmap_ct = status_cts.get("nonmap", 0)
+        progress.processing_ct = sum([status_cts.get(i, 0) for i in ["splitting", "georeferencing", "trimming"]])
+        progress.layer_ct = len(self.layer_lookup)
+
+        total = progress.unprepared_ct + progress.prepared_ct + progress.georeferenced_ct
+        progress.percent = int((progress.georeferenced_ct / total) * 100) if progress.georeferenced_ct > 0 else 0
+
+        main_anno = self.get_annotation_set('main-content')
+        if main_anno:
+            progress.main_layer_ct = main_anno.annotations.count()
+            progress.multimask_ct = len(main_anno.multimask) if main_anno.multimask is not None else None
+        else:
+            progress.main_layer_ct, progress.multimask_ct = 0, None
+
+        doc_ids = self.get_session_doc_ids()
+        prep_sessions = PrepSession.objects.filter(doc_id__in=doc_ids)
+        georef_sessions = GeorefSession.objects.filter(doc_id__in=doc_ids)
+        progress.prep_session_ct = prep_sessions.count()
+        progress.prep_contributor_ct = prep_sessions.values("user").distinct().count()
+        progress.georef_session_ct = georef_sessions.count()
+        progress.georef_contributor_ct = georef_sessions.values("user").distinct().count()
+
+        if save:
+            progress.save()
+            self.progress = progress
+        return progress
+
+    def get_session_doc_ids(self):
+        """Return ids of all documents in this volume that may have sessions:
+        the sheet documents plus all documents in the lookup."""
+        sheet_doc_ids = Sheet.objects.filter(volume=self).exclude(doc=None).values_list("doc_id", flat=True)
+        return set(sheet_doc_ids) | set([int(i) for i in self.document_lookup.keys()])
 
     def get_locale(self, serialized=False):
         """ Returns the first locale in the list of related locales.
@@ -398,13 +505,34 @@ class Volume(models.Model):
             sheet.lc_iiif_service = parsed.iiif_service
             sheet.save()
 
-    def load_sheet_docs(self, force_reload=False):
+    def load_sheet_docs(self, force_reload=False, convert_workers=None, use_processes=False):
+        """Create a document for each sheet that doesn't have one yet. Files
+        are converted in threads, use_processes=True converts them in a
+        process pool instead (not possible within a Celery task)."""
 
         self.make_sheets()
         self.update_status("initializing...")
-        for sheet in self.sheets:
-            if sheet.doc is None or sheet.doc.file is None or force_reload:
-                sheet.load_doc(self.loaded_by)
+        sheets = [i for i in self.sheets if i.doc is None or i.doc.file is None or force_reload]
+
+        # fetch all of the files that are needed at once, then create the
+        # documents (which hits the database) one at a time
+        jp2_urls = [i.jp2_url for i in sheets if i.jp2_url and (i.doc is None or not i.doc.file)]
+        file_paths = {}
+        if jp2_urls:
+            if use_processes:
+                # db connections must not be shared with forked workers
+                connections.close_all()
+            file_paths = get_documents_from_jp2_urls(
+                jp2_urls,
+                convert_workers=convert_workers,
+                use_processes=use_processes,
+            )
+
+        for sheet in sheets:
+            if sheet.jp2_url in file_paths and file_paths[sheet.jp2_url] is None:
+                logger.warn(f"{self} p{sheet.sheet_no} | download failed, skipping")
+                continue
+            sheet.load_doc(self.loaded_by, file_path=file_paths.get(sheet.jp2_url))
         self.update_status("ready")
         self.refresh_lookups()
 
@@ -419,21 +547,9 @@ class Volume(models.Model):
         logger.info(f"{self.__str__()} | status: {self.status}")
 
     def update_place_counts(self):
-
-        locale = self.get_locale()
-        if locale is not None:
-            with transaction.atomic():
-                locale.volume_count += 1
-                locale.volume_count_inclusive += 1
-                locale.save(update_fields=["volume_count", "volume_count_inclusive"])
-                parents = locale.direct_parents.all()
-                while parents:
-                    new_parents = []
-                    for p in parents:
-                        p.volume_count_inclusive += 1
-                        p.save(update_fields=["volume_count_inclusive"])
-                        new_parents += list(p.direct_parents.all())
-                    parents = new_parents
+        """Recount volumes for this volume's locale and all of its ancestors,
+        see ohmg.places.models.update_volume_counts."""
+        update_volume_counts([self.pk])
 
     def get_all_docs(self):
         all_documents = []
@@ -466,24 +582,36 @@ class Volume(models.Model):
         """Clean and remake document_lookup and layer_lookup fields
         for this Volume by examining the original loaded Sheets and
         re-evaluating every descendant Document and Layer.
+
+        All related objects are loaded up front in a constant number of
+        queries (see prime_documents), and the lookups are written once.
         """
 
-        if len(self.document_lookup) > 0 or len(self.layer_lookup) > 0:
-            self.document_lookup = {}
-            self.layer_lookup = {}
-            self.save(update_fields=["document_lookup", "layer_lookup"])
+        sheets = Sheet.objects.filter(volume=self).exclude(doc=None).select_related("doc").order_by("sheet_no")
+        documents, layers = prime_documents([i.doc for i in sheets])
+
+        self.document_lookup = {}
+        self.layer_lookup = {}
+        for document in documents:
+            self.update_doc_lookup(document, save=False)
+        for layer in layers:
+            self.update_lyr_lookup(layer, save=False)
 
-        for document in self.get_all_docs():
-            self.update_doc_lookup(document, update_layer=True)
+        self.set_extent(save=False)
+        self.save(update_fields=["document_lookup", "layer_lookup", "extent"])
+        self.update_progress()
 
-    def update_doc_lookup(self, document, update_layer=False):
+    def update_doc_lookup(self, document, update_layer=False, save=True):
         """Serialize the input document, and save it into
         this volume's lookup table. If an int is passed, it will be used
         as a primary key lookup.
 
         If update_layer=True, also trigger the update of the layer
         lookup for the georeference layer from this document
-        (if applicable)."""
+        (if applicable).
+
+        Use save=False to only update the lookup in memory, leaving the
+        save (and progress update) to the caller."""
 
         if isinstance(document, Document):
             data = document.serialize(serialize_layer=False, include_sessions=True)
@@ -500,14 +628,18 @@ class Volume(models.Model):
             data["page_str"] = data['title']
 
         self.document_lookup[data['id']] = data
-        self.save(update_fields=["document_lookup"])
+        if save:
+            self.save(update_fields=["document_lookup"])
+            self.update_progress()
 
         if update_layer is True and data['layer']:
-            self.update_lyr_lookup(data['layer'])
+            self.update_lyr_lookup(data['layer'], save=save)
 
-    def update_lyr_lookup(self, layer):
+    def update_lyr_lookup(self, layer, save=True):
         """Serialize the input layer id (pk), and save it into
-        this volume's lookup table."""
+        this volume's lookup table. Use save=False to only update the
+        lookup in memory, leaving the save (and extent and progress
+        updates) to the caller."""
 
         if isinstance(layer, Layer):
             data = layer.serialize(serialize_document=False, include_sessions=True)
@@ -544,11 +676,12 @@ class Volume(models.Model):
             data['sort_order'] = 0
 
         self.layer_lookup[data['slug']] = data
-        self.save(update_fields=["layer_lookup"])
-
-        self.set_extent()
+        if save:
+            self.save(update_fields=["layer_lookup"])
+            self.update_progress()
+            self.set_extent()
 
-    def set_extent(self):
+    def set_extent(self, save=True):
         # calculate extent from all of the layer extents.
         # perhaps would be better to get this from the Place once that
         # those attributes have been added to those instances.
@@ -561,7 +694,8 @@ class Volume(models.Model):
         if len(layer_extent_polygons) > 0:
             multi = MultiPolygon(layer_extent_polygons)
             self.extent = Polygon.from_bbox(multi.extent)
-            self.save(update_fields=['extent'])
+            if save:
+                self.save(update_fields=['extent'])
 
     def sort_lookups(self):
 
@@ -604,28 +738,22 @@ class Volume(models.Model):
 
     def get_user_activity_summary(self):
 
-        def _get_session_user_summary(session_dict):
-            users = [i['user']['name'] for i in session_dict.values()]
-            user_info = [{
-                "ct": users.count(i),
-                "name": i,
-                "profile": reverse('profile_detail', args=(i, ))
-            } for i in set(users)]
-            user_info.sort(key=lambda item: item.get("ct"), reverse=True)
-            return user_info
-
-        prep_sessions, georef_sessions = {}, {}
-        for item in list(self.document_lookup.values()) + list(self.layer_lookup.values()):
-            for sesh in item['session_data']:
-                if sesh['type'] == "Preparation":
-                    prep_sessions[sesh['id']] = sesh
-                elif sesh['type'] == "Georeference":
-                    georef_sessions[sesh['id']] = sesh
+        def _get_session_user_summary(sessions):
+            user_cts = sessions.values("user__username").annotate(ct=Count("pk")).order_by("-ct")
+            return [{
+                "ct": i["ct"],
+                "name": i["user__username"],
+                "profile": reverse('profile_detail', args=(i["user__username"], ))
+            } for i in user_cts]
+
+        doc_ids = self.get_session_doc_ids()
+        prep_sessions = PrepSession.objects.filter(doc_id__in=doc_ids)
+        georef_sessions = GeorefSession.objects.filter(doc_id__in=doc_ids)
 
         return {
-            'prep_ct': len(prep_sessions),
+            'prep_ct': prep_sessions.count(),
             'prep_contributors': _get_session_user_summary(prep_sessions),
-            'georef_ct': len(georef_sessions),
+            'georef_ct': georef_sessions.count(),
             'georef_contributors': _get_session_user_summary(georef_sessions),
         }
 
@@ -640,13 +768,7 @@ class Volume(models.Model):
 
         # now sort all of the lookups (by status) into a single set of items
         items = self.sort_lookups()
-
-        unprep_ct = len(items['unprepared'])
-        prep_ct = len(items['prepared'])
-        georef_ct = len(items['georeferenced'])
-        percent = 0
-        if georef_ct > 0:
-            percent = int((georef_ct / (unprep_ct + prep_ct + georef_ct)) * 100)
+        progress = self.get_progress()
 
         # generate extra links and info for the user that loaded the volume
         loaded_by = {"name": "", "profile": "", "date": ""}
@@ -665,12 +787,7 @@ class Volume(models.Model):
                 "total": self.sheet_ct,
                 "loaded": len([i for i in self.sheets if i.doc is not None]),
             },
-            "progress": {
-                "unprep_ct": unprep_ct,
-                "prep_ct": prep_ct,
-                "georef_ct": georef_ct,
-                "percent": percent,
-            },
+            "progress": progress.as_progress(),
             "items": items,
             "loaded_by": loaded_by,
             "urls": self.get_urls(),
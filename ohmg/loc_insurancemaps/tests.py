@@ -1,3 +1,41 @@
-from django.test import TestCase # noqa: F401
+from django.test import TestCase
 
-# Create your tests here.
+from ohmg.loc_insurancemaps.models import Volume, VolumeProgress
+
+
+class VolumeProgressTests(TestCase):
+
+    def setUp(self):
+        self.volume = Volume.objects.create(
+            identifier="sanborn03375_001",
+            city="Plaquemine",
+            state="louisiana",
+            year=1885,
+            document_lookup={
+                "1": {"status": "unprepared"},
+                "2": {"status": "prepared"},
+                "3": {"status": "georeferenced"},
+                "4": {"status": "trimmed"},
+            },
+        )
+
+    def test_get_progress_does_not_save(self):
+        progress = self.volume.get_progress()
+        self.assertEqual(progress.as_progress(), {
+            "unprep_ct": 1,
+            "prep_ct": 1,
+            "georef_ct": 2,
+            "percent": 50,
+        })
+        self.assertFalse(VolumeProgress.objects.filter(volume=self.volume).exists())
+
+    def test_update_progress_saves(self):
+        self.volume.update_progress()
+        progress = VolumeProgress.objects.get(volume=self.volume)
+        self.assertEqual(progress.georeferenced_ct, 2)
+
+        self.volume.document_lookup["1"]["status"] = "georeferenced"
+        self.volume.update_progress()
+        progress.refresh_from_db()
+        self.assertEqual(progress.georeferenced_ct, 3)
+        self.assertEqual(Volume.objects.get(pk=self.volume.pk).get_progress().percent, 75)
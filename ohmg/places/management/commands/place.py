@@ -5,7 +5,12 @@ from pathlib import Path
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
-from ohmg.places.models import Place
+from ohmg.places.models import (
+    Place,
+    PlaceAncestry,
+    defer_place_refresh,
+    refresh_place_ancestry,
+)
 from ohmg.places.management.utils import reset_volume_counts
 
 logger = logging.getLogger(__name__)
@@ -20,6 +25,8 @@ class Command(BaseCommand):
                 "create",
                 "import-all",
                 "reset-volume-counts",
+                "refresh-ancestry",
+                "prewarm-cache",
             ],
             help="Name of the new Place.",
         )
@@ -66,6 +73,13 @@ class Command(BaseCommand):
         elif options['operation'] == "reset-volume-counts":
             self.reset_all_counts()
 
+        elif options['operation'] == "refresh-ancestry":
+            ct = refresh_place_ancestry()
+            print(f"done, {ct} ancestry rows created")
+
+        elif options['operation'] == "prewarm-cache":
+            self.prewarm_cache()
+
     def create_new_place(self, name, parent_slug, category):
 
         parent = Place.objects.get(slug=parent_slug)
@@ -75,6 +89,8 @@ class Command(BaseCommand):
             category=category,
         )
         place.save(set_slug=False)
+        # adding the parent refreshes the place's ancestry (see receivers), which
+        # must be in place before the slug is made from the state
         place.direct_parents.add(parent)
         place.save()
         print(place)
@@ -82,7 +98,6 @@ class Command(BaseCommand):
     def import_all_places(self):
 
         datadir = Path(Path(__file__).parent.parent.parent, "reference_data")
-        Place.objects.all().delete()
         def load_place_csv(filepath):
             print(filepath)
             with open(filepath, "r") as op:
@@ -92,17 +107,53 @@ class Command(BaseCommand):
                         parents = row.pop("direct_parents")
                         if n % 100 == 0:
                             print(n)
-                        p = Place.objects.create(**row)
+                        # slugs need the ancestry, so they are set below
+                        p = Place(**row)
+                        p.save(set_slug=False)
                         if parents:
                             for parent in parents.split(","):
                                 p.direct_parents.add(parent)
-                        p.save(set_slug=True)
 
-        load_place_csv(Path(datadir, "place_countries.csv"))
-        load_place_csv(Path(datadir, "place_states.csv"))
-        load_place_csv(Path(datadir, "place_counties.csv"))
-        load_place_csv(Path(datadir, "place_other.csv"))
+        # build the PlaceAncestry table and clear the places cache once,
+        # instead of after every place
+        with defer_place_refresh():
+            Place.objects.all().delete()
+            load_place_csv(Path(datadir, "place_countries.csv"))
+            load_place_csv(Path(datadir, "place_states.csv"))
+            load_place_csv(Path(datadir, "place_counties.csv"))
+            load_place_csv(Path(datadir, "place_other.csv"))
+
+        print("setting slugs")
+        self.set_all_slugs()
+
+    def set_all_slugs(self):
+        """Set every place's slug from its state, with one query for all of
+        the states and one bulk update."""
+
+        state_lookup = {}
+        links = PlaceAncestry.objects.filter(
+            ancestor__category="state",
+        ).select_related("ancestor").order_by("descendant_id", "ancestor_id")
+        for link in links:
+            state_lookup.setdefault(link.descendant_id, link.ancestor)
+
+        places = list(Place.objects.all())
+        for place in places:
+            place.set_slug(state=state_lookup.get(place.pk))
+        with transaction.atomic():
+            Place.objects.bulk_update(places, ["slug", "display_name"], batch_size=1000)
 
     def reset_all_counts(self):
 
         reset_volume_counts(verbose=True)
+
+    def prewarm_cache(self):
+
+        places = Place.objects.filter(volume_count_inclusive__gt=0).order_by("pk")
+        total = places.count()
+        print(f"caching {total} places")
+        for n, place in enumerate(places, start=1):
+            place.serialize_cached(refresh=True)
+            if n % 100 == 0:
+                print(f"{n}/{total}")
+        print("done")
@@ -1,15 +1,9 @@
-from ohmg.loc_insurancemaps.models import Volume
-from ohmg.places.models import Place
+from ohmg.places.models import update_volume_counts
 
 def reset_volume_counts(verbose=False):
 
     if verbose:
-        print("set all Place volume counts to 0")
-    Place.objects.all().update(volume_count=0, volume_count_inclusive=0)
+        print("recalculating all Place volume counts")
+    updated = update_volume_counts()
     if verbose:
-        print("done")
-
-    for volume in Volume.objects.all():
-        if verbose:
-            print(volume)
-        volume.update_place_counts()
+        print(f"done, {updated} places updated")
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.18 on 2026-10-18 16:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('places', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaceAncestry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField(help_text='Number of steps from the descendant up to the ancestor (shortest path)')),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='places.place')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='places.place')),
+            ],
+            options={
+                'verbose_name_plural': 'Place ancestries',
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='placeancestry',
+            index=models.Index(fields=['ancestor', 'depth'], name='places_plac_ancesto_5d2c1e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='placeancestry',
+            index=models.Index(fields=['descendant', 'depth'], name='places_plac_descend_8a41f7_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+# same query as ohmg.places.models.refresh_place_ancestry(), with the table
+# names fixed as they are at this migration
+FILL_SQL = """
+DELETE FROM places_placeancestry;
+WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+    SELECT id, id, 0 FROM places_place
+    UNION
+    SELECT pp.to_place_id, c.descendant_id, c.depth + 1
+    FROM closure c
+    JOIN places_place_direct_parents pp ON pp.from_place_id = c.ancestor_id
+    WHERE c.depth < 20
+)
+INSERT INTO places_placeancestry (ancestor_id, descendant_id, depth)
+SELECT ancestor_id, descendant_id, MIN(depth)
+FROM closure
+GROUP BY ancestor_id, descendant_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('places', '0002_placeancestry'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            FILL_SQL,
+            reverse_sql="DELETE FROM places_placeancestry;",
+        ),
+    ]
@@ -1,5 +1,9 @@
 import logging
-from django.db import models
+import threading
+from contextlib import contextmanager
+
+from django.core.cache import caches
+from django.db import connection, models, transaction
 
 from ohmg.core.utils import slugify
 from ohmg.core.utils import (
@@ -70,18 +74,12 @@ class Place(models.Model):
 
     @property
     def states(self):
-        candidates = [self]
-        states = []
-        while candidates:
-            new_candidates = []
-            for p in candidates:
-                if p.category == "state":
-                    states.append(p)
-                else:
-                    for i in p.direct_parents.all():
-                        new_candidates.append(i)
-            candidates = new_candidates
-        return list(set(states))
+        if self.category == "state":
+            return [self]
+        return list(Place.objects.filter(
+            category="state",
+            descendant_links__descendant_id=self.pk,
+        ).distinct())
 
     def get_volumes(self):
         from ohmg.loc_insurancemaps.models import Volume
@@ -102,24 +100,42 @@ class Place(models.Model):
     def get_descendants(self):
         return Place.objects.filter(direct_parents__id__exact=self.id).order_by("name")
 
-    def get_breadcrumbs(self):
+    def get_lineage(self):
+        """Returns the list of places from the top of the hierarchy down to
+        this place, following the first parent of each place. This is one
+        query against PlaceAncestry, with each ancestor's first parent
+        annotated onto it."""
+
+        first_parent = Place.direct_parents.through.objects.filter(
+            from_place_id=models.OuterRef("pk"),
+        ).order_by("id").values("to_place_id")[:1]
+        # the closure includes this place itself, at depth 0
+        places = Place.objects.filter(
+            descendant_links__descendant_id=self.pk,
+        ).annotate(first_parent_id=models.Subquery(first_parent))
+        lookup = {i.pk: i for i in places}
+
+        lineage = [self]
+        parent_id = lookup[self.pk].first_parent_id if self.pk in lookup else None
+        while parent_id in lookup and len(lineage) < len(lookup):
+            parent = lookup[parent_id]
+            lineage.append(parent)
+            parent_id = parent.first_parent_id
+        lineage.reverse()
+        return lineage
+
+    def get_breadcrumbs(self, lineage=None):
+        if lineage is None:
+            lineage = self.get_lineage()
         breadcrumbs = []
-        p = self
-        while p.direct_parents.all().count() > 0:
-            parent = p.direct_parents.all()[0]
-            par_name = parent.name
-            if parent.category in ("county", "parish", "borough", "census area"):
-                par_name += f" {parent.get_category_display()}"
-            breadcrumbs.append({"name": par_name, "slug": parent.slug})
-            p = parent
-        breadcrumbs.reverse()
-        name = self.name
-        if self.category in ("county", "parish", "borough", "census area"):
-            name += f" {self.get_category_display()}"
-        breadcrumbs.append({"name": name, "slug": self.slug})
+        for p in lineage:
+            name = p.name
+            if p.category in ("county", "parish", "borough", "census area"):
+                name += f" {p.get_category_display()}"
+            breadcrumbs.append({"name": name, "slug": p.slug})
         return breadcrumbs
     
-    def get_select_lists(self):
+    def get_select_lists(self, lineage=None):
         """
         Returns a dictionary with 4 levels of lists, these are used to populate
         select dropdowns. Each list has both a list of options and also a current
@@ -182,35 +198,36 @@ class Place(models.Model):
             },
         }
 
-        # take the requested place, and prefill list selections based on its breadcrumbs
-        for n, i in enumerate(self.get_breadcrumbs(), start=1):
-            lists[n]['selected'] = i['slug']
-        
-        # at this point, at least a country will be selected, get its pk
-        top_pk = Place.objects.get(slug=lists[1]["selected"]).pk
+        # take the requested place, and prefill list selections based on its lineage
+        if lineage is None:
+            lineage = self.get_lineage()
+        selected_pks = {}
+        for n, p in enumerate(lineage, start=1):
+            lists[n]['selected'] = p.slug
+            selected_pks[n] = p.pk
+
+        fields = ("pk", "slug", "display_name", "volume_count_inclusive")
 
         # always give all of the country options
-        all_lvl1 = list(Place.objects.filter(direct_parents=None).values("pk", "slug", "display_name", "volume_count_inclusive"))
+        all_lvl1 = list(Place.objects.filter(direct_parents=None).values(*fields))
         lists[1]["options"] = all_lvl1
 
         # set level 2 (state) options to only those in this country
-        all_lvl2 = list(Place.objects.filter(direct_parents=top_pk).values("pk", "slug", "display_name", "volume_count_inclusive"))
+        all_lvl2 = list(Place.objects.filter(direct_parents=selected_pks[1]).values(*fields))
         lists[2]["options"] = all_lvl2
 
         # if a state is selected, set options to all other states in the same country
         # also, set county/parish and city options for everything within the state
-        if lists[2]['selected'] != "---":
-            state_pk = Place.objects.get(slug=lists[2]["selected"]).pk
-            all_lvl3 = list(Place.objects.filter(direct_parents=state_pk).values("pk", "slug", "display_name", "volume_count_inclusive"))
+        if 2 in selected_pks:
+            all_lvl3 = list(Place.objects.filter(direct_parents=selected_pks[2]).values(*fields))
             lists[3]["options"] = all_lvl3
-            lvl3_pks = [i['pk'] for i in all_lvl3]
-            all_lvl4 = list(Place.objects.filter(direct_parents__in=lvl3_pks).values("pk", "slug", "display_name", "volume_count_inclusive"))
-            lists[4]["options"] = all_lvl4
 
-        # if a county/parish is selected, narrow cities to only those in the county
-        if lists[3]['selected'] != "---":
-            ce_pk = Place.objects.get(slug=lists[3]["selected"]).pk
-            all_lvl4 = list(Place.objects.filter(direct_parents=ce_pk).values("pk", "slug", "display_name", "volume_count_inclusive"))
+            # if a county/parish is selected, narrow cities to only those in the county
+            if 3 in selected_pks:
+                all_lvl4 = list(Place.objects.filter(direct_parents=selected_pks[3]).values(*fields))
+            else:
+                lvl3_pks = [i['pk'] for i in all_lvl3]
+                all_lvl4 = list(Place.objects.filter(direct_parents__in=lvl3_pks).values(*fields))
             lists[4]["options"] = all_lvl4
 
         for k, v in lists.items():
@@ -219,17 +236,16 @@ class Place(models.Model):
         return lists
 
     def get_inclusive_pks(self):
-        pks = [self.pk]
-        descendants = Place.objects.filter(direct_parents__id__exact=self.id)
-        while descendants:
-            pks += [i.pk for i in descendants]
-            new_descendants = []
-            for d in descendants:
-                new_descendants += [i for i in Place.objects.filter(direct_parents__id__exact=d.pk)]
-            descendants = new_descendants
+        """Returns the pks of this place and all of its descendants."""
+        pks = list(PlaceAncestry.objects.filter(
+            ancestor_id=self.pk,
+        ).values_list("descendant_id", flat=True))
+        if self.pk not in pks:
+            pks.insert(0, self.pk)
         return pks
 
     def serialize(self):
+        lineage = self.get_lineage()
         return {
             "pk": self.pk,
             "name": self.name,
@@ -251,8 +267,8 @@ class Place(models.Model):
                 "slug": i.slug,
             } for i in self.states],
             "slug": self.slug,
-            "breadcrumbs": self.get_breadcrumbs(),
-            "select_lists": self.get_select_lists(),
+            "breadcrumbs": self.get_breadcrumbs(lineage=lineage),
+            "select_lists": self.get_select_lists(lineage=lineage),
             "volume_count": self.volume_count,
             "volume_count_inclusive": self.volume_count_inclusive,
             "volumes": [{
@@ -262,30 +278,276 @@ class Place(models.Model):
             } for i in self.get_volumes().values_list("identifier", "year", "volume_no")],
         }
 
-    def save(self, set_slug=True, *args, **kwargs):
-        if set_slug is True:
-            state_postal = self.get_state_postal()
-            state_abbrev = self.get_state_abbrev()
-            slug, display_name = "", ""
-            if self.category == "state":
-                slug = slugify(self.name)
-                display_name = self.name
+    def serialize_cached(self, refresh=False):
+        """Returns the output of serialize() from the places cache, generating
+        and storing it if it's missing, expired, or refresh=True. Entries are
+        invalidated all at once by invalidate_place_cache()."""
+
+        cache = caches["places"]
+        key = f"place-{self.pk}"
+        data = None if refresh else cache.get(key)
+        if data is None:
+            data = self.serialize()
+            cache.set(key, data)
+        return data
+
+    def set_slug(self, state=False):
+        """Set the slug and display name from the name, category, and state.
+        Pass state to skip looking it up, e.g. during a bulk load."""
+        if state is False:
+            state = self.state
+        state_postal, state_abbrev = None, None
+        if state and state.name.lower() in STATE_POSTAL:
+            state_postal = STATE_POSTAL[state.name.lower()]
+        if state and state.name.lower() in STATE_ABBREV:
+            state_abbrev = STATE_ABBREV[state.name.lower()]
+        slug, display_name = "", ""
+        if self.category == "state":
+            slug = slugify(self.name)
+            display_name = self.name
+        else:
+            if self.category in ["county", "parish", "borough" "census area"]:
+                slug = slugify(f"{self.name}-{self.category}")
+                display_name = f"{self.name} {self.get_category_display()}"
             else:
-                if self.category in ["county", "parish", "borough" "census area"]:
-                    slug = slugify(f"{self.name}-{self.category}")
-                    display_name = f"{self.name} {self.get_category_display()}"
-                else:
-                    slug = slugify(self.name)
-                    display_name = self.name
-                if state_postal is not None:
-                    slug += f"-{state_postal}"
-                if state_abbrev is not None:
-                    display_name += f", {state_abbrev}"
-            if not slug:
                 slug = slugify(self.name)
-            if not display_name:
                 display_name = self.name
-            self.slug = slug
-            self.display_name = display_name
+            if state_postal is not None:
+                slug += f"-{state_postal}"
+            if state_abbrev is not None:
+                display_name += f", {state_abbrev}"
+        if not slug:
+            slug = slugify(self.name)
+        if not display_name:
+            display_name = self.name
+        self.slug = slug
+        self.display_name = display_name
+
+    def save(self, set_slug=True, *args, **kwargs):
+        if set_slug is True:
+            self.set_slug()
         super(Place, self).save(*args, **kwargs)
 
+def invalidate_place_cache():
+    """Expire all cached Place payloads. The cache is cleared outright, rather
+    than moved to a new key version, so stale payloads don't pile up on disk
+    (the file based backend lists every entry on each write)."""
+
+    caches["places"].clear()
+
+def get_viewer_volume_key(volume_id):
+    """Cache key for a volume's payload in the viewer (see
+    ohmg.frontend.views.Viewer), stored in the places cache so it is also
+    expired by invalidate_place_cache()."""
+    return f"viewer-volume-{volume_id}"
+
+def invalidate_viewer_volume(volume_id):
+    """Expire the cached viewer payload for a single volume."""
+    caches["places"].delete(get_viewer_volume_key(volume_id))
+
+_deferred = threading.local()
+
+def place_refresh_deferred():
+    """True while within a defer_place_refresh() block in this thread."""
+    return getattr(_deferred, "depth", 0) > 0
+
+@contextmanager
+def defer_place_refresh():
+    """Skip the ancestry refresh and cache invalidation that the receivers in
+    ohmg.places.receivers run for every place change, and instead rebuild the
+    whole PlaceAncestry table (which also clears the places cache) once when
+    the outermost block exits. Meant for bulk loads like `place import-all`.
+    If the block raises, nothing is rebuilt."""
+
+    depth = getattr(_deferred, "depth", 0)
+    _deferred.depth = depth + 1
+    try:
+        yield
+    finally:
+        _deferred.depth = depth
+    if depth == 0:
+        refresh_place_ancestry()
+
+class PlaceAncestry(models.Model):
+    """Closure table over Place.direct_parents: one row for every
+    (ancestor, descendant) pair in the hierarchy, including a row linking
+    each place to itself at depth 0. Rebuilt by refresh_place_ancestry()."""
+
+    ancestor = models.ForeignKey(
+        Place,
+        on_delete=models.CASCADE,
+        related_name="descendant_links",
+    )
+    descendant = models.ForeignKey(
+        Place,
+        on_delete=models.CASCADE,
+        related_name="ancestor_links",
+    )
+    depth = models.IntegerField(
+        help_text="Number of steps from the descendant up to the ancestor (shortest path)",
+    )
+
+    class Meta:
+        verbose_name_plural = "Place ancestries"
+        unique_together = ("ancestor", "descendant")
+        indexes = [
+            models.Index(fields=["ancestor", "depth"]),
+            models.Index(fields=["descendant", "depth"]),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} > {self.descendant_id} ({self.depth})"
+
+# guards against runaway recursion if a cycle is ever introduced into direct_parents
+MAX_PLACE_DEPTH = 20
+
+def refresh_place_ancestry(place_ids=None):
+    """Rebuild the PlaceAncestry closure table from direct_parents with one
+    recursive query. Pass a list of place ids to only rebuild the rows for
+    those places and their existing descendants (e.g. after creating a place
+    or changing its parents), otherwise the whole table is rebuilt. Returns
+    the number of rows created."""
+
+    ancestry_table = PlaceAncestry._meta.db_table
+    parents_table = Place.direct_parents.through._meta.db_table
+    place_table = Place._meta.db_table
+
+    params = []
+    if place_ids is None:
+        delete_sql = f"DELETE FROM {ancestry_table};"
+        seed = ""
+    else:
+        if not place_ids:
+            return 0
+        place_ids = set(place_ids)
+        place_ids.update(PlaceAncestry.objects.filter(
+            ancestor_id__in=place_ids,
+        ).values_list("descendant_id", flat=True))
+        delete_sql = f"DELETE FROM {ancestry_table} WHERE descendant_id IN %s;"
+        seed = "WHERE id IN %s"
+        params = [tuple(place_ids), tuple(place_ids)]
+
+    sql = f"""
+    {delete_sql}
+    WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+        SELECT id, id, 0 FROM {place_table} {seed}
+        UNION
+        SELECT pp.to_place_id, c.descendant_id, c.depth + 1
+        FROM closure c
+        JOIN {parents_table} pp ON pp.from_place_id = c.ancestor_id
+        WHERE c.depth < {MAX_PLACE_DEPTH}
+    )
+    INSERT INTO {ancestry_table} (ancestor_id, descendant_id, depth)
+    SELECT ancestor_id, descendant_id, MIN(depth)
+    FROM closure
+    GROUP BY ancestor_id, descendant_id;
+    """
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            ct = cursor.rowcount
+        transaction.on_commit(invalidate_place_cache)
+    return ct
+
+def update_volume_counts(volume_ids=None):
+    """Recalculate Place.volume_count and volume_count_inclusive with one
+    recursive query over the direct_parents hierarchy. Each volume counts
+    toward its locale (the first place attached to it, as with
+    Volume.get_locale), and once toward every distinct ancestor of that
+    locale. Pass a list of volume ids to only update the places that those
+    volumes are attached to and their ancestors (e.g. after importing a
+    batch of volumes), which only aggregates the volumes below those
+    places, otherwise every place is updated. Cached Place payloads are
+    invalidated once the transaction commits. Returns the number of places
+    updated."""
+
+    from ohmg.loc_insurancemaps.models import Volume
+
+    locales_table = Volume.locales.through._meta.db_table
+    parents_table = Place.direct_parents.through._meta.db_table
+    place_table = Place._meta.db_table
+
+    update_sql = f"""
+    UPDATE {place_table} p SET
+        volume_count = COALESCE(d.ct, 0),
+        volume_count_inclusive = COALESCE(i.ct, 0)
+    FROM {place_table} p2
+    LEFT JOIN direct_counts d ON d.place_id = p2.id
+    LEFT JOIN inclusive_counts i ON i.place_id = p2.id
+    WHERE p.id = p2.id
+    AND (p.volume_count != COALESCE(d.ct, 0) OR p.volume_count_inclusive != COALESCE(i.ct, 0))
+    """
+
+    if volume_ids is None:
+        params = []
+        sql = f"""
+        WITH RECURSIVE volume_locale AS (
+            SELECT DISTINCT ON (volume_id) volume_id, place_id
+            FROM {locales_table}
+            ORDER BY volume_id, id
+        ),
+        ancestors(volume_id, place_id) AS (
+            SELECT volume_id, place_id FROM volume_locale
+            UNION
+            SELECT a.volume_id, pp.to_place_id
+            FROM ancestors a
+            JOIN {parents_table} pp ON pp.from_place_id = a.place_id
+        ),
+        direct_counts AS (
+            SELECT place_id, COUNT(*) AS ct FROM volume_locale GROUP BY place_id
+        ),
+        inclusive_counts AS (
+            SELECT place_id, COUNT(*) AS ct FROM ancestors GROUP BY place_id
+        )
+        {update_sql};
+        """
+    else:
+        if not volume_ids:
+            return 0
+        # only the places these volumes are attached to and their ancestors
+        # (the targets) are recounted, so only volumes within the subtree
+        # below one of those places need to be aggregated
+        params = [tuple(volume_ids)]
+        sql = f"""
+        WITH RECURSIVE targets(place_id) AS (
+            SELECT place_id FROM {locales_table} WHERE volume_id IN %s
+            UNION
+            SELECT pp.to_place_id
+            FROM targets t
+            JOIN {parents_table} pp ON pp.from_place_id = t.place_id
+        ),
+        subtree(root_id, place_id) AS (
+            SELECT place_id, place_id FROM targets
+            UNION
+            SELECT s.root_id, pp.from_place_id
+            FROM subtree s
+            JOIN {parents_table} pp ON pp.to_place_id = s.place_id
+        ),
+        volume_locale AS (
+            SELECT DISTINCT ON (volume_id) volume_id, place_id
+            FROM {locales_table}
+            WHERE volume_id IN (
+                SELECT l.volume_id FROM {locales_table} l
+                JOIN subtree s ON s.place_id = l.place_id
+            )
+            ORDER BY volume_id, id
+        ),
+        direct_counts AS (
+            SELECT place_id, COUNT(*) AS ct FROM volume_locale GROUP BY place_id
+        ),
+        inclusive_counts AS (
+            SELECT s.root_id AS place_id, COUNT(DISTINCT v.volume_id) AS ct
+            FROM subtree s
+            JOIN volume_locale v ON v.place_id = s.place_id
+            GROUP BY s.root_id
+        )
+        {update_sql}
+        AND p.id IN (SELECT place_id FROM targets);
+        """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        ct = cursor.rowcount
+    # volumes may have been attached even if no counts changed
+    transaction.on_commit(invalidate_place_cache)
+    return ct
+
@@ -0,0 +1,81 @@
+import logging
+
+from django.db import transaction
+from django.db.models import signals
+from django.dispatch import receiver
+
+from ohmg.georeference.models import AnnotationSet
+from ohmg.loc_insurancemaps.models import Volume
+from ohmg.places.models import (
+    Place,
+    invalidate_place_cache,
+    invalidate_viewer_volume,
+    place_refresh_deferred,
+    refresh_place_ancestry,
+)
+
+logger = logging.getLogger(__name__)
+
+@receiver(signals.m2m_changed, sender=Volume.locales.through)
+def invalidate_on_locale_change(sender, action, **kwargs):
+    """Place payloads list their volumes, so expire them whenever volumes
+    are attached to or removed from places (e.g. through the admin)."""
+    if action in ("post_add", "post_remove", "post_clear"):
+        transaction.on_commit(invalidate_place_cache)
+
+@receiver(signals.post_save, sender=Volume)
+def invalidate_on_volume_save(sender, instance, update_fields, **kwargs):
+    """The viewer payload for a volume includes its lookups and progress, so
+    expire it on any save. Place payloads only show each volume's identifier,
+    year, and volume number, so they are expired only when any of those may
+    have changed (not e.g. for refreshed lookups)."""
+    volume_id = instance.pk
+    transaction.on_commit(lambda: invalidate_viewer_volume(volume_id))
+    if update_fields is not None and not set(update_fields) & {"identifier", "year", "volume_no"}:
+        return
+    transaction.on_commit(invalidate_place_cache)
+
+@receiver([signals.post_save, signals.post_delete], sender=AnnotationSet)
+def invalidate_on_annotationset_change(sender, instance, **kwargs):
+    """The viewer payload for a volume includes its main-content set, with
+    the multimask and mosaic urls."""
+    volume_id = instance.volume_id
+    if volume_id:
+        transaction.on_commit(lambda: invalidate_viewer_volume(volume_id))
+
+@receiver(signals.post_delete, sender=Volume)
+def invalidate_on_volume_delete(sender, instance, **kwargs):
+    """Deleting a volume cascades to its locale rows without sending
+    m2m_changed, so expire the payloads here."""
+    transaction.on_commit(invalidate_place_cache)
+
+@receiver([signals.post_save, signals.post_delete], sender=Place)
+def invalidate_on_place_change(sender, instance, **kwargs):
+    """Names and slugs appear in the breadcrumbs and select lists of other
+    places, so any change to a place expires all payloads. Skipped within
+    defer_place_refresh(), which clears the cache once at the end."""
+    if place_refresh_deferred():
+        return
+    transaction.on_commit(invalidate_place_cache)
+
+@receiver(signals.m2m_changed, sender=Place.direct_parents.through)
+def refresh_ancestry_on_parent_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep the PlaceAncestry closure table in sync with direct_parents,
+    wherever they are edited (the place command, the admin, etc.). Skipped
+    within defer_place_refresh(), which rebuilds the table once at the end."""
+    if action not in ("post_add", "post_remove", "post_clear") or place_refresh_deferred():
+        return
+    if not reverse:
+        refresh_place_ancestry([instance.pk])
+    elif pk_set:
+        # instance is the parent, pk_set holds the children that changed
+        refresh_place_ancestry(pk_set)
+    else:
+        # children were cleared from a parent, and which ones isn't known here
+        refresh_place_ancestry()
+
+@receiver(signals.post_save, sender=Place)
+def add_ancestry_on_create(sender, instance, created, **kwargs):
+    """Give each new place its depth 0 row, parents are added separately."""
+    if created and not place_refresh_deferred():
+        refresh_place_ancestry([instance.pk])
@@ -1,3 +1,221 @@
-from django.test import TestCase # noqa: F401
+from django.core.cache import caches
+from django.test import TestCase, override_settings
 
-# Create your tests here.
+from ohmg.loc_insurancemaps.models import Volume
+from ohmg.places.models import (
+    Place,
+    PlaceAncestry,
+    defer_place_refresh,
+    get_viewer_volume_key,
+    update_volume_counts,
+)
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "places": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "places-tests"},
+})
+class PlaceCacheTests(TestCase):
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.place = Place.objects.create(name="Plaquemine", category="city")
+            self.volume = Volume.objects.create(
+                identifier="sanborn03375_001",
+                city="Plaquemine",
+                state="louisiana",
+                year=1885,
+            )
+            self.volume.locales.add(self.place)
+        self.cache = caches["places"]
+
+    def cached_years(self):
+        self.place.serialize_cached()
+        return [i["year"] for i in self.cache.get(f"place-{self.place.pk}")["volumes"]]
+
+    def test_payload_is_cached(self):
+        self.assertEqual(self.cached_years(), [1885])
+        self.assertIsNotNone(self.cache.get(f"place-{self.place.pk}"))
+
+    def test_volume_edit_invalidates(self):
+        self.cached_years()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.volume.year = 1890
+            self.volume.save()
+        self.assertIsNone(self.cache.get(f"place-{self.place.pk}"))
+        self.assertEqual(self.cached_years(), [1890])
+
+    def test_lookup_only_save_keeps_cache(self):
+        self.cached_years()
+        self.cache.set(get_viewer_volume_key(self.volume.pk), {"identifier": self.volume.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.volume.save(update_fields=["document_lookup"])
+        self.assertIsNotNone(self.cache.get(f"place-{self.place.pk}"))
+        # the viewer payload includes the lookups, so it is expired
+        self.assertIsNone(self.cache.get(get_viewer_volume_key(self.volume.pk)))
+
+    def test_deferred_place_changes_clear_once(self):
+        self.cached_years()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with defer_place_refresh():
+                for n in range(5):
+                    Place.objects.create(name=f"Place {n}", category="city")
+        # the single ancestry rebuild at the end is the only invalidation
+        self.assertEqual(len(callbacks), 1)
+        self.assertIsNone(self.cache.get(f"place-{self.place.pk}"))
+
+    def test_volume_delete_invalidates(self):
+        self.cached_years()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.volume.delete()
+        self.assertIsNone(self.cache.get(f"place-{self.place.pk}"))
+        self.assertEqual(self.cached_years(), [])
+
+
+def legacy_update_place_counts(volume):
+    """The per-volume increment that Volume.update_place_counts used to do,
+    walking up direct_parents one place at a time."""
+    locale = volume.get_locale()
+    locale.volume_count += 1
+    locale.volume_count_inclusive += 1
+    locale.save(update_fields=["volume_count", "volume_count_inclusive"])
+    parents = locale.direct_parents.all()
+    while parents:
+        new_parents = []
+        for p in parents:
+            p.volume_count_inclusive += 1
+            p.save(update_fields=["volume_count_inclusive"])
+            new_parents += list(p.direct_parents.all())
+        parents = new_parents
+
+
+class PlaceHierarchyTestCase(TestCase):
+    """Builds a small hierarchy of places, kept in cls.places by name:
+    United States > Louisiana > Iberville > Plaquemine, White Castle
+                  > Mississippi > Natchez
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.places = {}
+        for name, category, parent in [
+            ("United States", "country", None),
+            ("Louisiana", "state", "United States"),
+            ("Iberville", "parish", "Louisiana"),
+            ("Plaquemine", "city", "Iberville"),
+            ("White Castle", "city", "Iberville"),
+            ("Mississippi", "state", "United States"),
+            ("Natchez", "city", "Mississippi"),
+        ]:
+            cls.places[name] = Place.objects.create(name=name, category=category)
+            if parent:
+                cls.places[name].direct_parents.add(cls.places[parent])
+
+    def pks(self, *names):
+        return {self.places[i].pk for i in names}
+
+
+class PlaceAncestryTests(PlaceHierarchyTestCase):
+
+    def ancestors(self, name):
+        return dict(PlaceAncestry.objects.filter(
+            descendant=self.places[name],
+        ).values_list("ancestor__name", "depth"))
+
+    def test_closure_rows(self):
+        self.assertEqual(self.ancestors("Plaquemine"), {
+            "Plaquemine": 0,
+            "Iberville": 1,
+            "Louisiana": 2,
+            "United States": 3,
+        })
+
+    def test_lookups(self):
+        plaquemine = self.places["Plaquemine"]
+        with self.assertNumQueries(1):
+            pks = self.places["Louisiana"].get_inclusive_pks()
+        self.assertEqual(set(pks), self.pks("Louisiana", "Iberville", "Plaquemine", "White Castle"))
+        self.assertEqual(
+            [i.name for i in plaquemine.get_lineage()],
+            ["United States", "Louisiana", "Iberville", "Plaquemine"],
+        )
+        self.assertEqual(plaquemine.states, [self.places["Louisiana"]])
+
+    def test_parent_change_refreshes(self):
+        self.places["White Castle"].direct_parents.set([self.places["Mississippi"]])
+        self.assertEqual(self.ancestors("White Castle"), {
+            "White Castle": 0,
+            "Mississippi": 1,
+            "United States": 2,
+        })
+        self.assertNotIn(self.places["White Castle"].pk, self.places["Louisiana"].get_inclusive_pks())
+
+    def test_deferred_refresh(self):
+        with defer_place_refresh():
+            place = Place.objects.create(name="Donaldsonville", category="city")
+            place.direct_parents.add(self.places["Louisiana"])
+            self.assertFalse(PlaceAncestry.objects.filter(descendant=place).exists())
+        self.assertEqual(self.ancestors("Donaldsonville"), {
+            "Donaldsonville": 0,
+            "Louisiana": 1,
+            "United States": 2,
+        })
+
+
+class VolumeCountTests(PlaceHierarchyTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.volumes = []
+        for n, (city, locale) in enumerate([
+            ("Plaquemine", "Plaquemine"),
+            ("Plaquemine", "Plaquemine"),
+            ("White Castle", "White Castle"),
+            ("Iberville", "Iberville"),
+            ("Natchez", "Natchez"),
+        ]):
+            volume = Volume.objects.create(
+                identifier=f"sanborn0000{n}_001",
+                city=city,
+                state="louisiana",
+                year=1885 + n,
+            )
+            volume.locales.add(cls.places[locale])
+            cls.volumes.append(volume)
+
+    def counts(self):
+        return {
+            i.name: (i.volume_count, i.volume_count_inclusive)
+            for i in Place.objects.all()
+        }
+
+    def legacy_counts(self):
+        Place.objects.update(volume_count=0, volume_count_inclusive=0)
+        for volume in self.volumes:
+            legacy_update_place_counts(volume)
+        return self.counts()
+
+    def test_matches_legacy_counts(self):
+        expected = self.legacy_counts()
+        self.assertEqual(expected["United States"], (0, 5))
+        self.assertEqual(expected["Iberville"], (1, 4))
+
+        Place.objects.update(volume_count=0, volume_count_inclusive=0)
+        update_volume_counts()
+        self.assertEqual(self.counts(), expected)
+
+        Place.objects.update(volume_count=0, volume_count_inclusive=0)
+        update_volume_counts([i.pk for i in self.volumes])
+        self.assertEqual(self.counts(), expected)
+
+    def test_volume_ids_limit_the_update(self):
+        expected = self.legacy_counts()
+        Place.objects.update(volume_count=0, volume_count_inclusive=0)
+        update_volume_counts([self.volumes[-1].pk])
+
+        counts = self.counts()
+        for name in ("Natchez", "Mississippi", "United States"):
+            self.assertEqual(counts[name], expected[name])
+        for name in ("Louisiana", "Iberville", "Plaquemine", "White Castle"):
+            self.assertEqual(counts[name], (0, 0))
@@ -16,7 +16,7 @@ class PlaceView(View):
 
         f = request.GET.get("f", None)
         p = get_object_or_404(Place, slug=place_slug)
-        place = p.serialize()
+        place = p.serialize_cached()
 
         if f == "json":
             return JsonResponse({
@@ -273,7 +273,12 @@ CELERY_TASK_ROUTES = {
     'ohmg.georeference.tasks.run_preparation_session': {'queue': 'split'},
     'ohmg.georeference.tasks.run_georeference_session': {'queue': 'georeference'},
     'ohmg.georeference.tasks.delete_expired': {'queue': 'housekeeping'},
-    'ohmg.georeference.tasks.delete_preview_vrt': {'queue': 'housekeeping'},
+    'ohmg.georeference.tasks.delete_stale_preview_vrts': {'queue': 'housekeeping'},
+    'ohmg.georeference.tasks.generate_mosaic_json_task': {'queue': 'mosaic'},
+    'ohmg.georeference.tasks.trim_mosaic_layer': {'queue': 'mosaic'},
+    'ohmg.georeference.tasks.assemble_mosaic_json': {'queue': 'mosaic'},
+    'ohmg.georeference.tasks.generate_mosaic_cog_task': {'queue': 'mosaic'},
+    'ohmg.georeference.tasks.assemble_mosaic_cog': {'queue': 'mosaic'},
     'ohmg.loc_insurancemaps.tasks.load_docs_as_task': {'queue': 'volume'},
 }
 
@@ -282,7 +287,11 @@ CELERY_BEAT_SCHEDULE = {
     'delete_expired_sessions': {
         'task': 'ohmg.georeference.tasks.delete_expired',
         'schedule': 60.0,
-    }
+    },
+    'delete_stale_preview_vrts': {
+        'task': 'ohmg.georeference.tasks.delete_stale_preview_vrts',
+        'schedule': 600.0,
+    },
 }
 
 # note: this is app_label.ModelClass,
@@ -297,6 +306,69 @@ ACCOUNT_USERNAME_VALIDATORS = 'ohmg.accounts.validators.custom_username_validato
 # prep/georef session duration before expiration (seconds)
 GEOREFERENCE_SESSION_LENGTH = int(os.getenv("GEOREFERENCE_SESSION_LENGTH", 600))
 
+# resources available to each warp-to-COG operation. memory limit is in MB,
+# and thread count is an integer or ALL_CPUS.
+GEOREFERENCE_WARP_MEMORY_LIMIT = int(os.getenv("GEOREFERENCE_WARP_MEMORY_LIMIT", 512))
+GEOREFERENCE_NUM_THREADS = os.getenv("GEOREFERENCE_NUM_THREADS", "ALL_CPUS")
+
+# default encoding for layer and mosaic COGs, can be overridden per AnnotationSet.
+# see ohmg.georeference.georeferencer.COG_ENCODING_PROFILES for options.
+COG_ENCODING_PROFILE = os.getenv("COG_ENCODING_PROFILE", "jpeg")
+
+# memory budget (MB) for writing mosaic GeoTIFFs, split between windows that
+# are in flight and GDAL's block cache
+MOSAIC_MEMORY_LIMIT = int(os.getenv("MOSAIC_MEMORY_LIMIT", 1024))
+
+# georeferencing preview VRTs are shared by every client that requests the
+# same GCPs, and are removed once unused for this many seconds
+PREVIEW_VRT_MAX_AGE = int(os.getenv("PREVIEW_VRT_MAX_AGE", 3600))
+
+# how document split previews and splits are calculated, "geos" (in process)
+# or "postgis" (one query per cut)
+SPLIT_ENGINE = os.getenv("SPLIT_ENGINE", "geos")
+
+# format that newly loaded documents are stored in: "jpeg" (one baseline
+# JPEG) or "cog" (tiled TIFF with overviews, served through the IIIF image
+# endpoint and read by window during georeferencing)
+DOCUMENT_SOURCE_FORMAT = os.getenv("DOCUMENT_SOURCE_FORMAT", "jpeg")
+
+# concurrent downloads when loading a volume's sheets (conversion runs in a
+# separate process pool sized to the cpu count)
+LOC_DOWNLOAD_WORKERS = int(os.getenv("LOC_DOWNLOAD_WORKERS", 4))
+
+# minimum seconds between requests to each host, shared across threads, and
+# base delay (seconds) for exponential backoff between retries
+HTTP_HOST_RATE_LIMITS = {
+    "tile.loc.gov": 0.25,
+    "www.loc.gov": 1,
+}
+HTTP_RETRY_BACKOFF = 2
+
+# LoC API responses are cached in CACHE_DIR/http_cache.sqlite3. entries expire
+# after HTTP_CACHE_TTL seconds (0 = never), and the least recently used are
+# evicted past HTTP_CACHE_MAX_SIZE bytes (compressed).
+HTTP_CACHE_TTL = int(os.getenv("HTTP_CACHE_TTL", 60 * 60 * 24 * 30))
+HTTP_CACHE_MAX_SIZE = int(os.getenv("HTTP_CACHE_MAX_SIZE", 512 * 1048576))
+
+# serialized Place payloads (place pages and the viewer) are cached on disk in
+# CACHE_DIR/places for PLACE_CACHE_TIMEOUT seconds. the whole cache is cleared
+# whenever volumes are attached, edited, or deleted, place volume counts change,
+# or the place hierarchy is refreshed. prewarm with `place prewarm-cache`.
+PLACE_CACHE_TIMEOUT = int(os.getenv("PLACE_CACHE_TIMEOUT", 60 * 60 * 24 * 7))
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "places": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(CACHE_DIR, "places"),
+        "TIMEOUT": PLACE_CACHE_TIMEOUT,
+        "OPTIONS": {
+            "MAX_ENTRIES": 100000,
+        },
+    },
+}
+
 MAPBOX_API_TOKEN = os.environ.get('MAPBOX_API_TOKEN', None)
 
 # no trailing slash on server location